@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import resource
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import click
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.stand_ins import PROFILES, StandInServer, get_stand_in_survey
+
+
+#  C U T O U T   P I P E L I N E   B E N C H M A R K S
+#
+# Runs batches of targets through get_cutout and save_cutout (as the fetch
+# CLI does) against the local stand-in servers, one survey at a time, each in
+# a fresh process so its peak RSS is its own. Reports cutouts/s, per cutout
+# latencies, bytes served and peak RSS per survey, and the time spent in each
+# pipeline stage:
+#    fetch:   get_tiles (download + create_fits)
+#    process: process_tile_group (trim/mosaic + format)
+#    save:    save_cutout (serialize + write)
+#
+
+
+# nb: a spawned process's ru_maxrss starts at its parent's (e.g., with the
+# stand-in servers' tiles in memory), so on Linux the high-water mark is reset
+# through /proc (clear_refs) when a survey starts, and read from VmHWM
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def get_peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/(1 << 10)
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # nb: bytes on macOS, KB elsewhere
+    return peak/(1 << 20) if sys.platform == 'darwin' else peak/(1 << 10)
+
+
+def get_percentiles(values):
+    if not values:
+        return {'p50': None, 'p99': None}
+    return {'p50': float(np.percentile(values, 50)), 'p99': float(np.percentile(values, 99))}
+
+
+class StageTimer:
+    """Collects (stage, seconds) samples from many threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = dict()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, list()).append(seconds)
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter()-start)
+        return timed
+
+    def summary(self):
+        with self.lock:
+            return {stage: dict({'count': len(s), 'total_s': float(np.sum(s))}, **get_percentiles(s))
+                    for stage, s in self.samples.items()}
+
+
+def get_targets(n, radius_arcmin, seed=0):
+    from astropy.coordinates import SkyCoord
+    import astropy.units as u
+    rng = random.Random(seed)
+    return [{'position': SkyCoord(rng.uniform(0, 360), rng.uniform(-30, 60), unit='deg'),
+             'size': 2*radius_arcmin*u.arcmin} for _ in range(n)]
+
+
+def run_survey(survey, base_url, options):
+    """Benchmarks one survey (run in its own process): returns its results."""
+    reset_peak_rss()
+    import urllib3
+    import fetch_cutouts
+    out_dir = os.path.join(options['out'], survey)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    os.chdir(options['out']) # nb: for OutLOG.txt
+    if not options['verbose']:
+        sys.stdout = open(os.devnull, 'w')
+    timer = StageTimer()
+    stand_in_class = get_stand_in_survey(survey, base_url)
+    stand_in_class.get_tiles = timer.wrap('fetch', stand_in_class.get_tiles)
+    stand_in_class.process_tile_group = timer.wrap('process', stand_in_class.process_tile_group)
+    save_cutout = timer.wrap('save', fetch_cutouts.save_cutout)
+    http = urllib3.PoolManager(num_pools=4, maxsize=options['threads'], timeout=60.0, retries=3, block=True)
+
+    def run_task(task):
+        (pid, target) = task
+        start = time.perf_counter()
+        try:
+            survey_obj = stand_in_class().set_pid(pid).attach_http_pool_manager(http)
+            survey_obj.set_out_dir(out_dir)
+            survey_obj.set_http_wait_retry_s(0)
+            survey_obj.set_compression(options['compression'])
+            all_fits = survey_obj.get_cutout(target['position'], target['size'], options['group_by'])
+            cutouts = len([f for f in all_fits if f and f['download']])
+            save_cutout(all_fits)
+            return (time.perf_counter()-start, cutouts, None)
+        except Exception as e:
+            return (time.perf_counter()-start, 0, str(e))
+
+    targets = get_targets(options['targets'], options['radius'], options['seed'])
+    start = time.perf_counter()
+    with ThreadPoolExecutor(options['threads']) as pool:
+        results = list(pool.map(run_task, enumerate(targets)))
+    wall = time.perf_counter()-start
+    latencies = [r[0] for r in results if r[2] is None]
+    cutouts = sum([r[1] for r in results])
+    errors = [r[2] for r in results if r[2] is not None]
+    return {
+        'survey': survey,
+        'targets': len(targets),
+        'cutouts': cutouts,
+        'failed_targets': len(errors),
+        'errors': sorted(set(errors))[:5],
+        'wall_s': wall,
+        'cutouts_per_s': cutouts/wall if wall > 0 else 0.0,
+        'latency_s': get_percentiles(latencies),
+        'bytes_written': sum([os.path.getsize(os.path.join(dp, f)) for dp, dn, fn in os.walk(out_dir) for f in fn]),
+        'peak_rss_mb': get_peak_rss_mb(),
+        'stages': timer.summary(),
+    }
+
+
+def format_seconds(s):
+    return "-" if s is None else f"{s*1000:.1f}ms"
+
+
+def print_report(results):
+    print(f"\n{'survey':<10} {'cutouts':>8} {'failed':>7} {'cutouts/s':>10} {'p50':>9} {'p99':>9} {'served MB':>10} {'written MB':>11} {'peak RSS MB':>12}")
+    for r in results:
+        print(f"{r['survey']:<10} {r['cutouts']:>8} {r['failed_targets']:>7} {r['cutouts_per_s']:>10.2f} "
+              f"{format_seconds(r['latency_s']['p50']):>9} {format_seconds(r['latency_s']['p99']):>9} "
+              f"{r['served']['bytes']/(1 << 20):>10.1f} {r['bytes_written']/(1 << 20):>11.1f} {r['peak_rss_mb']:>12.1f}")
+    print(f"\n{'survey':<10} {'stage':<8} {'count':>6} {'total':>10} {'p50':>9} {'p99':>9}")
+    for r in results:
+        for stage in ['fetch', 'process', 'save']:
+            if stage in r['stages']:
+                s = r['stages'][stage]
+                print(f"{r['survey']:<10} {stage:<8} {s['count']:>6} {s['total_s']:>9.2f}s {format_seconds(s['p50']):>9} {format_seconds(s['p99']):>9}")
+    for r in results:
+        for e in r['errors']:
+            print(f"{r['survey']} error: {e}")
+
+
+@click.command()
+@click.option('--surveys', '-s', 'surveys', default='FIRST,NVSS,VLASS,WISE,PANSTARRS,SDSS,GLEAM', help='comma separated surveys to benchmark')
+@click.option('--targets', '-n', 'targets', default=50, type=int, help='targets per survey (default 50)')
+@click.option('--radius', '-r', 'radius', default=1.0, type=float, help='cutout radius in arcmin (default 1)')
+@click.option('--threads', 'threads', default=15, type=int, help='concurrent cutout tasks, as the fetch grabbers (default 15)')
+@click.option('--groupby', '-g', 'group_by', default='MOSAIC', help='MOSAIC (default) or None')
+@click.option('--latency_ms', default=50.0, type=float, help='mean stand-in response latency (default 50)')
+@click.option('--jitter_ms', default=20.0, type=float, help='stand-in latency standard deviation (default 20)')
+@click.option('--fail_rate', default=0.0, type=float, help='fraction of stand-in requests answered with a 503 (default 0)')
+@click.option('--compress', 'compression', default=None, help='tile compression of the output, e.g. RICE_1')
+@click.option('--seed', default=0, type=int)
+@click.option('--out', 'out', default='bench_out', help='scratch output folder (default bench_out)')
+@click.option('--json', 'json_file', default=None, help='also write the results to this JSON file')
+@click.option('--verbose', is_flag=True, help='show the pipeline output')
+def bench(surveys, targets, radius, threads, group_by, latency_ms, jitter_ms, fail_rate, compression, seed, out, json_file, verbose):
+    surveys = [s.strip().upper() for s in surveys.split(',') if s.strip()]
+    unknown = [s for s in surveys if not s in PROFILES]
+    if unknown:
+        raise click.BadParameter(f"no stand-in for {unknown}; choose from {list(PROFILES)}")
+    options = {'targets': targets, 'radius': radius, 'threads': threads, 'group_by': group_by, 'compression': compression,
+               'seed': seed, 'out': os.path.abspath(out), 'verbose': verbose}
+    os.makedirs(options['out'], exist_ok=True)
+    server = StandInServer(latency_ms, jitter_ms, fail_rate, seed).start()
+    results = list()
+    try:
+        for survey in surveys:
+            # a fresh (spawned) process per survey, for clean peak RSS figures
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                result = pool.submit(run_survey, survey, server.get_base_url(), options).result()
+            result['served'] = server.stats.get(survey)
+            results.append(result)
+            print(f"{survey}: {result['cutouts']} cutouts in {result['wall_s']:.2f}s")
+    finally:
+        server.stop()
+    print_report(results)
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump({'options': options, 'latency_ms': latency_ms, 'jitter_ms': jitter_ms,
+                       'fail_rate': fail_rate, 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    bench()
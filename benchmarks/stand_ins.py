@@ -0,0 +1,225 @@
+import os
+import sys
+import time
+import random
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+#  S T A N D - I N   S U R V E Y   S E R V E R S
+#
+# A local HTTP server playing the part of each survey's image service, and
+# survey subclasses whose get_tile_urls point at it, so the benchmarks drive
+# the real fetch -> create_fits -> trim/mosaic -> format -> save code paths
+# without touching CADC, IRSA, STScI, etc.
+#
+# Each profile describes what a survey's service sends back:
+#    mode:     'cutout' (image of the requested size about the target) or
+#              'tile' (a fixed size survey tile that covers the target)
+#    pixel_scale, tile_pixels (for 'tile' mode), naxis (2, or 4 for
+#    degenerate frequency/stokes axes), bitpix, noise (in data units),
+#    tiles:    urls per target (e.g., PanSTARRS skycells or VLASS epochs)
+#    header:   survey specific cards that the survey classes read
+#    path:     url path (VLASS takes its epoch and file names from it)
+#
+
+PROFILES = {
+    'FIRST': {
+        'mode': 'cutout', 'pixel_scale': 1.8, 'naxis': 2, 'bitpix': -32, 'noise': 1.5e-4, 'tiles': 1,
+        'header': {'DATE-OBS': '1997-05-15', 'BMAJ': 1.5e-3, 'BMIN': 1.5e-3, 'BPA': 0.0, 'FIELDNAM': '10000+20000E'},
+        'path': 'cgi-bin/firstimage',
+    },
+    'NVSS': {
+        'mode': 'cutout', 'pixel_scale': 15.0, 'naxis': 2, 'bitpix': -32, 'noise': 4.5e-4, 'tiles': 1,
+        'header': {'DATE-OBS': '1995-03-01', 'BMAJ': 1.25e-2, 'BMIN': 1.25e-2, 'BPA': 0.0},
+        'path': 'cgi-bin/postage.pl',
+    },
+    'VLASS': {
+        'mode': 'cutout', 'pixel_scale': 1.0, 'naxis': 4, 'bitpix': -32, 'noise': 1.2e-4, 'tiles': 2,
+        'header': dict({'DATE-OBS': '2018-01-15T00:00:00.0', 'RADESYS': 'FK5', 'BMAJ': 7e-4, 'BMIN': 7e-4,
+                        'BPA': 0.0, 'BTYPE': 'Intensity'},
+                       **{f'FILNAM{i+1:02}': part for i, part in enumerate(
+                           ['VLASS1', '1', 'ql', 'T11t36', 'J000000+000000', '10', '2048', 'v1', 'I', 'iter1', 'image', 'tt0'])}),
+        'path': 'caom2ops/VLASS1.1.ql.T11t36.J000000+000000.10.2048.v1.I.iter1.image.pbcor.tt0.subim.fits',
+    },
+    'WISE': {
+        'mode': 'tile', 'pixel_scale': 1.375, 'tile_pixels': 4095, 'naxis': 2, 'bitpix': -32, 'noise': 5.0, 'tiles': 1,
+        'header': {'MIDOBS': '2010-06-15T00:00:00.0', 'COADDID': '0000p000_ac51', 'DATE-OBS': '2010-06-15'},
+        'path': 'ibe/data/wise/allwise/p3am_cdd/00/0000/0000p000_ac51/0000p000_ac51-w1-int-3.fits',
+    },
+    'PANSTARRS': {
+        'mode': 'cutout', 'pixel_scale': 0.25, 'naxis': 2, 'bitpix': -32, 'noise': 20.0, 'tiles': 2,
+        'header': {'MJD-OBS': 55500.0, 'STK_TYPE': 'stack', 'STK_ID': '1234567', 'SKYCELL': 'skycell.1234.056',
+                   'TESS_ID': 'RINGS.V3'},
+        'path': 'cgi-bin/fitscut.cgi',
+    },
+    'SDSS': {
+        'mode': 'cutout', 'pixel_scale': 0.262, 'naxis': 2, 'bitpix': -32, 'noise': 0.02, 'tiles': 1,
+        'header': {'DATE-OBS': '2003-04-01'},
+        'path': 'viewer/fits-cutout',
+    },
+    'GLEAM': {
+        'mode': 'cutout', 'pixel_scale': 28.0, 'naxis': 2, 'bitpix': -32, 'noise': 1.0e-2, 'tiles': 1,
+        'header': {'DATE-OBS': '2013-08-09'},
+        'path': 'gleam_postage/q/form',
+    },
+}
+
+
+#  Synthetic FITS
+
+def get_tile_wcs(profile, ra, dec, shape):
+    wcs = WCS(naxis=profile['naxis'])
+    ctype = ['RA---SIN', 'DEC--SIN', 'FREQ', 'STOKES'][:profile['naxis']]
+    wcs.wcs.ctype = ctype
+    wcs.wcs.crval = [ra, dec, 3.0e9, 1.0][:profile['naxis']]
+    wcs.wcs.crpix = [shape[1]/2.0+0.5, shape[0]/2.0+0.5, 1.0, 1.0][:profile['naxis']]
+    wcs.wcs.cdelt = [-profile['pixel_scale']/3600.0, profile['pixel_scale']/3600.0, 2.0e9, 1.0][:profile['naxis']]
+    return wcs
+
+
+class DataBlocks:
+    """Caches the (padded, big endian) data block of a noise image, with a
+       point source in the middle, per profile and shape, so serving a tile
+       is just a header plus a cached buffer."""
+    def __init__(self, seed=0):
+        self.blocks = dict()
+        self.lock = threading.Lock()
+        self.seed = seed
+
+    def get(self, survey, profile, shape):
+        key = (survey, shape)
+        with self.lock:
+            if not key in self.blocks:
+                rng = np.random.default_rng(self.seed)
+                image = rng.normal(0.0, profile['noise'], shape)
+                y, x = np.ogrid[:shape[0], :shape[1]]
+                image += 50*profile['noise']*np.exp(-((x-shape[1]/2.0)**2+(y-shape[0]/2.0)**2)/8.0)
+                data = image.astype('>f4' if profile['bitpix'] == -32 else '>f8').tobytes()
+                self.blocks[key] = data + b'\0'*(-len(data) % 2880)
+            return self.blocks[key]
+
+
+def get_fits_bytes(survey, profile, ra, dec, size_deg, blocks):
+    if profile['mode'] == 'tile':
+        n = profile['tile_pixels']
+        shape = (n, n)
+        # a survey tile somewhere around the target (which it still covers)
+        slack = max(0.0, (n*profile['pixel_scale']/3600.0 - size_deg)/2.0)*0.8
+        ra += random.uniform(-slack, slack)/max(np.cos(np.radians(dec)), 1e-3)
+        dec += random.uniform(-slack, slack)
+    else:
+        n = max(int(np.ceil(size_deg*3600.0/profile['pixel_scale'])), 2)
+        shape = (n, n)
+    header = get_tile_wcs(profile, ra, dec, shape).to_header()
+    for key, value in profile['header'].items():
+        header[key] = value
+    hdu = fits.PrimaryHDU(header=header)
+    hdu.header['BITPIX'] = profile['bitpix']
+    hdu.header['NAXIS'] = profile['naxis']
+    for axis in range(1, profile['naxis']+1):
+        hdu.header[f'NAXIS{axis}'] = [shape[1], shape[0], 1, 1][axis-1]
+    header_bytes = hdu.header.tostring().encode('ascii')
+    return header_bytes + blocks.get(survey, profile, shape)
+
+
+class StandInStats:
+    """Per survey request, failure and byte counts of the stand-in server."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = dict()
+
+    def add(self, survey, nbytes=0, failed=False):
+        with self.lock:
+            s = self.stats.setdefault(survey, {'requests': 0, 'failures': 0, 'bytes': 0})
+            s['requests'] += 1
+            s['failures'] += 1 if failed else 0
+            s['bytes'] += nbytes
+
+    def get(self, survey):
+        with self.lock:
+            return dict(self.stats.get(survey, {'requests': 0, 'failures': 0, 'bytes': 0}))
+
+
+def make_handler(latency_ms=0.0, jitter_ms=0.0, fail_rate=0.0, blocks=None, stats=None):
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            parsed = urllib.parse.urlparse(self.path)
+            survey = parsed.path.strip('/').split('/')[0].upper()
+            query = dict(urllib.parse.parse_qsl(parsed.query))
+            if latency_ms or jitter_ms:
+                time.sleep(max(0.0, random.gauss(latency_ms, jitter_ms))/1000.0)
+            if not survey in PROFILES or random.random() < fail_rate:
+                body = b"<html><body>503 Service Temporarily Unavailable</body></html>"
+                self.send_response(503)
+                failed = True
+            else:
+                body = get_fits_bytes(survey, PROFILES[survey], float(query['ra']), float(query['dec']),
+                                      float(query['size']), blocks)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/fits')
+                failed = False
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            stats.add(survey, len(body), failed)
+
+        def log_message(self, *args):
+            pass
+
+    return StandInHandler
+
+
+class StandInServer:
+    """Serves every profile from one local port (the survey is the first
+       path component), on a background thread."""
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, fail_rate=0.0, seed=0, host='127.0.0.1', port=0):
+        random.seed(seed)
+        self.stats = StandInStats()
+        handler = make_handler(latency_ms, jitter_ms, fail_rate, DataBlocks(seed), self.stats)
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def get_base_url(self):
+        (host, port) = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+#  Stand-in surveys
+
+def get_stand_in_survey(survey, base_url):
+    """Returns a subclass of a core survey (with the same class name, which
+       the core code keys on) that fetches from the stand-in server."""
+    import core
+    survey_class = getattr(core, survey)
+    profile = PROFILES[survey]
+
+    def get_tile_urls(self, position, size):
+        size_deg = size.to('deg').value
+        urls = list()
+        for tile in range(profile['tiles']):
+            # nb: extra tiles are offset, so mosaics have something to do
+            ra = position.ra.degree + tile*0.3*size_deg/max(np.cos(position.dec.radian), 1e-3)
+            query = urllib.parse.urlencode({'ra': ra, 'dec': position.dec.degree, 'size': size_deg, 'tile': tile})
+            urls.append(f"{base_url}/{survey.lower()}/{profile['path']}?{query}")
+        return urls
+
+    return type(survey, (survey_class,), {'get_tile_urls': get_tile_urls})
@@ -20,14 +20,48 @@ from astropy import units as u
 from astropy.coordinates import SkyCoord
 # filters used by various surveys
 from core.survey_filters import grizy_filters, wise_filters, ugriz_filters
-# supported suverys (nb: cf., SurveyConfig::self.supported_surveys)
-from core.nvss      import NVSS
-from core.first     import FIRST
-from core.wise      import WISE
-from core.sdss      import SDSS
-from core.vlass     import VLASS
-from core.panstarrs import PANSTARRS
-from core.gleam     import GLEAM
+# supported suverys (nb: cf., SurveyConfig::self.supported_surveys), imported
+# only once requested
+from core import SURVEY_MODULES, get_survey_class
+
+# a survey instance, to hold one task's state (its clients are shared, see
+# get_thread_client), with a filter enum of the survey's, or its default
+def get_survey(survey_name, filter=None):
+    survey_class = get_survey_class(survey_name)
+    return survey_class(filter=filter) if filter else survey_class()
+
+# processing stack tasks as JSON-able dicts and back, e.g., for sending them
+# through a work queue to be run by another process (or node)
+def get_task_spec(task):
+    survey = task['survey']
+    return {
+        'ra':          task['position'].ra.degree,
+        'dec':         task['position'].dec.degree,
+        'size_arcmin': task['size'].to(u.arcmin).value,
+        'survey':      type(survey).__name__,
+        'filter':      survey.get_filter_name(),
+        'group_by':    task['group_by'],
+        'out_dir':     os.path.abspath(survey.out_dir),
+        'overwrite':   survey.overwrite,
+        'compression': survey.compression,
+        'quantize_level': survey.quantize_level,
+    }
+
+def get_task_from_spec(spec, pid=0):
+    filter = None
+    if spec['filter']:
+        filter = [f for f in get_survey_class(spec['survey']).get_supported_filters() if f.name.lower() == spec['filter']][0]
+    survey = get_survey(spec['survey'], filter)
+    survey.set_out_dir(spec['out_dir'])
+    survey.overwrite = spec['overwrite']
+    survey.set_compression(spec['compression'], spec['quantize_level'])
+    return {
+        'position': SkyCoord(spec['ra'], spec['dec'], unit=(u.deg, u.deg)),
+        'size':     spec['size_arcmin'] * u.arcmin,
+        'survey':   survey,
+        'group_by': spec['group_by'],
+        'pid':      pid,
+    }
 
 # THIS IS ONLY USED FOR THE COMMAND LINE INTERFACE CAN BE REMOVED FROM CORE
 #
@@ -41,16 +75,51 @@ class CLIConfig:
         # defaults
         self.MAX_BATCH_SIZE = 1000
         self.overwrite = False
+        self.save_workers = 4 # number of threads writing FITS output
+        # limits on cutouts waiting to be saved (the out queue)
+        self.max_queued_items = 64
+        self.max_queued_bytes = 1024 * (1 << 20)
+        # tile compression of the output FITS (None for uncompressed)
+        self.compression = None
+        self.quantize_level = 16
+        # write into a few multi-extension FITS shards instead of per cutout files
+        self.data_out = data_out
+        self.container = False
+        self.shard_bytes = 4 * (1 << 30)
+        # skip targets already recorded in the manifest (data_out/manifest.sqlite)
+        self.skip_existing = False
+        # render PNG/JPEG images of the cutouts (None for no images)
+        self.render_format = None
+        self.render_workers = None # defaults to the cpu count
+        # time each task's stages, writing a Chrome trace here (None for no tracing)
+        self.trace_file = None
+        # live metrics: a Prometheus text endpoint and/or a periodically rewritten stats file
+        self.metrics_port = None
+        self.stats_file = None
+        self.stats_interval_s = 10.0
+        # JSON-lines log of the run, and how much goes to the console
+        self.log_file = "OutLOG.jsonl"
+        self.verbosity = "debug"
+        # keep-alive connections per survey host, and any per host exceptions, e.g., {'www.cv.nrao.edu': 4}
+        self.http_connections = 15
+        self.http_host_connections = {}
+        # verify the survey hosts' TLS certificates (nb: off only for hosts with broken certificates)
+        self.http_verify = True
+        # overrides of the surveys' own http retry policies, e.g., {'NVSS': {'attempts': 4, 'base_s': 10}}
+        self.http_retries = {}
+        # a host's circuit breaker opens after this many failures in a row, for reset_s seconds
+        self.breaker_failures = 5
+        self.breaker_reset_s = 30.0
+        # hedged downloads: a duplicate is sent for one slower than this percentile of its
+        # host's (None for no hedging), up to budget duplicates per request
+        self.hedge_percentile = None
+        self.hedge_budget = 0.05
+        # work queue workers: how long a task is leased for (renewed while in
+        # hand), and how many times it's tried before it goes to failed/
+        self.lease_s = 600.0
+        self.max_attempts = 3
         self.survey_filter_sets = {} #None # this is to keep track of requested survey filters
-        self.supported_surveys = (
-            FIRST.__name__,
-            NVSS.__name__,
-            VLASS.__name__,
-            WISE.__name__,
-            PANSTARRS.__name__,
-            SDSS.__name__,
-            GLEAM.__name__,
-        )
+        self.supported_surveys = tuple(SURVEY_MODULES)
         self.group_by = group_by
         self.survey_names = []
         self.set_survey_filter_sets(surveys)
@@ -58,8 +127,8 @@ class CLIConfig:
         #self.local_dirs.set_local_root(out_dir)
         #self.out_dirs = {s: self.local_dirs.get_survey_dir(s) for s in self.survey_names}
         ###############################################################
-        # same config for sinlge or batch
-        self.out_dirs = {s: os.path.join(data_out,s) for s in self.survey_names}
+        # same config for sinlge or batch (nb: none for a work queue worker, whose tasks have theirs)
+        self.out_dirs = {s: os.path.join(data_out,s) for s in self.survey_names} if data_out else {}
         if "PANSTARRS" in self.out_dirs.keys():
             self.out_dirs["PANSTARRS"] = self.out_dirs["PANSTARRS"].replace("PANSTARRS", "PanSTARRS")
         for out_dir in self.out_dirs.values():
@@ -75,6 +144,122 @@ class CLIConfig:
     def get_overwrite(self):
         return self.overwrite
 
+    def set_save_workers(self,save_workers):
+        if isinstance(save_workers, int) and save_workers > 0:
+            self.save_workers = save_workers
+        return self.save_workers
+
+    def set_compression(self,compression,quantize_level=None):
+        self.compression = compression
+        if quantize_level is not None:
+            self.quantize_level = quantize_level
+        return self.compression
+
+    def set_container(self,container=True,shard_mb=None):
+        if isinstance(container, bool):
+            self.container = container
+        if isinstance(shard_mb, int) and shard_mb > 0:
+            self.shard_bytes = shard_mb * (1 << 20)
+        return self.container
+
+    def get_shards_dir(self):
+        return os.path.join(self.data_out,"shards")
+
+    def get_manifest_file(self):
+        return os.path.join(self.data_out,"manifest.sqlite")
+
+    def set_skip_existing(self,skip_existing=True):
+        if isinstance(skip_existing, bool):
+            self.skip_existing = skip_existing
+        return self.skip_existing
+
+    def set_render(self,render_format,render_workers=None):
+        self.render_format = render_format
+        if isinstance(render_workers, int) and render_workers > 0:
+            self.render_workers = render_workers
+        return self.render_format
+
+    def set_trace(self,trace_file):
+        if isinstance(trace_file, str) and trace_file:
+            self.trace_file = trace_file
+        return self.trace_file
+
+    def set_metrics_port(self,metrics_port):
+        if isinstance(metrics_port, int) and metrics_port > 0:
+            self.metrics_port = metrics_port
+        return self.metrics_port
+
+    def set_stats_file(self,stats_file,stats_interval=None):
+        if isinstance(stats_file, str) and stats_file:
+            self.stats_file = stats_file
+        if isinstance(stats_interval, (int, float)) and stats_interval > 0:
+            self.stats_interval_s = float(stats_interval)
+        return self.stats_file
+
+    def set_verbosity(self,verbosity):
+        if isinstance(verbosity, str) and verbosity.lower() in ["debug", "info", "warning", "error", "quiet"]:
+            self.verbosity = verbosity.lower()
+        return self.verbosity
+
+    def set_log_file(self,log_file):
+        if isinstance(log_file, str) and log_file:
+            self.log_file = log_file
+        return self.log_file
+
+    def set_http_connections(self,http_connections,http_host_connections=None):
+        if isinstance(http_connections, int) and http_connections > 0:
+            self.http_connections = http_connections
+        if isinstance(http_host_connections, dict):
+            self.http_host_connections = {str(host): int(n) for host, n in http_host_connections.items() if int(n) > 0}
+        return self.http_connections
+
+    def set_http_verify(self,http_verify):
+        if isinstance(http_verify, bool):
+            self.http_verify = http_verify
+        return self.http_verify
+
+    def set_http_retries(self,http_retries):
+        if isinstance(http_retries, dict):
+            self.http_retries = {str(survey).upper(): {key: float(value) if key != 'attempts' else int(value)
+                                                       for key, value in settings.items() if key in ('attempts', 'base_s', 'max_s') and value > 0}
+                                 for survey, settings in http_retries.items() if isinstance(settings, dict)}
+        return self.http_retries
+
+    # a survey's retry policy, with this run's overrides of it
+    def set_survey_http_retries(self,survey):
+        overrides = self.http_retries.get(type(survey).__name__.upper())
+        return survey.set_retry_policy(survey.retry_policy.replace(**overrides)) if overrides else survey
+
+    def set_circuit_breaker(self,breaker_failures,breaker_reset_s=None):
+        if isinstance(breaker_failures, int) and breaker_failures > 0:
+            self.breaker_failures = breaker_failures
+        if isinstance(breaker_reset_s, (int, float)) and breaker_reset_s > 0:
+            self.breaker_reset_s = float(breaker_reset_s)
+        return self.breaker_failures
+
+    def set_hedging(self,hedge_percentile,hedge_budget=None):
+        if isinstance(hedge_percentile, (int, float)) and 50 <= hedge_percentile < 100:
+            self.hedge_percentile = float(hedge_percentile)
+        if isinstance(hedge_budget, (int, float)) and 0 < hedge_budget <= 1:
+            self.hedge_budget = float(hedge_budget)
+        return self.hedge_percentile
+
+    def set_lease(self,lease_s,max_attempts=None):
+        if isinstance(lease_s, (int, float)) and lease_s > 0:
+            self.lease_s = float(lease_s)
+        if isinstance(max_attempts, int) and max_attempts > 0:
+            self.max_attempts = max_attempts
+        return self.lease_s
+
+    # requested filters by survey, for RGB composites
+    def get_rgb_filters(self):
+        return {s: filters for s, filters in self.survey_filter_sets.items() if len(filters) >= 3}
+
+    def set_max_queued_mb(self,max_queued_mb):
+        if isinstance(max_queued_mb, int) and max_queued_mb > 0:
+            self.max_queued_bytes = max_queued_mb * (1 << 20)
+        return self.max_queued_bytes // (1 << 20)
+
     def get_survey_targets(self):
         return self.targets
 
@@ -126,6 +311,13 @@ class CLIConfig:
             raise Exception("No Target provided!")
         self.targets = [{'position': extractCoordfromString(single_target, is_name), 'size': self.size_arcmin}]
 
+    # positions already resolved to SkyCoords (e.g., a service job's targets)
+    def set_targets(self, positions, size):
+        self.size_arcmin = size * u.arcmin
+        if not positions:
+            raise Exception("No Target provided!")
+        self.targets = [{'position': position, 'size': self.size_arcmin} for position in positions]
+
     def set_batch_targets(self, csv_files, relative_path, size):
         self.size_arcmin = size * u.arcmin
         # set targets in list of dicts
@@ -138,15 +330,14 @@ class CLIConfig:
         self.targets = [dict(item, size=self.size_arcmin) for item in coords]
 
     def match_filters(self,survey,filters):
-        # Get class from globals and create an instance
-        survey_class = globals()[survey.upper()]()
+        # nb: get_supported_filters is static, so no instance is needed
+        supported_filters = get_survey_class(survey).get_supported_filters()
         if isinstance(filters,str):
             filters = [filters]
         matched = list()
         for filter in filters:
             found = False
-            # Get the function (from the instance) that we need to call
-            for supported_filter in getattr(survey_class, 'get_supported_filters')():
+            for supported_filter in supported_filters:
             # for supported_filter in get_supported_filters(survey):
                 if supported_filter.name.lower() == filter.lower():
                     found = True
@@ -158,6 +349,7 @@ class CLIConfig:
                 self.__print(f"WARNING: '{survey}' filter '{filter}' is not supported!")
         return set(matched)
 
+    # (survey name, filter) pairs, with None for the survey's default filter
     def get_survey_class_stack(self):
         class_stack = list()
         for survey_name in self.survey_names:
@@ -165,10 +357,10 @@ class CLIConfig:
             # if self.has_filters(survey_name):
                 for filter in self.survey_filter_sets[survey_name]:
                     self.__print(f"USING_SURVEY_CLASS: {survey_name}(filter={filter})")
-                    class_stack.append(f"{survey_name}(filter={filter})")
+                    class_stack.append((survey_name, filter))
             else:
                 self.__print(f"USING_SURVEY_CLASS: {survey_name}()")
-                class_stack.append(f"{survey_name}()")
+                class_stack.append((survey_name, None))
         return class_stack
 
     # main initial processing step
@@ -180,14 +372,16 @@ class CLIConfig:
         # ok, let's build the cutout-fetching processing stack
         pid = 0 # task tracking id
         procssing_stack = list()
-        for survey_class in survey_classes:
+        for (survey_name, filter) in survey_classes:
             for survey_target in survey_targets:
                 # ra-dec-size cutout target
                 task = dict(survey_target)
-                task['survey'] = eval(survey_class) # add survey instance to processing stack
+                task['survey'] = get_survey(survey_name, filter) # add survey instance to processing stack
                 survey = type(task['survey']).__name__
                 task['survey'].set_out_dir(self.out_dirs[survey]) #set where to store output
                 task['survey'].overwrite = self.overwrite
+                task['survey'].set_compression(self.compression, self.quantize_level)
+                self.set_survey_http_retries(task['survey'])
                 # filter = task['survey'].get_filter_setting()
                 # radius = task['size']/2
                 task['group_by'] = self.group_by
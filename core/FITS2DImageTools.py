@@ -1,57 +1,73 @@
 import io
+import zlib
+import struct
 import numpy as np
 from astropy import units as u
-import matplotlib.pyplot as plt
 from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.stats import mad_std
-from astropy.visualization import imshow_norm, ZScaleInterval, MinMaxInterval, AsinhStretch, ManualInterval, ImageNormalize
+from astropy.visualization import ZScaleInterval, MinMaxInterval, AsinhStretch, ManualInterval, ImageNormalize
 from .statistics import rms_mad, error_median, robust_stats_radio
 
 
-def asinh_plot(wcs, image_data, survey, showgrid=False):
-    cmap = plt.get_cmap('gray')
+# returns (image_data, interval, stretch, cbar_label) for displaying a survey's
+# image; image_rms is the data's robust rms (i.e., a cutout's DATARMS), if known
+def get_display_params(image_data, survey, image_rms=None):
     if survey.upper() in ["PANSTARRS", "WISE", "SDSS"]:
-        interval = ZScaleInterval()
-        cbar_label = ''
-        stretch = AsinhStretch()
-    else:
-        image_data *= 1000 # convert to mJy
-        cbar_label = 'mJy'
-        interval = MinMaxInterval()
-        stretch  = AsinhStretch(asinh_soften_for_noise_RMS(image_data,
-                                                           3,
-                                                           interval))
+        return image_data, ZScaleInterval(), AsinhStretch(), ''
+    image_data = image_data * 1000 # convert to mJy (nb: a copy, so the hdu's data is left alone)
+    interval = MinMaxInterval()
+    stretch  = AsinhStretch(asinh_soften_for_noise_RMS(image_data,
+                                                       3,
+                                                       interval,
+                                                       # nb: as robust_stats_radio gives for the mJy data
+                                                       None if image_rms is None else image_rms*1000*1000))
+    return image_data, interval, stretch, 'mJy'
+
+def get_image_rms(header):
+    return header.get('DATARMS') if header is not None else None
+
+def asinh_plot(wcs, image_data, survey, showgrid=False, image_format='png', image_rms=None):
+    import matplotlib.pyplot as plt
+    cmap = plt.get_cmap('gray')
+    image_data, interval, stretch, cbar_label = get_display_params(image_data, survey, image_rms)
     return CIRADA_image_plot(wcs, image_data,
                       cbar_label, cmap,
                       showgrid,
                       interval,
-                      stretch)
+                      stretch,
+                      image_format)
 
 def CIRADA_image_plot(wcs, image_data,cbar_label, cmap,showgrid=False,
-                      interval = MinMaxInterval(),stretch = AsinhStretch()):
-    plt.rcParams.update({'font.size': 24})
-    fig = plt.figure(figsize=(10.5, 8), dpi=75)
-    ax = plt.subplot(projection=wcs.celestial)
-    im, norm = imshow_norm(image_data, ax, origin='lower',
-                       interval=interval,
-                       stretch=stretch,
-                       cmap=cmap)
-    cbar = fig.colorbar(im, cmap=cmap)
-    ax.set_xlabel('RA J2000')
-    ax.set_ylabel('Dec J2000')
-    cbar.set_label(cbar_label)
-    if showgrid:
-        ax.grid(color='white', ls='solid')
-    output = io.BytesIO()
-    plt.savefig(output, bbox_inches="tight")
-    plt.close(fig)
+                      interval = MinMaxInterval(),stretch = AsinhStretch(), image_format='png'):
+    import matplotlib.pyplot as plt
+    from astropy.visualization import imshow_norm
+    # nb: rc_context, so the font size doesn't leak into other plots
+    with plt.rc_context({'font.size': 24}):
+        fig = plt.figure(figsize=(10.5, 8), dpi=75)
+        try:
+            ax = plt.subplot(projection=wcs.celestial)
+            im, norm = imshow_norm(image_data, ax, origin='lower',
+                               interval=interval,
+                               stretch=stretch,
+                               cmap=cmap)
+            cbar = fig.colorbar(im, cmap=cmap)
+            ax.set_xlabel('RA J2000')
+            ax.set_ylabel('Dec J2000')
+            cbar.set_label(cbar_label)
+            if showgrid:
+                ax.grid(color='white', ls='solid')
+            output = io.BytesIO()
+            fig.savefig(output, bbox_inches="tight", format=image_format)
+        finally:
+            plt.close(fig)
     return output
 
 
-def asinh_soften_for_noise_RMS(image_data_2D, factor=3, interval=MinMaxInterval()):
-    (image_MIN, image_MAX, image_MEDIAN,
-     image_RMS, image_STD, image_MEAN) = robust_stats_radio(image_data_2D)
+def asinh_soften_for_noise_RMS(image_data_2D, factor=3, interval=MinMaxInterval(), image_RMS=None):
+    if image_RMS is None:
+        (image_MIN, image_MAX, image_MEDIAN,
+         image_RMS, image_STD, image_MEAN) = robust_stats_radio(image_data_2D)
     (image_MIN, image_MAX) = interval.get_limits(image_data_2D)
     if factor*image_RMS >= image_MIN:
         parameter = (factor*image_RMS-image_MIN)/(image_MAX-image_MIN)
@@ -59,13 +75,56 @@ def asinh_soften_for_noise_RMS(image_data_2D, factor=3, interval=MinMaxInterval(
         parameter = 0.1 # Default for asinh
     return parameter
 
-# main, calls other methods to create and return thumbnail in image buffer
-def get_thumbnail(hdu, survey):
-    wcs = WCS(hdu.header)
+
+# interval + stretch to 8-bit grey levels, flipped so north is up (i.e., as
+# imshow's origin='lower'); blanks (NaN) come out black
+def stretch_to_uint8(image_data, interval, stretch):
+    (vmin, vmax) = interval.get_limits(image_data)
+    scaled = np.array(image_data, dtype=np.float32)
+    scaled -= vmin
+    if vmax > vmin:
+        scaled /= (vmax-vmin)
+    np.clip(scaled, 0.0, 1.0, out=scaled)
+    scaled = stretch(scaled, clip=True, out=scaled)
+    scaled[np.isnan(scaled)] = 0.0
+    pixels = (scaled*255.0+0.5).astype(np.uint8)
+    return pixels[::-1]
+
+# minimal 8-bit greyscale (height, width) or RGB (height, width, 3) PNG
+# encoder: one IDAT chunk, no row filtering
+def encode_png(pixels, compress_level=6):
+    height, width = pixels.shape[:2]
+    color_type = 2 if pixels.ndim == 3 else 0
+    rows = np.zeros((height, pixels[0].size+1), dtype=np.uint8) # leading 0 per row is filter type 'None'
+    rows[:,1:] = pixels.reshape(height, -1)
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag+data) & 0xffffffff)
+    return (b"\x89PNG\r\n\x1a\n" +
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)) +
+            chunk(b"IDAT", zlib.compress(rows.tobytes(), compress_level)) +
+            chunk(b"IEND", b""))
+
+def encode_jpeg(pixels, quality=90):
+    from PIL import Image
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+# main, calls other methods to create and return thumbnail in image buffer:
+# by default a bare, greyscale, stretched image, rendered straight from the
+# data; decorated=True draws the (much slower) matplotlib version with WCS
+# axes and a colorbar
+def get_thumbnail(hdu, survey, decorated=False, image_format='png'):
     # # squeeze to 2d from nd to make thumbnail
     image_data = np.squeeze(hdu.data) #WILL NEED A BETTER TRIMMER FOR CUBES LIKELY trim_axes(hdu, wcs)
-    img_buffer = asinh_plot(wcs, image_data, survey)
-    return img_buffer.getvalue()
+    if decorated:
+        img_buffer = asinh_plot(WCS(hdu.header), image_data, survey, image_format=image_format, image_rms=get_image_rms(hdu.header))
+        return img_buffer.getvalue()
+    image_data, interval, stretch, cbar_label = get_display_params(image_data, survey, get_image_rms(hdu.header))
+    pixels = stretch_to_uint8(image_data, interval, stretch)
+    if image_format.lower() in ['jpg', 'jpeg']:
+        return encode_jpeg(pixels)
+    return encode_png(pixels)
 
 
 # def trim_axes(hdu, wcs):
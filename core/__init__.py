@@ -1,15 +1,66 @@
+import importlib
+
 # abstract base class components
-from .survey_abc     import processing_status
 from .survey_filters import grizy_filters, wise_filters, ugriz_filters, vlass_epoch
-from .FITS2DImageTools import *
-from .statistics import *
 from .toolbox import *
 
-# supported surveys
-from .first     import FIRST
-from .nvss      import NVSS
-from .vlass     import VLASS
-from .wise      import WISE
-from .panstarrs import PANSTARRS
-from .sdss      import SDSS
-from .gleam     import GLEAM
+# supported surveys, and everything heavier, are only imported when first
+# used (e.g., core.VLASS imports core.vlass, and with it astroquery), so a
+# run only pays for the surveys it asks for
+SURVEY_MODULES = {
+    'FIRST':     '.first',
+    'NVSS':      '.nvss',
+    'VLASS':     '.vlass',
+    'WISE':      '.wise',
+    'PANSTARRS': '.panstarrs',
+    'SDSS':      '.sdss',
+    'GLEAM':     '.gleam',
+}
+LAZY_NAMES = {
+    'processing_status': '.survey_abc',
+    'SurveyABC':         '.survey_abc',
+}
+# modules whose names used to be star imported here
+LAZY_STAR_MODULES = ['.FITS2DImageTools', '.statistics']
+
+
+def get_survey_class(name):
+    """The survey class for a (case insensitive) survey name, e.g., 'VLASS'."""
+    return getattr(importlib.import_module(SURVEY_MODULES[name.upper()], __name__), name.upper())
+
+
+# names of ours a star import of core leaves out
+LAZY_MACHINERY = ['importlib', 'LAZY_NAMES', 'LAZY_STAR_MODULES', 'LAZY_MACHINERY', 'get_star_names']
+
+# the names a star import of core gets (as before the lazy imports): the
+# surveys, the lazy names, and the star modules' exports (nb: only built, and
+# those modules imported, by a star import, through __all__)
+def get_star_names():
+    names = [name for name in globals() if not name.startswith('_') and not name in LAZY_MACHINERY]
+    for module_name in LAZY_STAR_MODULES:
+        module = importlib.import_module(module_name, __name__)
+        names += getattr(module, '__all__', [name for name in vars(module) if not name.startswith('_')])
+    return sorted(set(names + list(SURVEY_MODULES) + list(LAZY_NAMES)))
+
+
+def __getattr__(name):
+    if name == '__all__':
+        value = get_star_names()
+    elif name in SURVEY_MODULES:
+        value = get_survey_class(name)
+    elif name in LAZY_NAMES:
+        value = getattr(importlib.import_module(LAZY_NAMES[name], __name__), name)
+    else:
+        for module_name in LAZY_STAR_MODULES:
+            module = importlib.import_module(module_name, __name__)
+            if hasattr(module, name) and not name.startswith('_'):
+                value = getattr(module, name)
+                break
+        else:
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(SURVEY_MODULES) + list(LAZY_NAMES))
@@ -0,0 +1,186 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+
+
+#  I N - M E M O R Y   M O S A I C K I N G
+#
+# A small NumPy reproject-and-coadd engine for cutout sized mosaics: it does
+# what Montage's mMakeHdr/mProjectPP/mAdd(mean) do for us, but without the
+# temp files and external binaries. Tiles are bilinearly resampled onto a
+# common north-up TAN grid and mean combined. The reprojection is split into
+# (tile, row band) jobs which can be run on a shared thread or process pool,
+# with the coadd done as the final reduction.
+#
+
+
+# pools are shared by all the cutout threads so the number of reprojection
+# workers stays bounded no matter how many tasks are mosaicking at once
+reprojection_pools = dict()
+reprojection_pools_lock = threading.Lock()
+
+def get_reprojection_pool(workers, use_processes=False):
+    key = (workers, use_processes)
+    with reprojection_pools_lock:
+        if not key in reprojection_pools:
+            if use_processes:
+                # nb: spawn, as forking a process full of threads isn't safe
+                reprojection_pools[key] = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                reprojection_pools[key] = ThreadPoolExecutor(workers, thread_name_prefix='reproject')
+        return reprojection_pools[key]
+
+
+def get_celestial_image(hdu):
+    """Returns the 2D celestial (wcs, data) pair of an image hdu: i.e., with
+       any degenerate (e.g., frequency/stokes) axes dropped."""
+    return WCS(hdu.header).celestial, np.squeeze(hdu.data)
+
+
+def to_unit_vectors(ra, dec):
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.array([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)])
+
+
+def get_footprint(wcs, data):
+    # world (ra, dec) corners of the image
+    return wcs.calc_footprint(axes=(data.shape[1], data.shape[0]))
+
+
+# raised when a mosaic grid would be larger than asked for (e.g., so Montage can have it)
+class MosaicTooLarge(Exception):
+    pass
+
+
+def make_mosaic_wcs(images, center=None, size=None):
+    """Builds a north-up TAN frame, at the finest input pixel scale, covering
+       all the (wcs, data) images. If center=(ra, dec) is given the frame is
+       centred on it, with CRPIX at the middle of the image: i.e., as the
+       cutout headers expect; and if size (degrees) is too, it only covers
+       that box about the centre (plus a pixel's margin), rather than the
+       whole tiles. Returns (wcs, shape)."""
+    scale = min(min(proj_plane_pixel_scales(wcs)) for (wcs, data) in images)
+    corners = np.vstack([get_footprint(wcs, data) for (wcs, data) in images])
+    if center is None:
+        x, y, z = to_unit_vectors(corners[:,0], corners[:,1]).mean(axis=1)
+        center = ((np.degrees(np.arctan2(y, x)) % 360.0), np.degrees(np.arctan2(z, np.hypot(x, y))))
+    ref = images[0][0]
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.cunit = ['deg', 'deg']
+    wcs.wcs.crval = list(center)
+    wcs.wcs.cdelt = [-scale, scale]
+    wcs.wcs.crpix = [1, 1]
+    if ref.wcs.radesys:
+        wcs.wcs.radesys = ref.wcs.radesys
+    if size is not None and center is not None:
+        # just the cutout box (nb: trim_tile takes the stamp out of it)
+        naxis1 = naxis2 = 2*int(np.ceil(size/2.0/scale+1))
+    else:
+        # symmetric extent about the centre that takes in every corner
+        x, y = wcs.wcs_world2pix(corners[:,0], corners[:,1], 0)
+        naxis1 = 2*int(np.ceil(np.max(np.abs(x))+1))
+        naxis2 = 2*int(np.ceil(np.max(np.abs(y))+1))
+    wcs.wcs.crpix = [naxis1/2.0, naxis2/2.0]
+    return wcs, (naxis2, naxis1)
+
+
+def interpolate_bilinear(data, x, y):
+    """Samples data at (0-based) pixel positions x, y; positions off the image
+       (or next to blank pixels) come back as NaN."""
+    ny, nx = data.shape
+    inside = (x >= -0.5) & (x <= nx-0.5) & (y >= -0.5) & (y <= ny-0.5)
+    x = np.clip(x, 0, nx-1)
+    y = np.clip(y, 0, ny-1)
+    x0 = np.floor(x).astype(int)
+    y0 = np.floor(y).astype(int)
+    x1 = np.minimum(x0+1, nx-1)
+    y1 = np.minimum(y0+1, ny-1)
+    fx = x-x0
+    fy = y-y0
+    values = (data[y0,x0]*(1-fx)*(1-fy) + data[y0,x1]*fx*(1-fy) +
+              data[y1,x0]*(1-fx)*fy     + data[y1,x1]*fx*fy)
+    values[~inside] = np.nan
+    return values
+
+
+def get_overlap(image, mosaic_wcs, shape):
+    """Returns the (y0, y1, x0, x1) box of the mosaic grid covered by a
+       (wcs, data) image, clipped to the grid, or None if it doesn't overlap."""
+    (wcs, data) = image
+    corners = get_footprint(wcs, data)
+    x, y = mosaic_wcs.wcs_world2pix(corners[:,0], corners[:,1], 0)
+    x0, x1 = max(int(np.floor(x.min())), 0), min(int(np.ceil(x.max()))+1, shape[1])
+    y0, y1 = max(int(np.floor(y.min())), 0), min(int(np.ceil(y.max()))+1, shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return (y0, y1, x0, x1)
+
+
+def reproject_image(image, mosaic_wcs, box):
+    """Resamples a (wcs, data) image onto the (y0, y1, x0, x1) box of the
+       mosaic grid. Returns (y0, x0, values)."""
+    (wcs, data) = image
+    (y0, y1, x0, x1) = box
+    yy, xx = np.mgrid[y0:y1, x0:x1]
+    ra, dec = mosaic_wcs.wcs_pix2world(xx, yy, 0)
+    if wcs.has_distortion:
+        ix, iy = wcs.all_world2pix(ra, dec, 0)
+    else:
+        ix, iy = wcs.wcs_world2pix(ra, dec, 0)
+    return (y0, x0, interpolate_bilinear(data, ix, iy))
+
+
+def reproject_job(job):
+    return reproject_image(*job)
+
+
+def coadd(reprojected, shape):
+    """Mean combines reprojected (y0, x0, values) patches; uncovered pixels are NaN."""
+    total = np.zeros(shape)
+    count = np.zeros(shape)
+    for patch in reprojected:
+        if patch is None:
+            continue
+        (y0, x0, values) = patch
+        valid = np.isfinite(values)
+        (ny, nx) = values.shape
+        total[y0:y0+ny, x0:x0+nx][valid] += values[valid]
+        count[y0:y0+ny, x0:x0+nx][valid] += 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mosaic = np.where(count > 0, total/count, np.nan)
+    return mosaic.astype(np.float32)
+
+
+def reproject_and_coadd(hdus, center=None, workers=1, use_processes=False, rows_per_job=256, size=None, max_pixels=None):
+    """Mosaics a list of image hdus in memory, returning an HDUList (like
+       SurveyABC.mosaic's Montage path) whose header is WCS only. Given a
+       center and size (degrees) only that box is mosaicked. With workers > 1
+       the reprojection runs on a shared thread (or process) pool: threads
+       get one job per band of rows_per_job mosaic rows of a tile, processes
+       one job per tile (to limit pickling). Raises MosaicTooLarge if the
+       grid would have more than max_pixels."""
+    images = [get_celestial_image(hdu) for hdu in hdus]
+    mosaic_wcs, shape = make_mosaic_wcs(images, center, size)
+    if max_pixels and shape[0]*shape[1] > max_pixels:
+        raise MosaicTooLarge(f"{shape[1]}x{shape[0]} mosaic exceeds the {max_pixels} pixel limit")
+    jobs = list()
+    for image in images:
+        box = get_overlap(image, mosaic_wcs, shape)
+        if box is None:
+            continue
+        (y0, y1, x0, x1) = box
+        step = (y1-y0) if use_processes else rows_per_job
+        for y in range(y0, y1, step):
+            jobs.append((image, mosaic_wcs, (y, min(y+step, y1), x0, x1)))
+    if workers > 1 and len(jobs) > 1:
+        reprojected = get_reprojection_pool(workers, use_processes).map(reproject_job, jobs)
+    else:
+        reprojected = map(reproject_job, jobs)
+    return fits.HDUList([fits.PrimaryHDU(coadd(reprojected, shape), header=mosaic_wcs.to_header())])
@@ -5,10 +5,14 @@ import requests, json
 from .toolbox import pad_string_lines
 
 from .survey_abc import SurveyABC
+from .retry import RetryPolicy
 class FIRST(SurveyABC):
     def __init__(self):
         super().__init__()
         self.needs_trimming = False
+        self.http_max_response_bytes = 32 * (1 << 20)
+        # a single cgi server: give it longer to recover between retries
+        self.retry_policy = RetryPolicy(attempts=3, base_s=5.0, max_s=60.0)
 
     @staticmethod
     def get_supported_filters():
@@ -0,0 +1,146 @@
+import os
+import io
+import csv
+import hashlib
+import threading
+
+from astropy.io import fits
+
+
+#  B A T C H   C O N T A I N E R   O U T P U T
+#
+# Rather than one (or more) small FITS file per target/survey/group, cutouts
+# (and the original tiles of mosaics) are appended as image extensions to a
+# handful of large multi-extension FITS shards, e.g.,
+#
+#    data_out/shards/cutouts-0000.fits
+#    data_out/shards/cutouts-0001.fits
+#    data_out/shards/index.csv
+#
+# The index maps (target, survey, filter, group) to the shard, extension
+# number, and byte range of each extension, so writes are sequential appends
+# and reads are (sorted) seeks into a few big files.
+#
+
+INDEX_FIELDS = ['position', 'radius', 'survey', 'filter', 'group', 'epoch', 'role', 'url',
+                'filename', 'shard', 'extension', 'offset', 'nbytes', 'sha1']
+
+# an empty primary hdu starts every shard
+PRIMARY_BYTES = len(fits.PrimaryHDU().header.tostring())
+
+
+def get_extension_bytes(hdu):
+    """Serializes an image (or compressed image) hdu as a FITS extension."""
+    hdul = fits.HDUList([fits.PrimaryHDU()])
+    hdul.append(hdu) # nb: converts primary hdus to image extensions
+    buffer = io.BytesIO()
+    hdul.writeto(buffer, output_verify='silentfix+warn')
+    return buffer.getbuffer()[PRIMARY_BYTES:]
+
+
+class FITSShardWriter:
+    """Appends cutout dicts (as from SurveyABC.process_tile_group) to rolling
+       multi-extension FITS shards of about max_shard_bytes each. Thread safe:
+       each cutout, with its originals, is written contiguously. Reruns start
+       a new shard and append to the index, so the latest index row wins."""
+    def __init__(self, out_dir, max_shard_bytes=4*(1 << 30), prefix="cutouts"):
+        self.out_dir = out_dir
+        self.max_shard_bytes = max_shard_bytes
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        self.shard_num = len([f for f in os.listdir(out_dir) if f.startswith(prefix) and f.endswith('.fits')])
+        self.shard = None
+        index_file = os.path.join(out_dir, 'index.csv')
+        is_new_index = not os.path.exists(index_file)
+        self.index_handle = open(index_file, 'a', newline='')
+        self.index = csv.DictWriter(self.index_handle, fieldnames=INDEX_FIELDS)
+        if is_new_index:
+            self.index.writeheader()
+
+    def __get_shard_name(self):
+        return f"{self.prefix}-{self.shard_num:04d}.fits"
+
+    def __open_shard(self):
+        self.shard = open(os.path.join(self.out_dir, self.__get_shard_name()), 'wb')
+        fits.PrimaryHDU().header.tofile(self.shard)
+        self.shard_extensions = 0
+
+    def __roll_shard(self, nbytes):
+        if self.shard is None:
+            self.__open_shard()
+        elif self.shard.tell()+nbytes > self.max_shard_bytes and self.shard_extensions > 0:
+            self.shard.close()
+            self.shard_num += 1
+            self.__open_shard()
+
+    def add(self, f_dict):
+        """Appends a cutout and its originals, returning their index rows."""
+        from .survey_abc import compress_hdul
+        if not f_dict or not f_dict['download']:
+            return list()
+        row = {key: f_dict.get(key, '') for key in ['position', 'radius', 'survey', 'filter', 'group', 'epoch', 'filename']}
+        entries = [(dict(row, role='cutout', url=''), f_dict['download'])]
+        # nb: as save_and_serialize, only a mosaic's originals are kept (a single
+        # tile's would be the whole, untrimmed, source tile next to every cutout)
+        if len(f_dict['originals']) > 1:
+            for url, og in f_dict['originals'].items():
+                if 'tile' in og:
+                    entries.append((dict(row, role='original', url=url), og['tile']))
+        if f_dict.get('compression'):
+            entries = [(r, compress_hdul([hdu], f_dict['compression'], f_dict['quantize_level'])[1]) for (r, hdu) in entries]
+        # serialize outside of the lock, write inside it
+        blobs = [(r, get_extension_bytes(hdu)) for (r, hdu) in entries]
+        rows = list()
+        with self.lock:
+            self.__roll_shard(sum([len(blob) for (r, blob) in blobs]))
+            for (r, blob) in blobs:
+                self.shard_extensions += 1
+                r.update({
+                    'shard': self.__get_shard_name(),
+                    'extension': self.shard_extensions,
+                    'offset': self.shard.tell(),
+                    'nbytes': len(blob),
+                    'sha1': hashlib.sha1(blob).hexdigest()
+                })
+                self.shard.write(blob)
+                self.index.writerow(r)
+                rows.append(r)
+            self.shard.flush()
+            self.index_handle.flush()
+        return rows
+
+    def close(self):
+        with self.lock:
+            if self.shard:
+                self.shard.close()
+                self.shard = None
+            self.index_handle.close()
+
+
+def read_index(out_dir):
+    with open(os.path.join(out_dir, 'index.csv'), newline='') as index_file:
+        return list(csv.DictReader(index_file))
+
+
+def find_extensions(index, **match):
+    """Filters index rows on any of the INDEX_FIELDS, e.g.,
+       find_extensions(index, survey='VLASS', role='cutout')."""
+    return [row for row in index if all([str(row[key]) == str(value) for key, value in match.items()])]
+
+
+def iter_extensions(out_dir, rows):
+    """Yields (row, hdu) for index rows, reading the shards in file order."""
+    handles = dict()
+    try:
+        for row in sorted(rows, key=lambda r: (r['shard'], int(r['offset']))):
+            if not row['shard'] in handles:
+                handles[row['shard']] = open(os.path.join(out_dir, row['shard']), 'rb')
+            shard = handles[row['shard']]
+            shard.seek(int(row['offset']))
+            blob = fits.PrimaryHDU().header.tostring().encode('ascii') + shard.read(int(row['nbytes']))
+            yield (row, fits.open(io.BytesIO(blob))[1])
+    finally:
+        for handle in handles.values():
+            handle.close()
@@ -1,4 +1,4 @@
-import urllib, requests, io
+import urllib, io
 from astropy import units as u
 from astropy.io.votable import parse#parse_single_table
 # from astroquery.sdss import SDSS as astroSDSS
@@ -14,6 +14,7 @@ class GLEAM(SurveyABC):
         self.needs_trimming = True
         self.projection = "SIN"
         self.base_url = "http://gleam-vo.icrar.org"
+        self.http_max_response_bytes = 64 * (1 << 20)
 
     @staticmethod
     def get_supported_filters():
@@ -37,31 +38,17 @@ class GLEAM(SurveyABC):
         }
         query_string = urllib.parse.urlencode(query_dict)
         url = f"{self.base_url}/gleam_postage/q/siap.xml?{query_string}"
-        if self.http is None:
-            matches = requests.get(url, verify=False, timeout=self.http_read_timeout)
-        else:
-            matches = self.http.request('GET',url, timeout=self.http_read_timeout)
-        return matches
+        return self.get_http().request('GET',url, timeout=self.http_read_timeout)
 
     # code referenced and adapted from https://github.com/ICRAR/gleamvo-client/blob/master/gleam_client.py
     #file_id=mosaic_Week3_162-170MHz.fits&regrid=1&projection=SIN&fits_format=1
     def get_tile_urls(self,position,size):
         #GLEAMCUTOUT?
         matches = self.get_fits_matches(position,size)
-        good=False
-        try: # different response object for cutout server and CLI
-            if matches.status_code==200: # webserver
-                good =True
-        except:
-            if matches.status==200: # CLI
-                good =True
         all_urls = []
-        if good:
+        if matches.status==200:
             try:
-                if self.http is None:
-                    response_data = bytearray(matches.content)
-                else:
-                    response_data = bytearray(matches.data)
+                response_data = bytearray(matches.data)
                 # a pretend file in memory
                 xml = io.BytesIO(response_data)
                 xml.seek(0)
@@ -74,7 +61,7 @@ class GLEAM(SurveyABC):
                         all_urls.append(url)
             except Exception as e:
                 print(str(e))
-                if "no rows found" in str(matches.content):
+                if "no rows found" in str(matches.data):
                     raise Exception(f"No GLEAM sources found at position: {position.to_string('decimal')} within radius: {(size/2).to(u.arcmin).value}")
                 return all_urls
 
@@ -0,0 +1,221 @@
+import time
+import queue
+import socket
+import threading
+from collections import deque
+
+
+#  H E D G E D   R E Q U E S T S
+#
+# Cuts the latency tail of slow survey services (e.g., NRAO's postage.pl, or
+# CADC's sync cutouts), where a few requests get stuck for far longer than
+# the rest: if a download hasn't finished within its host's usual time (a
+# percentile of the host's recent download times) a duplicate is sent, and
+# whichever finishes first wins; the other is cancelled: its connection is
+# shut down, even if it's still waiting for the response.
+# The duplicates are limited by a budget shared by all hosts, a fraction of
+# the requests made, so a host that is slow across the board isn't sent
+# twice the load.
+#
+#    set_hedger(Hedger(percentile=95, budget=0.05))   # off (None) by default
+#    result = get_hedger().run(host, fetch)           # fetch(cancelled) -> result
+#
+
+class RequestCancelled(Exception):
+    pass
+
+
+class Cancellation:
+    """A hedged copy's cancel flag: once set, the copy stops reading (between
+       chunks), and the connections it's using are shut down, waking it even
+       if it's still waiting for the response (the pool then drops them)."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.connections = list()
+
+    def is_set(self):
+        return self.cancelled.is_set()
+
+    def set(self):
+        with self.lock:
+            self.cancelled.set()
+            (connections, self.connections) = (self.connections, list())
+        for connection in connections:
+            shutdown_connection(connection)
+
+    def add_connection(self, connection):
+        with self.lock:
+            if not self.cancelled.is_set():
+                self.connections.append(connection)
+                return
+        shutdown_connection(connection)
+
+    def done(self):
+        """The copy is done with its connections (e.g., they're going back
+           to the pool for other requests), so they're no longer shut down."""
+        with self.lock:
+            self.connections = list()
+
+
+def shutdown_connection(connection):
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+# the Cancellation of the calling thread's hedged request, if it's running one
+hedged_requests = threading.local()
+
+def track_connection(connection):
+    """Called as a connection sends a request (see http_transport), so a hedged
+       copy's connection can be shut down once it has lost."""
+    cancelled = getattr(hedged_requests, 'cancelled', None)
+    if cancelled is not None:
+        cancelled.add_connection(connection)
+
+
+# stops a download (between chunks) once cancelled, e.g., the loser of a hedged request
+def get_cancellable_chunks(chunks, cancelled):
+    for chunk in chunks:
+        if cancelled.is_set():
+            raise RequestCancelled("request cancelled: a copy of it finished first")
+        yield chunk
+
+
+class LatencyTracker:
+    """Thread safe rolling windows of download times, by host."""
+    def __init__(self, window=500, min_samples=20):
+        self.lock = threading.Lock()
+        self.window = window
+        self.min_samples = min_samples
+        self.latencies = dict()
+
+    def add(self, host, latency_s):
+        with self.lock:
+            if host not in self.latencies:
+                self.latencies[host] = deque(maxlen=self.window)
+            self.latencies[host].append(latency_s)
+
+    def get_percentile(self, host, percentile):
+        """The host's percentile download time; None until it has min_samples."""
+        with self.lock:
+            latencies = sorted(self.latencies.get(host, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies)-1, int(len(latencies)*percentile/100.0))]
+
+
+class HedgeBudget:
+    """Token bucket of duplicate requests: each request earns ratio of a
+       token (up to burst of them), and each duplicate spends one."""
+    def __init__(self, ratio=0.05, burst=10):
+        self.lock = threading.Lock()
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = float(burst)
+
+    def add_request(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens+self.ratio)
+
+    def take(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class Hedger:
+    """Runs downloads, hedging those slower than their host's percentile."""
+    def __init__(self, percentile=95.0, budget=0.05, burst=10, min_delay_s=0.05, window=500, min_samples=20):
+        self.percentile = percentile
+        self.min_delay_s = min_delay_s
+        self.latencies = LatencyTracker(window, min_samples)
+        self.budget = HedgeBudget(budget, burst)
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'hedged': 0, 'hedge_wins': 0}
+
+    def __count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def get_delay(self, host):
+        """How long a download from host may take before it's hedged (None for not yet)."""
+        delay = self.latencies.get_percentile(host, self.percentile)
+        return None if delay is None else max(delay, self.min_delay_s)
+
+    # starts fetch(cancelled) on its own thread, its outcome put on results
+    def __start(self, fetch, results, hedge):
+        cancelled = Cancellation()
+        def run():
+            start = time.perf_counter()
+            hedged_requests.cancelled = cancelled
+            try:
+                results.put((hedge, True, fetch(cancelled), time.perf_counter()-start))
+            except Exception as e:
+                results.put((hedge, False, e, time.perf_counter()-start))
+            finally:
+                hedged_requests.cancelled = None
+                cancelled.done()
+        threading.Thread(target=run, name="HedgedRequest", daemon=True).start()
+        return (cancelled, time.perf_counter())
+
+    def run(self, host, fetch):
+        """Returns the first result of fetch(cancelled), or raises if every
+           copy of it failed; fetch should give up once cancelled is set."""
+        self.__count('requests')
+        self.budget.add_request()
+        delay = self.get_delay(host)
+        if delay is None:
+            start = time.perf_counter()
+            result = fetch(Cancellation())
+            self.latencies.add(host, time.perf_counter()-start)
+            return result
+        results = queue.Queue()
+        attempts = {False: self.__start(fetch, results, False)}
+        try:
+            outcome = results.get(timeout=delay)
+        except queue.Empty:
+            outcome = None
+            if self.budget.take():
+                self.__count('hedged')
+                attempts[True] = self.__start(fetch, results, True)
+        error = None
+        running = set(attempts)
+        while running:
+            (hedge, ok, value, latency_s) = outcome if outcome else results.get()
+            outcome = None
+            running.discard(hedge)
+            if ok:
+                self.latencies.add(host, latency_s)
+                for other in running:
+                    (cancelled, start) = attempts[other]
+                    cancelled.set()
+                    # nb: at least this long, so the slow ones still count towards the percentile
+                    self.latencies.add(host, time.perf_counter()-start)
+                if hedge:
+                    self.__count('hedge_wins')
+                return value
+            error = value
+        raise error
+
+    def get_counts(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+default_hedger = None
+
+def get_hedger():
+    """The process wide hedger, None (the default) for no hedging."""
+    return default_hedger
+
+def set_hedger(hedger):
+    global default_hedger
+    default_hedger = hedger
+    return hedger
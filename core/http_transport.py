@@ -0,0 +1,188 @@
+import ssl
+import threading
+
+import urllib3
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.ssl_ import create_urllib3_context
+
+from .hedging import track_connection
+
+
+#  P O O L E D   H T T P   T R A N S P O R T
+#
+# One set of keep-alive connection pools for every request the surveys make:
+# the cutout downloads (SurveyABC.send_request), the tile and catalogue
+# queries (GLEAM's SIAP, PanSTARRS' skycell lists), and, through requests
+# sessions mounted on the same pools, astroquery's CADC TAP clients. So most
+# requests reuse an open connection (no TCP or TLS handshake), connections
+# are capped per host, and all of them share one TLS context (rather than
+# loading the CA certificates for each connection).
+# Certificates are verified (verify=True) unless the transport is configured
+# not to, for every request, the webserver's (the default transport's) too.
+#
+#    transport = HTTPTransport(maxsize=15, host_maxsize={'www.cv.nrao.edu': 4})
+#    set_transport(transport)   # the process wide default, get_transport()
+#    survey.attach_http_pool_manager(transport)
+#
+
+# connections that register with the hedged request sending on them (if
+# any), so a losing copy's can be shut down (see hedging.Cancellation)
+class TrackedHTTPConnection(HTTPConnection):
+    def request(self, *args, **kwargs):
+        track_connection(self)
+        return super().request(*args, **kwargs)
+
+class TrackedHTTPSConnection(HTTPSConnection):
+    def request(self, *args, **kwargs):
+        track_connection(self)
+        return super().request(*args, **kwargs)
+
+class TrackedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TrackedHTTPConnection
+
+class TrackedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TrackedHTTPSConnection
+
+
+class HostLimitedPoolManager(urllib3.PoolManager):
+    """A PoolManager with per host connection pool sizes (host_maxsize),
+       on top of the usual maxsize for the rest."""
+    def __init__(self, host_maxsize=None, **kwargs):
+        self.host_maxsize = dict(host_maxsize or {})
+        super().__init__(**kwargs)
+        # nb: after PoolManager's __init__, which sets urllib3's own
+        self.pool_classes_by_scheme = {'http': TrackedHTTPConnectionPool, 'https': TrackedHTTPSConnectionPool}
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        if host in self.host_maxsize:
+            request_context = dict(request_context if request_context is not None else self.connection_pool_kw)
+            request_context['maxsize'] = self.host_maxsize[host]
+        return super()._new_pool(scheme, host, port, request_context)
+
+
+def get_ssl_context(verify=True):
+    context = create_urllib3_context(cert_reqs=ssl.CERT_REQUIRED if verify else ssl.CERT_NONE)
+    if verify:
+        context.load_default_certs()
+        try:
+            import certifi # nb: as requests would, if it's there
+            context.load_verify_locations(certifi.where())
+        except ImportError:
+            pass
+    else:
+        context.check_hostname = False
+    return context
+
+
+class HTTPTransport:
+    """Thread safe pooled http(s) transport; request() is urllib3's, so it
+       can be attached to surveys in place of a PoolManager."""
+    def __init__(self, num_pools=60, maxsize=15, host_maxsize=None, timeout=120.0, retries=3, block=True, verify=True):
+        self.lock = threading.Lock()
+        self.thread_sessions = threading.local()
+        self.sessions = list()
+        self.pool_kw = {'num_pools': num_pools, 'timeout': timeout, 'retries': retries, 'block': block}
+        self.manager = self.__get_manager(maxsize, host_maxsize, verify)
+
+    def __get_manager(self, maxsize, host_maxsize, verify):
+        (self.maxsize, self.verify) = (maxsize, verify)
+        # nb: urllib3 sets the shared context's verify mode from cert_reqs on each connection
+        return HostLimitedPoolManager(host_maxsize, maxsize=maxsize, ssl_context=get_ssl_context(verify),
+                                      cert_reqs='CERT_REQUIRED' if verify else 'CERT_NONE', **self.pool_kw)
+
+    def configure(self, maxsize=None, host_maxsize=None, verify=None):
+        """Resizes the pools, or turns certificate verification on or off (closing
+           the pools open), e.g., from a run's configuration."""
+        with self.lock:
+            old_manager = self.manager
+            self.manager = self.__get_manager(maxsize if maxsize else self.maxsize,
+                                              host_maxsize if host_maxsize is not None else old_manager.host_maxsize,
+                                              verify if verify is not None else self.verify)
+            for session in self.sessions:
+                session.verify = self.verify
+        old_manager.clear()
+        return self
+
+    def request(self, method, url, **kwargs):
+        return self.manager.request(method, url, **kwargs)
+
+    def get_session(self):
+        """The calling thread's requests session on these pools (e.g., for an
+           astroquery client); a session (its cookies, headers, etc.) isn't
+           thread safe, so only the pools are shared."""
+        session = getattr(self.thread_sessions, 'session', None)
+        if session is None:
+            import requests # nb: only if something needs it
+            session = requests.Session()
+            adapter = get_transport_adapter(self)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            with self.lock:
+                session.verify = self.verify
+                self.sessions.append(session)
+            self.thread_sessions.session = session
+        return session
+
+    def clear(self):
+        self.manager.clear()
+
+
+# a requests adapter handing out connections from a transport's pools: the
+# very pools (keyed as the transport keys them, with its ssl context) that the
+# urllib3 requests use, rather than ones keyed by requests' own pool kwargs
+# (ca_certs, cert_reqs), so per host limits hold across both
+def get_transport_adapter(transport):
+    from requests.adapters import HTTPAdapter
+    from requests.utils import select_proxy
+
+    class TransportAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            pass
+
+        @property
+        def poolmanager(self):
+            return transport.manager
+
+        @poolmanager.setter
+        def poolmanager(self, manager):
+            pass # nb: always the transport's (current) pools
+
+        def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+            if cert or select_proxy(request.url, proxies):
+                return super().get_connection_with_tls_context(request, verify, proxies, cert)
+            return transport.manager.connection_from_url(request.url)
+
+        # nb: requests < 2.32
+        def get_connection(self, url, proxies=None):
+            if select_proxy(url, proxies):
+                return super().get_connection(url, proxies)
+            return transport.manager.connection_from_url(url)
+
+        # nb: the transport's ssl context does the verifying (no per connection CA loading)
+        def cert_verify(self, conn, url, verify, cert):
+            if cert:
+                super().cert_verify(conn, url, verify, cert)
+
+        def close(self):
+            pass # the pools are the transport's to close
+
+    return TransportAdapter()
+
+
+default_transport = None
+default_transport_lock = threading.Lock()
+
+def get_transport():
+    """The process wide transport (one with the defaults, unless set)."""
+    global default_transport
+    with default_transport_lock:
+        if default_transport is None:
+            default_transport = HTTPTransport()
+        return default_transport
+
+def set_transport(transport):
+    global default_transport
+    with default_transport_lock:
+        default_transport = transport
+    return transport
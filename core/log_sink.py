@@ -0,0 +1,138 @@
+import sys
+import json
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+
+
+#  A S Y N C H R O N O U S   L O G   S I N K
+#
+# Threads hand log records (a message plus structured fields: pid, survey,
+# filter, stage, status, duration_s, ...) to a queue and get straight back to
+# work; a background thread drains the queue in batches and writes them,
+#
+#    to a JSON-lines file (every record),
+#    to the plain text OutLOG.txt (info and up, in its usual format), and
+#    to the console (at or above the console level),
+#
+# holding the files open for the run rather than opening them per message.
+#
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40, 'quiet': 100}
+
+
+def get_level(level):
+    if isinstance(level, str) and level.lower() in LEVELS:
+        return LEVELS[level.lower()]
+    raise Exception(f"log level {level} is invalid!\n Valid levels are: {', '.join(LEVELS)}")
+
+
+# e.g., "VLASS(pid=12,filter='g'): message", as SurveyABC.sprint prefixes them
+def get_prefix(record):
+    if not record.get('survey'):
+        return ""
+    pid = "" if record.get('pid') is None else f"pid={record['pid']}"
+    filter = f"filter='{record['filter']}'" if record.get('filter') else ""
+    return f"{record['survey']}({pid}{',' if pid and filter else ''}{filter}): "
+
+
+def format_record(record):
+    prefix = get_prefix(record)
+    return "\n".join([f"{prefix}{line}" for line in str(record['msg']).splitlines() if line])
+
+
+class LogSink:
+    """Queued, batched log writer; see above. console_level is one of
+       debug, info, warning, error or quiet."""
+    def __init__(self, json_file="OutLOG.jsonl", text_file="OutLOG.txt", console_level='debug',
+                 batch_size=512, flush_interval_s=1.0):
+        self.console_level = get_level(console_level)
+        self.text_level = LEVELS['info']
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.json_file = open(json_file, 'a') if json_file else None
+        self.text_file = open(text_file, 'a') if text_file else None
+        self.records = queue.SimpleQueue()
+        self.closed = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.__run, name="LogSink", daemon=True)
+        self.thread.start()
+        # nb: so a ctrl-c's sys.exit still gets the last batch out
+        atexit.register(self.close)
+
+    def log(self, level, msg, **fields):
+        record = {'time': time.time(), 'level': level, 'msg': msg}
+        record.update(fields)
+        self.records.put(record)
+
+    def debug(self, msg, **fields):
+        self.log('debug', msg, **fields)
+
+    def info(self, msg, **fields):
+        self.log('info', msg, **fields)
+
+    def warning(self, msg, **fields):
+        self.log('warning', msg, **fields)
+
+    def error(self, msg, **fields):
+        self.log('error', msg, **fields)
+
+    def __get_batch(self):
+        try:
+            batch = [self.records.get(timeout=self.flush_interval_s)]
+        except queue.Empty:
+            return list()
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.records.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def __write(self, batch):
+        json_lines, text_lines, console_lines = list(), list(), list()
+        for record in batch:
+            level = LEVELS.get(record['level'], LEVELS['info'])
+            if self.json_file:
+                json_lines.append(json.dumps(record, default=str))
+            if level >= self.text_level or level >= self.console_level:
+                text = format_record(record)
+                if self.text_file and level >= self.text_level:
+                    text_lines.append(f"\n\n{datetime.fromtimestamp(record['time'])}: {text}")
+                if level >= self.console_level:
+                    console_lines.append(text)
+        if json_lines:
+            self.json_file.write("\n".join(json_lines)+"\n")
+            self.json_file.flush()
+        if text_lines:
+            self.text_file.write("".join(text_lines))
+            self.text_file.flush()
+        if console_lines:
+            print("\n".join(console_lines))
+
+    def __run(self):
+        stop = False
+        while not stop:
+            batch = self.__get_batch()
+            # None is the close() sentinel: write what came before it, then stop
+            if None in batch:
+                stop = True
+                batch = [record for record in batch if record is not None]
+            try:
+                self.__write(batch)
+            except Exception as e:
+                print(f"Unable to write {len(batch)} log record(s): {e}", file=sys.stderr)
+
+    def close(self):
+        """Writes out everything logged so far and closes the files."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.records.put(None)
+        self.thread.join()
+        for f in [self.json_file, self.text_file]:
+            if f:
+                f.close()
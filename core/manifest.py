@@ -0,0 +1,145 @@
+import os
+import math
+import time
+import hashlib
+import sqlite3
+import threading
+
+
+#  C U T O U T   M A N I F E S T
+#
+# A local SQLite record of every cutout a run has saved, e.g.,
+#
+#    data_out/manifest.sqlite
+#
+# so "do we already have survey X at position Y?" is an indexed lookup rather
+# than a directory crawl. Cone queries use a bounding box on the (dec, ra)
+# index, then an exact angular separation cut.
+#
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cutouts (
+    id        INTEGER PRIMARY KEY,
+    ra        REAL NOT NULL,
+    dec       REAL NOT NULL,
+    radius    REAL NOT NULL,
+    survey    TEXT NOT NULL,
+    filter    TEXT NOT NULL DEFAULT '',
+    tile_group TEXT,
+    group_by  TEXT NOT NULL DEFAULT 'NONE',
+    epoch     TEXT,
+    path      TEXT NOT NULL,
+    extension INTEGER NOT NULL DEFAULT 0,
+    bytes     INTEGER,
+    sha1      TEXT,
+    created   REAL,
+    UNIQUE (path, extension)
+);
+CREATE INDEX IF NOT EXISTS cutouts_position ON cutouts (dec, ra);
+CREATE INDEX IF NOT EXISTS cutouts_survey ON cutouts (survey, filter);
+"""
+
+# positions within this many arcsec count as the same target
+MATCH_TOLERANCE_ARCSEC = 1.0
+
+
+def get_sha1(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_separation(ra1, dec1, ra2, dec2):
+    """Angular separation in degrees (haversine, so fine at small scales)."""
+    ra1, dec1, ra2, dec2 = map(math.radians, (ra1, dec1, ra2, dec2))
+    a = math.sin((dec2-dec1)/2)**2 + math.cos(dec1)*math.cos(dec2)*math.sin((ra2-ra1)/2)**2
+    return math.degrees(2*math.asin(min(1.0, math.sqrt(a))))
+
+
+def get_ra_ranges(ra, dec, radius):
+    """RA intervals (degrees) of the box around a cone of radius degrees,
+       split in two where the box wraps through RA=0."""
+    if abs(dec)+radius >= 90.0:
+        return [(0.0, 360.0)]
+    half_width = math.degrees(math.asin(min(1.0, math.sin(math.radians(radius))/math.cos(math.radians(dec)))))
+    ra_min, ra_max = ra-half_width, ra+half_width
+    if ra_min < 0:
+        return [(ra_min+360.0, 360.0), (0.0, ra_max)]
+    if ra_max >= 360.0:
+        return [(ra_min, 360.0), (0.0, ra_max-360.0)]
+    return [(ra_min, ra_max)]
+
+
+def get_group_by_name(group_by):
+    return str(group_by).upper() if group_by else "NONE"
+
+
+class CutoutManifest:
+    """Thread safe registry of saved cutouts, backed by a single SQLite
+       connection (in WAL mode, so other processes can read while we write)."""
+    def __init__(self, db_file):
+        db_dir = os.path.dirname(os.path.abspath(db_file))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False, timeout=30.0)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SCHEMA)
+
+    def register(self, f_dict, path=None, extension=0, nbytes=None, sha1=None):
+        """Records a saved cutout dict (as from SurveyABC.save_and_serialize).
+           The path defaults to the dict's download_path; container output
+           passes the shard path and extension number instead. Pass the size
+           and sha1 taken as the file was written, if known."""
+        path = os.path.abspath(path if path else f_dict['download_path'])
+        ra, dec = [float(x) for x in str(f_dict['position']).split(',')]
+        if not extension:
+            # nb: read back from disk only if not given
+            if nbytes is None:
+                nbytes = os.path.getsize(path)
+            if sha1 is None:
+                sha1 = get_sha1(path)
+        row = (ra, dec, float(f_dict['radius']), f_dict['survey'], f_dict.get('filter') or '',
+               f_dict.get('group'), get_group_by_name(f_dict.get('group_by')),
+               str(f_dict['epoch']) if f_dict.get('epoch') else None,
+               path, int(extension), nbytes, sha1, time.time())
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO cutouts "
+                            "(ra, dec, radius, survey, filter, tile_group, group_by, epoch, path, extension, bytes, sha1, created) "
+                            "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", row)
+
+    def find(self, ra, dec, radius=MATCH_TOLERANCE_ARCSEC/3600.0, **match):
+        """Returns the cutouts (as dicts) centred within radius degrees of
+           (ra, dec), optionally matching columns, e.g., survey='VLASS'."""
+        radius = float(radius)
+        ranges = get_ra_ranges(ra, dec, radius)
+        where = ["dec BETWEEN ? AND ?", "(" + " OR ".join(["ra BETWEEN ? AND ?"]*len(ranges)) + ")"]
+        params = [dec-radius, dec+radius] + [ra for ra_range in ranges for ra in ra_range]
+        for column, value in match.items():
+            where.append(f"{column} = ?")
+            params.append(value)
+        with self.lock:
+            rows = self.db.execute(f"SELECT * FROM cutouts WHERE {' AND '.join(where)}", params).fetchall()
+        return [dict(row) for row in rows if get_separation(ra, dec, row['ra'], row['dec']) <= radius]
+
+    def has(self, ra, dec, radius, survey, filter='', group_by=None):
+        """True if a cutout of radius arcmin about (ra, dec) for this survey,
+           filter and grouping was saved and is still on disk."""
+        matches = self.find(ra, dec, survey=survey, filter=filter or '', group_by=get_group_by_name(group_by))
+        return any([abs(m['radius']-float(radius)) < 1e-6 and os.path.exists(m['path']) for m in matches])
+
+    def has_task(self, task):
+        """True if a processing stack task (see CLIConfig) is already done."""
+        position = task['position']
+        return self.has(position.ra.degree, position.dec.degree, task['size'].value/2.0,
+                        type(task['survey']).__name__, task['survey'].get_filter_name(), task.get('group_by'))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
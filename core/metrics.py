@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import threading
+import urllib.parse
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .retry import get_circuit_breakers
+from .hedging import get_hedger
+
+
+#  L I V E   M E T R I C S
+#
+# Counters and gauges for long batch runs: in-flight requests, attempts,
+# failures, bytes and circuit breaker state per host; task outcomes by
+# processing status; saved cutouts and their rolling throughput; and the
+# depths of the pipeline queues. They can be scraped from a Prometheus text endpoint,
+#
+#    http://127.0.0.1:<port>/metrics
+#
+# and/or rewritten every few seconds to a stats file: JSON, or Prometheus
+# text if the file name ends in .prom (e.g., for node_exporter's textfile
+# collector).
+#
+
+# tasks that ended in any other status (e.g., still 'fetching' when an exception was raised)
+TASK_STATUSES = ['done', 'none', 'corrupted', 'bailed', 'unavailable', 'error']
+
+
+def get_host(url):
+    return urllib.parse.urlsplit(url).netloc or "unknown"
+
+
+def get_status_name(status):
+    name = getattr(status, 'name', str(status))
+    return name if name in TASK_STATUSES else 'error'
+
+
+class NoRequest:
+    """Stands in for a tracked request when there are no metrics."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def done(self, nbytes):
+        pass
+
+NO_REQUEST = NoRequest()
+
+
+class TrackedRequest:
+    """One http attempt: in flight until exit; failed unless done() is called."""
+    def __init__(self, metrics, host):
+        self.metrics = metrics
+        self.host = host
+        self.nbytes = None
+
+    def __enter__(self):
+        self.metrics.start_request(self.host)
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.end_request(self.host, self.nbytes)
+        return False
+
+    def done(self, nbytes):
+        self.nbytes = nbytes
+
+
+class CutoutMetrics:
+    """Thread safe metrics of a cutout fetching run."""
+    def __init__(self, window_s=60.0):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.window_s = window_s
+        self.in_flight = dict()
+        self.requests = dict()
+        self.failures = dict()
+        self.bytes = dict()
+        self.tasks = {status: 0 for status in TASK_STATUSES}
+        self.tasks_queued = 0
+        self.saved = 0
+        self.saved_times = deque() # (time, cutouts) within the rolling window
+        self.queues = dict()
+
+    # http requests (per attempt, so retries count)
+    def request(self, url):
+        return TrackedRequest(self, get_host(url))
+
+    def start_request(self, host):
+        with self.lock:
+            self.in_flight[host] = self.in_flight.get(host, 0) + 1
+
+    def end_request(self, host, nbytes=None):
+        with self.lock:
+            self.in_flight[host] -= 1
+            self.requests[host] = self.requests.get(host, 0) + 1
+            if nbytes is None:
+                self.failures[host] = self.failures.get(host, 0) + 1
+            else:
+                self.bytes[host] = self.bytes.get(host, 0) + nbytes
+
+    # tasks and output
+    def set_tasks_queued(self, count):
+        with self.lock:
+            self.tasks_queued = count
+
+    def add_task(self, status):
+        with self.lock:
+            self.tasks[get_status_name(status)] += 1
+
+    def add_saved(self, cutouts=1):
+        now = time.time()
+        with self.lock:
+            self.saved += cutouts
+            self.saved_times.append((now, cutouts))
+            self.__expire(now)
+
+    def __expire(self, now):
+        while self.saved_times and self.saved_times[0][0] < now-self.window_s:
+            self.saved_times.popleft()
+
+    def get_throughput(self):
+        """Saved cutouts per second over the rolling window."""
+        now = time.time()
+        with self.lock:
+            self.__expire(now)
+            window = min(self.window_s, max(now-self.start_time, 1e-3))
+            return sum([n for (t, n) in self.saved_times])/window
+
+    # queues are sampled when the metrics are read
+    def add_queue(self, name, q):
+        with self.lock:
+            self.queues[name] = q
+        return q
+
+    def get_snapshot(self):
+        throughput = self.get_throughput()
+        with self.lock:
+            snapshot = {
+                'time': time.time(),
+                'uptime_s': time.time()-self.start_time,
+                'tasks_queued': self.tasks_queued,
+                'tasks': dict(self.tasks),
+                'saved': self.saved,
+                'saved_per_s': throughput,
+                'window_s': self.window_s,
+                'hosts': {host: {'in_flight': self.in_flight.get(host, 0),
+                                 'requests': self.requests.get(host, 0),
+                                 'failures': self.failures.get(host, 0),
+                                 'bytes': self.bytes.get(host, 0)}
+                          for host in sorted(set(self.in_flight) | set(self.requests))},
+                'queues': {name: {'items': q.qsize(), 'bytes': getattr(q, 'nbytes', None)}
+                           for name, q in self.queues.items()},
+                'circuits': get_circuit_breakers().get_states(),
+                'hedging': get_hedger().get_counts() if get_hedger() else None,
+            }
+        return snapshot
+
+    def format_prometheus(self):
+        s = self.get_snapshot()
+        lines = list()
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (labels, value) in samples:
+                label_str = ",".join([f'{k}="{v}"' for k, v in labels.items()])
+                lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+        hosts = s['hosts']
+        metric("cutout_uptime_seconds", "gauge", "Seconds since the run started.", [({}, round(s['uptime_s'], 3))])
+        metric("cutout_tasks_queued", "gauge", "Cutout tasks queued for the run.", [({}, s['tasks_queued'])])
+        metric("cutout_tasks_total", "counter", "Finished cutout tasks by processing status.",
+               [({'status': k}, v) for k, v in s['tasks'].items()])
+        metric("cutout_saved_total", "counter", "Cutouts saved.", [({}, s['saved'])])
+        metric("cutout_saved_per_second", "gauge", f"Cutouts saved per second over the last {s['window_s']:g}s.",
+               [({}, round(s['saved_per_s'], 4))])
+        metric("cutout_http_in_flight", "gauge", "HTTP requests in flight by host.",
+               [({'host': h}, v['in_flight']) for h, v in hosts.items()])
+        metric("cutout_http_requests_total", "counter", "HTTP request attempts by host.",
+               [({'host': h}, v['requests']) for h, v in hosts.items()])
+        metric("cutout_http_failures_total", "counter", "Failed HTTP request attempts by host.",
+               [({'host': h}, v['failures']) for h, v in hosts.items()])
+        metric("cutout_http_bytes_total", "counter", "Bytes downloaded by host.",
+               [({'host': h}, v['bytes']) for h, v in hosts.items()])
+        metric("cutout_http_circuit_open", "gauge", "1 while a host's circuit breaker is open (or half open).",
+               [({'host': h}, int(c['state'] != 'closed')) for h, c in s['circuits'].items()])
+        metric("cutout_http_circuit_trips_total", "counter", "Times a host's circuit breaker opened.",
+               [({'host': h}, c['trips']) for h, c in s['circuits'].items()])
+        if s['hedging']:
+            metric("cutout_http_hedged_total", "counter", "Slow downloads a duplicate request was sent for.",
+                   [({}, s['hedging']['hedged'])])
+            metric("cutout_http_hedge_wins_total", "counter", "Hedged downloads the duplicate finished first.",
+                   [({}, s['hedging']['hedge_wins'])])
+        metric("cutout_queue_items", "gauge", "Items waiting in each pipeline queue.",
+               [({'queue': name}, q['items']) for name, q in s['queues'].items()])
+        metric("cutout_queue_bytes", "gauge", "Bytes of image data waiting in each pipeline queue.",
+               [({'queue': name}, q['bytes']) for name, q in s['queues'].items() if q['bytes'] is not None])
+        return "\n".join(lines)+"\n"
+
+
+class MetricsServer:
+    """Serves the metrics as Prometheus text at /metrics, on a background thread."""
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.format_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def get_url(self):
+        (host, port) = self.server.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StatsFileWriter:
+    """Rewrites a stats file every interval_s seconds (and once more on
+       close), atomically, so readers never see half a file."""
+    def __init__(self, metrics, path, interval_s=10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval_s = interval_s
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def write(self):
+        if self.path.endswith('.prom'):
+            text = self.metrics.format_prometheus()
+        else:
+            text = json.dumps(self.metrics.get_snapshot(), indent=2)
+        part = self.path + ".part"
+        with open(part, 'w') as f:
+            f.write(text)
+        os.replace(part, self.path)
+
+    def __run(self):
+        while not self.stopped.wait(self.interval_s):
+            try:
+                self.write()
+            except Exception as e:
+                print(f"Unable to write stats file {self.path}: {e}")
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
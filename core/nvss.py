@@ -4,10 +4,15 @@ import numpy as np
 
 from .toolbox import pad_string_lines
 from .survey_abc import SurveyABC
+from .retry import RetryPolicy
 class NVSS(SurveyABC):
     def __init__(self):
         super().__init__()
         self.needs_trimming = False
+        # postage stamps are capped at 512x512 pixels
+        self.http_max_response_bytes = 16 * (1 << 20)
+        # a single cgi server: give it longer to recover between retries
+        self.retry_policy = RetryPolicy(attempts=3, base_s=5.0, max_s=60.0)
 
     @staticmethod
     def get_supported_filters():
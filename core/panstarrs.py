@@ -138,7 +138,8 @@ class PANSTARRS(SurveyABC):
 
         # the skycell at input (ra,dec)
         url = make_url(ra,dec)
-        skycells = Table.read(url, format='ascii', fast_reader=True)
+        # nb: fetched over the pooled transport, then parsed from the text (with a newline, read as the table)
+        skycells = Table.read(self.get_url_data(url).decode('utf-8'), format='ascii', fast_reader=True)
 
         # TODO (Issue #8): kludge: this is a really bad way of finding the neigbhoring skeyscells...
         # Notes: https://outerspace.stsci.edu/display/PANSTARRS/PS1+Sky+tessellation+patterns
@@ -156,7 +157,7 @@ class PANSTARRS(SurveyABC):
         for url in urls:
             try:
                 self.print("GETTING SKYCELL AT: ", url)
-                sc = Table.read(url, format='ascii')
+                sc = Table.read(self.get_url_data(url).decode('utf-8'), format='ascii')
                 is_in_skycells = False
                 for skycell in skycells:
                     if sc['projcell'] == skycell['projcell'] and sc['subcell'] == skycell['subcell']:
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import threading
+
+import numpy as np
+
+
+#  S T A G E   T I M I N G
+#
+# Records how long each stage of each cutout task takes (get_tile_urls,
+# send_request, create_fits, paste_tiles, trim_tile, format_fits_hdu,
+# save_and_serialize, ...), tagged with the task pid, survey and filter, e.g.,
+#
+#    recorder = StageRecorder()
+#    survey.set_stage_recorder(recorder)
+#    ...
+#    print(recorder.format_summary())
+#    recorder.write_trace("trace.json")
+#
+# The trace is Chrome's trace event format, so it opens in chrome://tracing
+# or https://ui.perfetto.dev with a row per grabber/saver thread.
+#
+
+class NoStage:
+    """Does nothing: stands in for a stage when nothing is recording."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_STAGE = NoStage()
+
+
+class Stage:
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.recorder.add(self.name, self.start, end, self.args)
+        return False
+
+
+class StageRecorder:
+    """Thread safe collector of (stage, start, end, args) events."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = list()
+        self.thread_names = dict()
+        self.t0 = time.perf_counter()
+        self.wall0 = time.time()
+
+    def stage(self, name, **args):
+        """Context manager timing one stage; args (e.g., pid, survey, filter)
+           go into the trace event."""
+        return Stage(self, name, args)
+
+    def add(self, name, start, end, args=None):
+        thread = threading.current_thread()
+        with self.lock:
+            self.thread_names.setdefault(thread.ident, thread.name)
+            self.events.append((name, start, end, thread.ident, args or {}))
+
+    def get_summary(self):
+        """Per stage timings (seconds), busiest stage first."""
+        with self.lock:
+            durations = dict()
+            for (name, start, end, tid, args) in self.events:
+                durations.setdefault(name, list()).append(end-start)
+        summary = list()
+        for name, d in durations.items():
+            d = np.array(d)
+            summary.append({
+                'stage': name,
+                'count': len(d),
+                'total': float(d.sum()),
+                'mean':  float(d.mean()),
+                'p50':   float(np.percentile(d, 50)),
+                'p95':   float(np.percentile(d, 95)),
+                'max':   float(d.max()),
+            })
+        return sorted(summary, key=lambda s: -s['total'])
+
+    def format_summary(self):
+        lines = [f"{'stage':<20} {'count':>7} {'total s':>10} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10} {'max ms':>10}"]
+        for s in self.get_summary():
+            lines.append(f"{s['stage']:<20} {s['count']:>7} {s['total']:>10.2f} {s['mean']*1e3:>10.1f} "
+                         f"{s['p50']*1e3:>10.1f} {s['p95']*1e3:>10.1f} {s['max']*1e3:>10.1f}")
+        return "\n".join(lines)
+
+    def get_trace(self):
+        """The events as a Chrome trace (complete 'X' events, in us)."""
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+            thread_names = dict(self.thread_names)
+        # small thread numbers read better than idents
+        tids = {ident: n for n, ident in enumerate(sorted(thread_names), 1)}
+        trace = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tids[ident], 'args': {'name': name}}
+                 for ident, name in thread_names.items()]
+        for (name, start, end, ident, args) in events:
+            trace.append({
+                'name': name,
+                'cat':  args.get('survey', 'cutout'),
+                'ph':   'X',
+                'ts':   round((start-self.t0)*1e6, 1),
+                'dur':  round((end-start)*1e6, 1),
+                'pid':  pid,
+                'tid':  tids[ident],
+                'args': args,
+            })
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms', 'otherData': {'start_time': self.wall0}}
+
+    def write_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.get_trace(), f, default=str)
+        return path
@@ -0,0 +1,220 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+from astropy.visualization import make_lupton_rgb, ZScaleInterval
+
+from .FITS2DImageTools import get_display_params, get_image_rms, stretch_to_uint8, encode_png, encode_jpeg
+from .toolbox import get_mosaic_filename
+
+
+#  I M A G E   R E N D E R I N G
+#
+# Turns cutouts into PNG/JPEG images as a pipeline stage: the grabbers hand
+# over the in-memory cutouts (see fetch_cutouts.get_cutout), which are
+# stretched and encoded on a process pool, so there is no second pass over
+# the FITS files on disk. When three or more filters of a survey have been
+# requested, a Lupton RGB composite is also made for each target once all of
+# its bands have come in.
+#
+
+
+#  Survey stretches (with the fixed limits used by images/process_fits.py)
+
+def arcsinh_stretch(data, vmin, vmax):
+    fit = np.interp(data, (vmin, vmax), (0, 1))
+    fit = np.arcsinh(10*fit)/3
+    return fit
+
+def lupton_stretch(data, vmin, vmax, stretch=0.5, Q=9):
+    # data is a (blue, green, red) band cube
+    fit = np.interp(data, (vmin, vmax), (0, 10))
+    fit = make_lupton_rgb(fit[2], fit[1], fit[0], stretch=stretch, Q=Q)
+    return fit
+
+def vlass_stretch(data):
+    return arcsinh_stretch(data, -0.000235248, 0.00798479)
+
+def nvss_stretch(data):
+    return arcsinh_stretch(data, -0.00070356, 0.162288)
+
+def first_stretch(data):
+    return arcsinh_stretch(data, -0.00551651, 0.0634952)
+
+def sdss_stretch(data):
+    return lupton_stretch(data, -0.05538, 20.67399)
+
+def panstarrs_stretch(data):
+    return lupton_stretch(data, -250.226, 80822.4, stretch=0.7, Q=11)
+
+
+# (vmin, vmax, stretch, Q) of RGB composites; others scale each band by its zscale limits
+RGB_STRETCHES = {
+    'SDSS':      (-0.05538, 20.67399, 0.5, 9),
+    'PANSTARRS': (-250.226, 80822.4,  0.7, 11),
+}
+
+
+def encode_image(pixels, image_format='png'):
+    if image_format.lower() in ['jpg', 'jpeg']:
+        return encode_jpeg(pixels)
+    return encode_png(pixels)
+
+def write_image(image_bytes, path):
+    # write then rename, so a half written image is never picked up
+    part = path + ".part"
+    with open(part, 'wb') as f:
+        f.write(image_bytes)
+    os.replace(part, path)
+    return path
+
+
+def crop_to_common_shape(images):
+    """Crops 2D images about their centres to the shape they all share."""
+    ny = min([image.shape[0] for image in images])
+    nx = min([image.shape[1] for image in images])
+    cropped = list()
+    for image in images:
+        y0 = (image.shape[0]-ny)//2
+        x0 = (image.shape[1]-nx)//2
+        cropped.append(image[y0:y0+ny, x0:x0+nx])
+    return cropped
+
+
+def render_band(image_data, survey, path, image_format='png', image_rms=None):
+    """Stretches one (2D) cutout as the thumbnails do and writes it to path."""
+    image_data, interval, stretch, cbar_label = get_display_params(image_data, survey, image_rms)
+    return write_image(encode_image(stretch_to_uint8(image_data, interval, stretch), image_format), path)
+
+
+def render_rgb(bands, survey, path, image_format='png'):
+    """Writes a Lupton RGB composite of (blue, green, red) 2D band images."""
+    bands = [np.nan_to_num(np.asarray(band, dtype=np.float32)) for band in crop_to_common_shape(bands)]
+    if survey.upper() in RGB_STRETCHES:
+        (vmin, vmax, stretch, Q) = RGB_STRETCHES[survey.upper()]
+        rgb = lupton_stretch(np.array(bands), vmin, vmax, stretch, Q)
+    else:
+        scaled = list()
+        for band in bands:
+            (vmin, vmax) = ZScaleInterval().get_limits(band)
+            scaled.append(np.interp(band, (vmin, vmax), (0, 10)))
+        rgb = make_lupton_rgb(scaled[2], scaled[1], scaled[0], stretch=0.5, Q=9)
+    return write_image(encode_image(np.ascontiguousarray(rgb[::-1]), image_format), path)
+
+
+def get_rgb_bands(filters):
+    """Picks (blue, green, red) from a survey's filter enums: the bluest,
+       middle and reddest (i.e., by enum number) of them."""
+    filters = sorted(filters, key=lambda f: f.value)
+    return [filters[0].name.lower(), filters[len(filters)//2].name.lower(), filters[-1].name.lower()]
+
+
+class RenderStage:
+    """Renders cutout dicts (as from SurveyABC.get_cutout) on a process pool.
+       rgb_filters maps a survey name to the filter enums requested for it;
+       surveys with three or more get RGB composites too. Bands are matched
+       up by survey, position, radius and group: if a group has several
+       (unmosaicked) cutouts, the first of each band is used. The bands held
+       for unfinished composites are limited to max_pending_bytes (0 for no
+       limit), the oldest composites being dropped to make room, as are those
+       missing a band (see drop)."""
+    def __init__(self, workers=None, image_format='png', rgb_filters=None, max_pending_bytes=0):
+        self.image_format = image_format.lower()
+        self.extension = 'jpg' if self.image_format in ['jpg', 'jpeg'] else 'png'
+        # nb: spawn, as forking a process full of threads isn't safe
+        self.pool = ProcessPoolExecutor(workers or os.cpu_count() or 1, mp_context=multiprocessing.get_context('spawn'))
+        self.rgb_bands = {survey: get_rgb_bands(filters) for survey, filters in (rgb_filters or {}).items() if len(filters) >= 3}
+        self.max_pending_bytes = max_pending_bytes
+        self.pending_rgb = dict() # nb: oldest first
+        self.pending_bytes = 0
+        # composites given up on: (survey, position, radius, group) keys, or
+        # (survey, position, radius) ones for all of a target's groups
+        self.dropped_rgb = set()
+        self.futures = list()
+        self.lock = threading.Lock()
+
+    def __submit(self, func, *args):
+        future = self.pool.submit(func, *args)
+        with self.lock:
+            self.futures.append(future)
+        return future
+
+    # forgets a composite's bands, and any that come in for it later (nb: with the lock held)
+    def __drop_rgb(self, key):
+        self.dropped_rgb.add(key)
+        for pending_key in [k for k in self.pending_rgb if k == key or k[:3] == key]:
+            bands = self.pending_rgb.pop(pending_key)
+            self.pending_bytes -= sum([band.nbytes for band in bands.values()])
+
+    def drop(self, task):
+        """Gives up on the composites needing a task's band, e.g., as it
+           failed or found no images, so their other bands aren't kept."""
+        survey = type(task['survey']).__name__
+        if not survey in self.rgb_bands or not task['survey'].get_filter_name() in self.rgb_bands[survey]:
+            return
+        position = task['position']
+        with self.lock:
+            self.__drop_rgb((survey, f"{position.ra.degree}, {position.dec.degree}", (task['size']/2).value))
+
+    def __add_band(self, f_dict, image_data):
+        survey = f_dict['survey']
+        if not survey in self.rgb_bands or not f_dict['filter'] in self.rgb_bands[survey]:
+            return
+        key = (survey, f_dict['position'], f_dict['radius'], f_dict['group'])
+        with self.lock:
+            if key in self.dropped_rgb or key[:3] in self.dropped_rgb:
+                return
+            bands = self.pending_rgb.setdefault(key, dict())
+            if not f_dict['filter'] in bands:
+                bands[f_dict['filter']] = image_data
+                self.pending_bytes += image_data.nbytes
+            if len(bands) < len(self.rgb_bands[survey]):
+                # make room by dropping the oldest composites (nb: this one's kept, if it's all there is)
+                while 0 < self.max_pending_bytes < self.pending_bytes and len(self.pending_rgb) > 1:
+                    self.__drop_rgb(next(iter(self.pending_rgb)))
+                return
+            del self.pending_rgb[key]
+            self.pending_bytes -= sum([band.nbytes for band in bands.values()])
+        ra, dec = [float(x) for x in f_dict['position'].split(',')]
+        filename = get_mosaic_filename(SkyCoord(ra, dec, unit='deg'), f_dict['radius']*u.arcmin, survey,
+                                       filter="".join(self.rgb_bands[survey]),
+                                       group_title='' if f_dict['group'] == "None" else f_dict['group'])
+        path = os.path.join(f_dict['out_dir'], filename.replace("_mosaicked.fits", f"_rgb.{self.extension}"))
+        self.__submit(render_rgb, [bands[band] for band in self.rgb_bands[survey]], survey, path, self.image_format)
+
+    def submit(self, all_fits, task=None):
+        """Queues images (and any completed RGB composites) for a list of
+           cutout dicts; images go next to the FITS files. If the task they
+           came from is given, and they hold no images, it's dropped."""
+        cutouts = [f_dict for f_dict in all_fits if f_dict and f_dict.get('download') is not None]
+        for f_dict in cutouts:
+            image_data = np.squeeze(f_dict['download'].data)
+            path = os.path.join(f_dict['out_dir'], os.path.splitext(f_dict['filename'])[0]+f".{self.extension}")
+            self.__submit(render_band, image_data, f_dict['survey'], path, self.image_format, get_image_rms(f_dict['download'].header))
+            self.__add_band(f_dict, image_data)
+        if task is not None and not cutouts:
+            self.drop(task)
+        return self
+
+    def close(self):
+        """Waits for all the images, returning (rendered paths, errors)."""
+        rendered, errors = list(), list()
+        for future in self.futures:
+            try:
+                rendered.append(future.result())
+            except Exception as e:
+                errors.append(e)
+        self.pool.shutdown()
+        with self.lock:
+            incomplete = len(self.pending_rgb) + len([key for key in self.dropped_rgb if len(key) == 4])
+            missing = len([key for key in self.dropped_rgb if len(key) == 3])
+            (self.pending_rgb, self.pending_bytes, self.dropped_rgb) = (dict(), 0, set())
+        if incomplete:
+            errors.append(Exception(f"{incomplete} RGB composite(s) missing bands, or over the memory limit, not rendered"))
+        if missing:
+            errors.append(Exception(f"{missing} target(s) missing an RGB band, no composite rendered"))
+        return rendered, errors
@@ -0,0 +1,202 @@
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+import urllib3
+
+
+#  R E T R I E S   A N D   C I R C U I T   B R E A K E R S
+#
+# A RetryPolicy says how often, and how long apart, a survey retries a
+# failed request: exponential backoff (base_s, doubling up to max_s) with
+# full jitter, so threads that failed together don't retry together, but no
+# sooner than a 429's or 503's Retry-After asks. Only failures that may go
+# away are retried: timeouts, dropped connections, 429 and 5xx (a 404's body
+# is handed back, as the surveys read their services' own error messages).
+#
+# A CircuitBreaker per host counts the host's failures in a row; after
+# failures of them it opens, and requests to the host fail fast (with
+# CircuitOpenError) for reset_s seconds, rather than each thread sitting out
+# its own timeouts on a dead service. Then one request is let through as a
+# probe: if it gets an answer the circuit closes, else it opens again, for
+# twice as long (up to max_reset_s).
+#
+#    breaker = get_circuit_breakers().get(host)
+#    breaker.before_request()          # raises CircuitOpenError while open
+#    ... breaker.add_success() / breaker.add_failure()
+#
+
+# statuses worth retrying, and of those the ones that count against the host's
+# circuit (nb: a 500 or 502 can be a service's answer to the one request, e.g.,
+# a 502 for "no images")
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+HOST_FAULT_STATUSES = {503, 504}
+
+# urllib3's own retries: redirects only (nb: total bounds the errors urllib3 has no counter for)
+URLLIB3_RETRIES = urllib3.util.Retry(total=5, connect=0, read=0, status=0, redirect=5)
+
+
+class HTTPStatusError(Exception):
+    def __init__(self, status, url, retry_after=None):
+        super().__init__(f"HTTP {status} from {url}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, host, retry_in_s):
+        super().__init__(f"circuit open for {host}: failing fast for another {retry_in_s:.1f}s")
+        self.host = host
+        self.retry_in_s = retry_in_s
+
+
+# seconds from a Retry-After header (either delay-seconds or an HTTP date); None if absent or bad
+def get_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp()-time.time())
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def is_host_fault(error):
+    """False for failures where the host did answer (e.g., a 429); timeouts,
+       resets, truncated bodies and the like are."""
+    if isinstance(error, HTTPStatusError):
+        return error.status in HOST_FAULT_STATUSES
+    return True
+
+
+# e.g., 'read timeout' or 'connection refused', for the logs
+def get_failure_name(error):
+    if isinstance(error, urllib3.exceptions.MaxRetryError) and error.reason is not None:
+        error = error.reason
+    if isinstance(error, HTTPStatusError):
+        return f"HTTP {error.status}"
+    if isinstance(error, urllib3.exceptions.ReadTimeoutError):
+        return "read timeout"
+    if isinstance(error, urllib3.exceptions.ConnectTimeoutError):
+        return "connect timeout"
+    if isinstance(error, (urllib3.exceptions.NewConnectionError, ConnectionRefusedError)):
+        return "connection refused"
+    if isinstance(error, (urllib3.exceptions.ProtocolError, ConnectionResetError)):
+        return "connection reset"
+    return type(error).__name__
+
+
+class RetryPolicy:
+    """How many attempts a request gets, and the backoff between them."""
+    def __init__(self, attempts=3, base_s=2.0, max_s=30.0, jitter=True, max_retry_after_s=120.0):
+        self.attempts = max(1, int(attempts))
+        self.base_s = float(base_s)
+        self.max_s = float(max_s)
+        self.jitter = jitter
+        self.max_retry_after_s = float(max_retry_after_s)
+
+    def replace(self, **kwargs):
+        settings = dict(vars(self), **kwargs)
+        return RetryPolicy(**settings)
+
+    def get_delay(self, retry, retry_after=None):
+        """Seconds to wait before retry number retry (1 for the first)."""
+        delay = min(self.max_s, self.base_s * 2**(retry-1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_retry_after_s))
+        return delay
+
+    def __repr__(self):
+        return f"RetryPolicy(attempts={self.attempts}, base_s={self.base_s:g}, max_s={self.max_s:g})"
+
+
+class CircuitBreaker:
+    """Thread safe circuit breaker of one host; see above."""
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, host, failures=5, reset_s=30.0, max_reset_s=300.0):
+        self.host = host
+        self.lock = threading.Lock()
+        self.max_failures = failures
+        self.base_reset_s = reset_s
+        self.max_reset_s = max_reset_s
+        self.reset_s = reset_s
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+
+    def before_request(self):
+        """Raises CircuitOpenError unless a request to the host may go ahead."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            now = time.monotonic()
+            retry_in_s = self.opened_at+self.reset_s-now
+            # nb: only the probe goes while half open (another, if it hasn't answered in reset_s)
+            if retry_in_s <= 0:
+                (self.state, self.opened_at) = (self.HALF_OPEN, now)
+                return
+            raise CircuitOpenError(self.host, retry_in_s)
+
+    def add_success(self):
+        with self.lock:
+            (self.state, self.failures, self.reset_s) = (self.CLOSED, 0, self.base_reset_s)
+
+    def add_failure(self):
+        """Counts a failure; True if it opened the circuit."""
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.reset_s = min(2*self.reset_s, self.max_reset_s)
+            elif self.state == self.OPEN or self.failures < self.max_failures:
+                return False
+            (self.state, self.opened_at) = (self.OPEN, time.monotonic())
+            self.trips += 1
+            return True
+
+    def get_state(self):
+        with self.lock:
+            return {'state': self.state, 'failures': self.failures, 'trips': self.trips}
+
+
+class CircuitBreakers:
+    """The circuit breakers of a process, by host."""
+    def __init__(self, failures=5, reset_s=30.0, max_reset_s=300.0):
+        self.lock = threading.Lock()
+        self.breakers = dict()
+        self.configure(failures, reset_s, max_reset_s)
+
+    def configure(self, failures=None, reset_s=None, max_reset_s=None):
+        """Sets the breakers' settings (nb: those already made keep theirs)."""
+        with self.lock:
+            if failures:
+                self.failures = failures
+            if reset_s:
+                self.reset_s = reset_s
+            if max_reset_s:
+                self.max_reset_s = max_reset_s
+        return self
+
+    def get(self, host):
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(host, self.failures, self.reset_s, max(self.max_reset_s, self.reset_s))
+            return self.breakers[host]
+
+    def get_states(self):
+        with self.lock:
+            breakers = list(self.breakers.values())
+        return {breaker.host: breaker.get_state() for breaker in breakers}
+
+
+default_breakers = CircuitBreakers()
+
+def get_circuit_breakers():
+    return default_breakers
@@ -11,6 +11,8 @@ class SDSS(SurveyABC):
         self.filter = filter
         self.needs_trimming = True
         self.data_release = 14 #default is 14
+        # legacysurvey caps cutout sizes server side
+        self.http_max_response_bytes = 16 * (1 << 20)
 
     @staticmethod
     def get_supported_filters():
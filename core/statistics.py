@@ -1,12 +1,9 @@
 import io
 import numpy as np
-from scipy import stats
 from astropy import units as u
-import matplotlib.pyplot as plt
 from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.stats import mad_std
-from astropy.visualization import imshow_norm, ZScaleInterval, MinMaxInterval, AsinhStretch, ManualInterval, ImageNormalize
 
 
 #calculates the weigted mean using inverse square variances as weights
@@ -30,6 +27,7 @@ def probability_stat(Fluxs, errs):
     wm_flux = variance_weighted_mean(Fluxs, errs)
     chi_sq = np.sum(((np.array(Fluxs)-wm_flux)/np.array(errs))**2)
     dof = len(Fluxs) - 1
+    from scipy import stats
     prob_constant = stats.chi2.sf(chi_sq, dof)
     return prob_constant
 
@@ -94,6 +92,120 @@ def error_flux_nxs(nxs, Fluxs, errs):
         f_rms_var = np.sqrt(nxs) # fractional root mean square (rms) variability amplitude
         return np.sqrt(f_mse/len(Fluxs))*(2*f_rms_var/mean_flux) # (eq B1 2nd case)
 
+#  B A T C H   S T A T I S T I C S
+#
+# Vectorised versions of the above for many sources at once: fluxes and errs
+# are (sources x epochs) arrays and mask (default: finite flux and err) flags
+# the epochs each source has. Each returns one value per source, matching the
+# single source functions given just that source's epochs: including their
+# -1 flags (and quirks), with NaN where those would raise.
+
+def get_batch_arrays(fluxes, errs, mask=None):
+    fluxes = np.atleast_2d(np.asarray(fluxes, dtype=float))
+    errs = np.atleast_2d(np.asarray(errs, dtype=float))
+    if mask is None:
+        mask = np.isfinite(fluxes) & np.isfinite(errs)
+    else:
+        mask = np.atleast_2d(np.asarray(mask, dtype=bool))
+    # neutral values in the missing epochs, so they drop out of the sums
+    fluxes = np.where(mask, fluxes, 0.0)
+    errs = np.where(mask, errs, 1.0)
+    return fluxes, errs, mask, mask.sum(axis=1)
+
+def get_first_two_epochs(values, mask):
+    # values of each source's first two (unmasked) epochs
+    order = np.argsort(~mask, axis=1, kind='stable')
+    values = np.take_along_axis(values, order[:,:2], axis=1)
+    return values[:,0], values[:,1]
+
+def batch_variance_weighted_mean(fluxes, errs, mask=None):
+    fluxes, errs, mask, n = get_batch_arrays(fluxes, errs, mask)
+    weights = mask/(np.maximum(errs, 0.000001)**2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sum(fluxes*weights, axis=1)/np.sum(weights, axis=1)
+
+def batch_error_variance_weighted_mean(errs, mask=None):
+    errs, errs, mask, n = get_batch_arrays(errs, errs, mask)
+    weights = mask/(np.maximum(errs, 0.000001)**2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n == 0, np.nan, np.sqrt(1/np.sum(weights, axis=1)))
+
+def batch_mse(errs, mask=None):
+    errs, errs, mask, n = get_batch_arrays(errs, errs, mask)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sum(mask*errs**2, axis=1)/n
+
+def batch_flux_nxs(fluxes, errs, mask=None):
+    fluxes, errs, mask, n = get_batch_arrays(fluxes, errs, mask)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_flux = np.sum(fluxes, axis=1)/n
+        sample_variance = np.sum(mask*(fluxes-mean_flux[:,None])**2, axis=1)/(n-1)
+        nxs = (sample_variance - np.sum(mask*errs**2, axis=1)/n)/(mean_flux**2)
+    return np.where(n == 0, -1.0, nxs)
+
+def batch_error_flux_nxs(nxs, fluxes, errs, mask=None):
+    fluxes, errs, mask, n = get_batch_arrays(fluxes, errs, mask)
+    nxs = np.asarray(nxs, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        f_mse = np.sum(mask*errs**2, axis=1)/n
+        mean_flux = np.sum(fluxes, axis=1)/n
+        sample_variance = nxs*(mean_flux**2) + f_mse
+        error = np.where(sample_variance < 3*f_mse,
+                         np.sqrt(2/n) * (f_mse/(mean_flux**2)),          # (eq B1 first case)
+                         np.sqrt(f_mse/n)*(2*np.sqrt(nxs)/mean_flux))     # (eq B1 2nd case)
+    return np.where(nxs == -1, -1.0, error)
+
+def batch_overall_modulation_index(fluxes, errs, mask=None, nxs=None):
+    if nxs is None:
+        nxs = batch_flux_nxs(fluxes, errs, mask)
+    with np.errstate(invalid='ignore'):
+        f_var = np.sqrt(nxs)
+        return np.where(nxs < 0, -1.0, np.abs(2*(f_var-1)/(f_var+1)))
+
+def batch_modulation_index(fluxes, errs, mask=None, nxs=None, weighted_mean=None):
+    fluxes, errs, mask, n = get_batch_arrays(fluxes, errs, mask)
+    if weighted_mean is None:
+        weighted_mean = batch_variance_weighted_mean(fluxes, errs, mask)
+    first, second = get_first_two_epochs(fluxes, mask)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pairwise = np.abs((second-first)/weighted_mean)
+    overall = batch_overall_modulation_index(fluxes, errs, mask, nxs)
+    return np.where(n > 2, overall, np.where(n == 2, pairwise, -1.0))
+
+def batch_variability_t_stat(fluxes, errs, mask=None):
+    fluxes, errs, mask, n = get_batch_arrays(fluxes, errs, mask)
+    first, second = get_first_two_epochs(fluxes, mask)
+    first_err, second_err = get_first_two_epochs(errs, mask)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t_stat = np.abs((second-first)/np.sqrt(first_err*2 + second_err*2))
+    return np.where(n == 2, t_stat, -1.0)
+
+def batch_probability_stat(fluxes, errs, mask=None, weighted_mean=None):
+    fluxes, errs, mask, n = get_batch_arrays(fluxes, errs, mask)
+    if weighted_mean is None:
+        weighted_mean = batch_variance_weighted_mean(fluxes, errs, mask)
+    from scipy import stats
+    with np.errstate(invalid='ignore', divide='ignore'):
+        chi_sq = np.sum(mask*((fluxes-weighted_mean[:,None])/errs)**2, axis=1)
+        return stats.chi2.sf(chi_sq, np.where(n > 0, n-1, np.nan))
+
+def batch_variability_stats(fluxes, errs, mask=None):
+    """All the variability statistics for (sources x epochs) fluxes and errs,
+       as a dict of per-source arrays, sharing the intermediate results."""
+    fluxes, errs, mask, n = get_batch_arrays(fluxes, errs, mask)
+    weighted_mean = batch_variance_weighted_mean(fluxes, errs, mask)
+    nxs = batch_flux_nxs(fluxes, errs, mask)
+    return {
+        'n_epochs': n,
+        'weighted_mean': weighted_mean,
+        'error_weighted_mean': batch_error_variance_weighted_mean(errs, mask),
+        'nxs': nxs,
+        'error_nxs': batch_error_flux_nxs(nxs, fluxes, errs, mask),
+        'modulation_index': batch_modulation_index(fluxes, errs, mask, nxs, weighted_mean),
+        't_stat': batch_variability_t_stat(fluxes, errs, mask),
+        'probability': batch_probability_stat(fluxes, errs, mask, weighted_mean),
+    }
+
 def rms_mad(data):
   # Calculates the standard deviation of data using
   # the median absolute deviation, but forcing the median to be 0
@@ -104,22 +216,60 @@ def error_median(all_data):
     # calculates the error of the median of the data
     return rms_mad(all_data)/np.sqrt(len(all_data)-1)
 
-def robust_stats_radio(image_data_2D):
+MAD_TO_SIGMA = 1.482602218505602
+
+def get_finite_values(data):
+    # flat view of the data if it's all finite, else a copy of the finite pixels
+    data = np.asarray(data)
+    finite = np.isfinite(data)
+    if finite.all():
+        return data.ravel()
+    return data[finite]
+
+def get_sample(values, max_samples=None):
+    # evenly strided subsample of at most (about) max_samples values
+    if max_samples and values.size > max_samples:
+        return values[::int(np.ceil(values.size/max_samples))]
+    return values
+
+def robust_stats(image_data, max_samples=None, clip_sigma=None, clip_iters=3):
+    """Returns (min, max, median, rms, std, mean) of the finite pixels, in data
+       units: rms is the MAD about 0 (see rms_mad) and std the MAD about the
+       median (as astropy's mad_std). The median is found once and shared,
+       with the medians done by partitioning one scratch buffer in place.
+       For big mosaics, max_samples estimates the median, rms and std from a
+       strided subsample, and clip_sigma first sigma clips that sample about
+       the median (min, max and mean are always over all the pixels)."""
+    values = get_finite_values(image_data)
+    (image_MIN, image_MAX, image_MEAN) = (np.min(values), np.max(values), np.mean(values))
+    sample = get_sample(values, max_samples)
+    scratch = np.empty(sample.shape, dtype=np.result_type(sample.dtype, np.float32))
+    def get_median_and_std(sample):
+        np.copyto(scratch[:sample.size], sample)
+        median = np.median(scratch[:sample.size], overwrite_input=True)
+        np.subtract(sample, median, out=scratch[:sample.size])
+        np.abs(scratch[:sample.size], out=scratch[:sample.size])
+        return median, MAD_TO_SIGMA*np.median(scratch[:sample.size], overwrite_input=True)
+    (image_MEDIAN, image_STD) = get_median_and_std(sample)
+    if clip_sigma:
+        for _ in range(clip_iters):
+            clipped = sample[np.abs(sample-image_MEDIAN) <= clip_sigma*image_STD]
+            if clipped.size == sample.size or clipped.size == 0:
+                break
+            sample = clipped
+            (image_MEDIAN, image_STD) = get_median_and_std(sample)
+    np.abs(sample, out=scratch[:sample.size])
+    image_RMS = MAD_TO_SIGMA*np.median(scratch[:sample.size], overwrite_input=True)
+    return (image_MIN, image_MAX, image_MEDIAN, image_RMS, image_STD, image_MEAN)
+
+def robust_stats_radio(image_data_2D, max_samples=None, clip_sigma=None):
     # Calculates robust statistics useful for images
     # returns in mJy/beam
-    # Flatten array
-    #image_data_1D = image_data_2D.flatten() #potentially unneccessary
-    # remove non finite values
-    image_data_2D = image_data_2D[np.where(np.isfinite(image_data_2D))]
-    image_RMS     = rms_mad(image_data_2D)*1000 # mJy/beam
-    image_MEDIAN  = np.median(image_data_2D)*1000
-    image_STD     = mad_std(image_data_2D)*1000
-    image_MIN     = np.min(image_data_2D)*1000
-    image_MAX     = np.max(image_data_2D)*1000
-    image_MEAN    = np.mean(image_data_2D)*1000
+    (image_MIN, image_MAX, image_MEDIAN,
+     image_RMS, image_STD, image_MEAN) = robust_stats(image_data_2D, max_samples, clip_sigma)
     # Alternative for looking at RMS of radio data
     # Do not use at this point
     #neg_data = image_data_1D[np.where(image_data_1D <0)]
     #neg_data =np.concatenate((neg_data,-neg_data), axis=None)
     #image_RMS  = biweight_scale(neg_data,M=0)
-    return(image_MIN, image_MAX, image_MEDIAN, image_RMS, image_STD, image_MEAN)
+    return (image_MIN*1000, image_MAX*1000, image_MEDIAN*1000, image_RMS*1000, image_STD*1000, image_MEAN*1000)
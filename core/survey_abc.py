@@ -3,8 +3,11 @@ import os
 import sys
 import traceback
 import tempfile
+import errno
+import threading
+import hashlib
 import shutil
-import datetime, timestring
+import datetime
 
 from io import TextIOWrapper, BytesIO
 import io, os, shutil, tempfile, sys, base64, shutil, json
@@ -12,8 +15,9 @@ import urllib.request
 import urllib.parse
 import urllib.error
 import urllib3
-import requests
+import mmap
 from time import sleep
+from functools import partial
 
 import re
 
@@ -25,12 +29,31 @@ from .survey_filters import HeaderFilter
 from .survey_filters import get_header_pretty_string
 from .survey_filters import sanitize_fits_date_fields
 from .toolbox import *
-from .FITS2DImageTools import *
+from .statistics import robust_stats
+from .coadd import reproject_and_coadd
+from .profiling import NO_STAGE
+from .metrics import NO_REQUEST, get_host
+from .retry import RetryPolicy, CircuitOpenError, HTTPStatusError, RETRY_STATUSES, URLLIB3_RETRIES
+from .retry import get_circuit_breakers, get_retry_after, get_failure_name, is_host_fault
+from .http_transport import get_transport
+from .hedging import get_hedger, get_cancellable_chunks
 
 from astropy import units as u
 
-import montage_wrapper as montage
-from astropy.nddata.utils import Cutout2D
+# montage is only needed when the in-memory mosaicking falls back to it
+def get_montage():
+    import montage_wrapper
+    return montage_wrapper
+
+# never raised: stands in for montage's MontageError until montage is imported
+class MontageNotUsed(Exception):
+    pass
+
+def get_montage_error():
+    montage = sys.modules.get('montage_wrapper')
+    return montage.status.MontageError if montage else MontageNotUsed
+
+FITS_BLOCK = 2880
 
 from enum import Enum
 class processing_status(Enum):
@@ -40,6 +63,7 @@ class processing_status(Enum):
     corrupted = "Header corrupted"
     error     = "Programming error"
     bailed    = "Fetching aborted"
+    unavailable = "Survey service unavailable"
     done      = "Cutout processed"
 
     @classmethod
@@ -81,6 +105,130 @@ class processing_status(Enum):
                 file_listing.append(file)
         return file_listing
 
+# maps the primary image of a downloaded FITS file onto the download buffer
+# (bytearray or mmap) without copying it. returns None whenever astropy's own
+# parser is needed instead: e.g., no END card, scaled or integer data, or the
+# data is truncated.
+def get_hdul_view(data):
+    view = memoryview(data)
+    if bytes(view[:6]) != b"SIMPLE":
+        return None
+    header_end = None
+    for block in range(0, len(view), FITS_BLOCK):
+        cards = bytes(view[block:block+FITS_BLOCK])
+        for card in range(0, len(cards), 80):
+            if cards[card:card+8] == b"END     ":
+                header_end = block+card+80
+                break
+        if header_end:
+            break
+    if header_end is None:
+        return None
+    header = fits.Header.fromstring(bytes(view[:header_end]))
+    if header.get('BITPIX') not in (-32, -64) or header.get('BSCALE',1) != 1 or header.get('BZERO',0) != 0:
+        return None
+    naxis = header.get('NAXIS', 0)
+    shape = tuple(header.get(f'NAXIS{i}', 0) for i in range(naxis, 0, -1))
+    if naxis == 0 or 0 in shape:
+        return None
+    dtype = np.dtype('>f4' if header['BITPIX'] == -32 else '>f8')
+    offset = -(-header_end // FITS_BLOCK) * FITS_BLOCK
+    count = int(np.prod(shape))
+    if offset + count*dtype.itemsize > len(view):
+        return None
+    image = np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape)
+    return fits.HDUList([fits.PrimaryHDU(data=image, header=header)])
+
+# tile compressed copy of an hdu list, e.g., compression='RICE_1' or 'GZIP_2':
+# every image becomes a CompImageHDU extension behind an empty primary hdu
+# (nb: float images are quantized unless quantize_level=0, which is lossless
+# for the GZIP methods only)
+def compress_hdul(hdul, compression, quantize_level=16):
+    compressed = fits.HDUList([fits.PrimaryHDU()])
+    for hdu in hdul:
+        if hdu.data is None:
+            continue
+        # convert primary headers to extension ones
+        header = fits.ImageHDU(data=hdu.data, header=hdu.header).header
+        compressed.append(fits.CompImageHDU(data=hdu.data, header=header, compression_type=compression,
+                                            quantize_level=quantize_level))
+    return compressed
+
+# striped locks on output file names, so parallel savers can't race each other
+# picking duplicate names or writing the same file (nb: a fixed pool, rather
+# than a lock per file, keeps memory flat over huge batches)
+save_locks = [threading.Lock() for _ in range(64)]
+def get_save_lock(path):
+    return save_locks[hash(os.path.abspath(path)) % len(save_locks)]
+
+# returns the first free 'name(n).fits' (n=1,...) alternative to an existing
+# file from a single directory listing, or None if max_duplicates are taken
+def get_free_filename(path, max_duplicates=9):
+    if not os.path.exists(path):
+        return path
+    directory, filename = os.path.split(path)
+    stem = re.sub(r"\.fits$","",filename)
+    pattern = re.compile(re.escape(stem)+r"\((\d+)\)\.fits$")
+    taken = [int(m.group(1)) for m in [pattern.match(f) for f in os.listdir(directory or '.')] if m]
+    index = max(taken, default=0)+1
+    if index > max_duplicates:
+        return None
+    return path.replace(".fits", f"({index}).fits")
+
+# a write only stream hashing (sha1) and counting what goes through it to f
+# (nb: no fileno, so astropy writes the data arrays through write() as well)
+class HashingWriter(io.RawIOBase):
+    def __init__(self, f):
+        self.f = f
+        self.sha1 = hashlib.sha1()
+        self.nbytes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        written = self.f.write(data)
+        self.sha1.update(data)
+        self.nbytes += memoryview(data).nbytes
+        return written
+
+    def tell(self):
+        return self.nbytes
+
+# writes an hdu list to a temp file next to path and renames it into place,
+# so partially written FITS files are never seen; returns the file's size
+# and sha1, taken as it's written (rather than reading it back)
+def write_fits_atomically(hdul, path, output_verify='silentfix+warn'):
+    directory, filename = os.path.split(path)
+    tmp_path = os.path.join(directory, f".{filename}.{os.getpid()}.{threading.get_ident()}.part")
+    try:
+        # nb: not mkstemp, which would leave the file 0600 rather than honour the umask
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0o666), 'wb') as tmp:
+            writer = HashingWriter(tmp)
+            hdul.writeto(writer, output_verify=output_verify)
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return (writer.nbytes, writer.sha1.hexdigest())
+
+# raised when a download is larger than the survey's http_max_response_bytes
+class ResponseTooLarge(Exception):
+    pass
+
+# clients of the surveys' query services (e.g., an astroquery Cadc, with its
+# TAP service discovery done), reused by every task a thread runs: each is
+# built once per thread, on first use, by its factory (nb: astroquery's
+# clients aren't thread safe, so threads share no more than the transport's
+# pools; a failed build isn't kept, so the next task tries again)
+thread_clients = threading.local()
+def get_thread_client(name, factory):
+    clients = thread_clients.__dict__
+    if not name in clients:
+        clients[name] = factory()
+    return clients[name]
+
 # abstract class for a survey
 from abc import ABC, abstractmethod
 class SurveyABC(ABC):
@@ -108,13 +256,42 @@ class SurveyABC(ABC):
 
         # http request settings
         self.print_to_stdout = True
-        self.http_request_retries = 3
-        self.http_wait_retry_s = 2
+        self.retry_policy = RetryPolicy(attempts=3, base_s=2.0, max_s=30.0)
+        self.use_circuit_breakers = True
+        # send a duplicate of a slow download, if the process has a hedger (see set_hedger)
+        self.use_hedging = True
         self.http_read_timeout = 15
+        # streaming download settings: responses are read in chunks into a
+        # preallocated buffer (or a memory mapped temp file if the length is
+        # unknown) and refused when larger than http_max_response_bytes.
+        self.http_chunk_bytes = 1 << 20
+        self.http_max_response_bytes = 256 * (1 << 20)
         # data out settings
         self.tmp_dir = "/tmp"
         self.out_dir = None
         self.overwrite = True
+        # tile compression of the saved FITS, e.g., 'RICE_1' or 'GZIP_2' (None for none)
+        self.compression = None
+        self.quantize_level = 16
+        # mosaicking: "numpy" (in memory) or "montage"; montage is the fallback
+        self.mosaic_engine = "numpy"
+        self.mosaicked_with = None
+        # parallel reprojection for the numpy engine
+        self.mosaic_workers = os.cpu_count() or 1
+        self.mosaic_use_processes = False
+        # a bigger in-memory mosaic grid than this (e.g., untrimmed tiles) goes to montage
+        self.mosaic_max_pixels = 16 * (1 << 20)
+        # robust image statistics (DATARMS/DATAMED) recorded in the cutout headers;
+        # max_samples/clip_sigma trade exactness for speed on big mosaics
+        self.image_stats = True
+        self.image_stats_max_samples = None
+        self.image_stats_clip_sigma = None
+        # per stage timings (see core/profiling.py), None to not record
+        self.stage_recorder = None
+        # live counters of the run (see core/metrics.py), None for none
+        self.metrics = None
+        # queued, structured logging (see core/log_sink.py); None to print and buffer here
+        self.log_sink = None
 
     # save a list of dicts for HDU results into a folder with originals in nearby folder
     #save_orig_separately is for webserver
@@ -125,33 +302,26 @@ class SurveyABC(ABC):
                 save_dir = f_dict["out_dir"]
             save_at = os.path.join(save_dir, f_dict['filename'])
             if f_dict['download']:
-                try:
-                    f_dict['download'].writeto(save_at, overwrite=f_dict['overwrite'])
-                except Exception as e:
-                    if "Verif" in str(e): #skip verify warnings from fits standards
-                        f_dict['download'].writeto(save_at, overwrite=f_dict['overwrite'], output_verify='silentfix+warn')
-                    elif "exists" in str(e):
-                        next = 1
-                        save_at = save_at.replace(".fits", f"({next}).fits")
-                        while next < 10:
-                            try:
-                                f_dict['download'].writeto(save_at, overwrite=f_dict['overwrite'], output_verify='silentfix+warn')
-                                break
-                            except:
-                                next+=1
-                                save_at = save_at.replace(f"({next-1}).fits", f"({next}).fits")
-                        if next>=10:
-                            raise Exception(f"duplicate files not saved! {f_dict['filename']} for {f_dict['survey']}")
-                    else:
-                        raise Exception(f"problem creating {f_dict['filename']} for {f_dict['survey']}")
+                hdul = fits.HDUList([f_dict['download']])
                 # do this for every mosaic CLI
                 # add original raw tiles as extensions to mosaic as default
                 if len(list(f_dict['originals']))>1 and save_orig_separately==False:
-                    fits_img = fits.open(save_at, mode='append')
                     for og in f_dict['originals']:
-                        fits_img.append(f_dict['originals'][og]['tile'])
+                        hdul.append(f_dict['originals'][og]['tile'])
                         del f_dict['originals'][og]['tile']
-                    fits_img.close(output_verify="silentfix")
+                if f_dict.get('compression'):
+                    hdul = compress_hdul(hdul, f_dict['compression'], f_dict['quantize_level'])
+                # mosaic and originals go to disk in one pass
+                with get_save_lock(save_at):
+                    if not f_dict['overwrite']:
+                        save_at = get_free_filename(save_at)
+                        if save_at is None:
+                            raise Exception(f"duplicate files not saved! {f_dict['filename']} for {f_dict['survey']}")
+                    try:
+                        # nb: its size and sha1 go to the manifest
+                        (f_dict['nbytes'], f_dict['sha1']) = write_fits_atomically(hdul, save_at)
+                    except Exception as e:
+                        raise Exception(f"problem creating {f_dict['filename']} for {f_dict['survey']}: {e}")
 
                 # this always for webserver
                 # by default save single mosiac then originals separately
@@ -164,11 +334,15 @@ class SurveyABC(ABC):
                     sorted_keys = sorted((list(f_dict['originals'])), key=lambda x: f_dict['originals'][x]['obs-date'])
                     for num, url in enumerate(sorted_keys, 1):
                         fname = str(num)+"-" + urllib.parse.unquote(url).split('/')[-1]+'.fits'
-                        f_dict['originals'][url]['tile'].writeto(orig_dir+'/'+fname, overwrite=True, output_verify='silentfix+warn')
+                        tile = f_dict['originals'][url]['tile']
+                        if f_dict.get('compression'):
+                            tile = compress_hdul([tile], f_dict['compression'], f_dict['quantize_level'])
+                        tile.writeto(orig_dir+'/'+fname, overwrite=True, output_verify='silentfix+warn')
                         f_dict['originals'][url]['filepath'] = orig_dir+'/' + fname
                         f_dict['originals'][url]['filename'] = fname
                         del f_dict['originals'][url]['tile'] # remove fits image so json serializable
-                    # add thumbnail for webserver
+                    # add thumbnail for webserver (nb: the display code is only imported when needed)
+                    from .FITS2DImageTools import get_thumbnail
                     f_dict['thumbnail'] = base64.encodestring(get_thumbnail(f_dict['download'], f_dict['survey'])).decode('ascii')
                 # else:  # still remove fits imagset_out_dire so json serializable
                 #     f_dict['originals'][list(f_dict['originals'])[0]]['filepath'] = save_at
@@ -191,6 +365,54 @@ class SurveyABC(ABC):
         self.tmp_dir= directory
         return self
 
+    def set_compression(self, compression, quantize_level=16):
+        self.compression = compression
+        self.quantize_level = quantize_level
+        return self
+
+    def set_mosaic_engine(self, engine):
+        self.mosaic_engine = engine
+        return self
+
+    def set_mosaic_workers(self, workers, use_processes=False):
+        self.mosaic_workers = workers
+        self.mosaic_use_processes = use_processes
+        return self
+
+    def set_mosaic_max_pixels(self, max_pixels):
+        self.mosaic_max_pixels = max_pixels
+        return self
+
+    def set_image_stats(self, record=True, max_samples=None, clip_sigma=None):
+        self.image_stats = record
+        self.image_stats_max_samples = max_samples
+        self.image_stats_clip_sigma = clip_sigma
+        return self
+
+    def set_stage_recorder(self, recorder):
+        self.stage_recorder = recorder
+        return self
+
+    def set_log_sink(self, log_sink):
+        self.log_sink = log_sink
+        return self
+
+    def set_metrics(self, metrics):
+        self.metrics = metrics
+        return self
+
+    # tracks an http attempt (in flight, bytes, failure) in the metrics, if any
+    def track_request(self, url):
+        if self.metrics is None:
+            return NO_REQUEST
+        return self.metrics.request(url)
+
+    # times a block of this task as the named stage, if recording
+    def stage(self, name):
+        if self.stage_recorder is None:
+            return NO_STAGE
+        return self.stage_recorder.stage(name, pid=self.pid, survey=type(self).__name__, filter=self.get_filter_name())
+
     def set_out_dir(self, dir_path):
         self.out_dir = dir_path
 
@@ -198,18 +420,46 @@ class SurveyABC(ABC):
         self.pid = pid
         return self
 
+    def set_retry_policy(self,retry_policy):
+        self.retry_policy = retry_policy
+        return self
+
     def set_http_request_retries(self,retries):
-        self.http_request_retries = retries
+        self.retry_policy = self.retry_policy.replace(attempts=retries)
         return self
 
+    # the backoff's first wait (nb: doubling, and jittered, from there)
     def set_http_wait_retry_s(self,wait_seconds):
-        self.http_wait_retry_s = wait_seconds
+        self.retry_policy = self.retry_policy.replace(base_s=wait_seconds)
+        return self
+
+    def set_use_circuit_breakers(self,use_circuit_breakers=True):
+        self.use_circuit_breakers = use_circuit_breakers
+        return self
+
+    def set_use_hedging(self,use_hedging=True):
+        self.use_hedging = use_hedging
+        return self
+
+    def set_http_max_response_bytes(self,max_bytes):
+        self.http_max_response_bytes = max_bytes
         return self
 
     def attach_http_pool_manager(self,http_pool_manager):
         self.http = http_pool_manager
         return self
 
+    # the attached pool manager (or transport), else the process wide transport
+    def get_http(self):
+        return self.http if self.http is not None else get_transport()
+
+    # a small response (e.g., a tile or catalogue listing), whole
+    def get_url_data(self, url):
+        (status, data) = self.__request(url)
+        if status != 200:
+            raise Exception(f"HTTP {status} from {url}")
+        return bytes(data)
+
     def __push_message_buffer(self,msg):
         self.message_buffer += msg+"\n"
 
@@ -218,21 +468,22 @@ class SurveyABC(ABC):
         self.message_buffer = ""
         return msg
 
+    def __format_message(self, msg, diagnostic_msg=None, is_traceback=True):
+        if not (diagnostic_msg is None):
+            if isinstance(diagnostic_msg,fits.header.Header):
+                return msg + ("\nHEADER:\n>%s" % "\n>".join(get_header_pretty_string(diagnostic_msg).splitlines()))
+            return msg + ("\nTRACEBACK:" if is_traceback else "") + "\n>%s" % "\n> ".join(diagnostic_msg.splitlines())
+        elif isinstance(msg,fits.header.Header):
+            return "HEADER:\n>%s" % "\n>".join(get_header_pretty_string(msg).splitlines())
+        return msg
+
     # std out printing functions
     def sprint(self, msg, diagnostic_msg=None, show_caller=False, is_traceback=True, buffer=True):
         my_name   = type(self).__name__ + (f"[{sys._getframe(1).f_code.co_name}]" if show_caller else "")
         my_pid    = "" if self.pid is None else f"pid={self.pid}"
         my_filter = (lambda f: "" if f is None else f"filter='{f.name}'")(self.get_filter_setting())
         prefix = f"{my_name}({my_pid}{'' if my_pid=='' or my_filter=='' else ','}{my_filter})"
-        if not (diagnostic_msg is None):
-            if isinstance(diagnostic_msg,fits.header.Header):
-                msg_str = msg + ("\nHEADER:\n>%s" % "\n>".join(get_header_pretty_string(diagnostic_msg).splitlines()))
-            else:
-                msg_str = msg + ("\nTRACEBACK:" if is_traceback else "") + "\n>%s" % "\n> ".join(diagnostic_msg.splitlines())
-        elif isinstance(msg,fits.header.Header):
-            msg_str = "HEADER:\n>%s" % "\n>".join(get_header_pretty_string(msg).splitlines())
-        else:
-            msg_str = msg
+        msg_str = self.__format_message(msg, diagnostic_msg, is_traceback)
         prefixed_output = "\n".join([f"{prefix}: {s}" for s in msg_str.splitlines() if s])
         if buffer:
             self.__push_message_buffer(prefixed_output)
@@ -247,6 +498,14 @@ class SurveyABC(ABC):
         return self
 
     def print(self, msg, diagnostic_msg=None, show_caller=False, is_traceback=True, buffer=True):
+        if self.log_sink is not None:
+            # the sink's thread does the prefixing and writing (and there's no buffering)
+            level = 'warning' if diagnostic_msg is not None or str(msg).startswith("WARN") else 'debug'
+            fields = {'pid': self.pid, 'survey': type(self).__name__, 'filter': self.get_filter_name()}
+            if show_caller:
+                fields['caller'] = sys._getframe(1).f_code.co_name
+            self.log_sink.log(level, self.__format_message(msg, diagnostic_msg, is_traceback), **fields)
+            return
         message = self.sprint(**{key: value for key, value in locals().items() if key not in 'self'})
         if self.print_to_stdout:
             print(message)
@@ -263,10 +522,28 @@ class SurveyABC(ABC):
             request = url
         return request
 
+    # record the robust rms and median of the cutout, so thumbnails and
+    # downstream tools needn't recompute them
+    def add_image_stats(self, hdu):
+        if not self.image_stats or hdu is None or hdu.data is None:
+            return hdu
+        try:
+            (image_MIN, image_MAX, image_MEDIAN,
+             image_RMS, image_STD, image_MEAN) = robust_stats(hdu.data, self.image_stats_max_samples, self.image_stats_clip_sigma)
+        except ValueError: # nb: no finite pixels
+            return hdu
+        hdu.header['DATARMS'] = (float(image_RMS), 'Robust (MAD about 0) RMS of image data')
+        hdu.header['DATAMED'] = (float(image_MEDIAN), 'Median of image data')
+        return hdu
+
     def add_CIRADA_signature(self, new_hdu, mosaicked=False):
         new_hdu.header['CREATOR'] = 'CIRADA CUTOUT SERVICE PSOFT.1.v2 (www.cirada.ca)' #, after=-1)
         self.add_cutout_service_comment(new_hdu)
-        if mosaicked:
+        if mosaicked and self.mosaicked_with == "numpy":
+            new_hdu.header.add_comment(pad_string_lines("This image was mosaicked in memory by " \
+                        "bilinear reprojection onto a common TAN grid and mean coaddition " \
+                        "of the input images."), after=-1)
+        elif mosaicked:
             new_hdu.header.add_comment(pad_string_lines("Astropy's python wrapper to the Montage " \
                         "Astronomical Image Mosaic Engine was used to mosaic this image:" \
                         " (https://montage-wrapper.readthedocs.io/en/v0.9.5/) "), after=-1)
@@ -280,51 +557,117 @@ class SurveyABC(ABC):
                         "Industrial Research Organisation. \
                         "), after=-1)
 
-    # get data over http post
-    def send_request(self, url):
-        potential_retries = self.http_request_retries
-        #print("sending request for fits", url)
-        while potential_retries > 0:
-            try:
-                #webserver handles own process pool
-                if self.http is None:
-                    #response = urllib.request.urlopen(request)
-                    response = requests.get(url, verify=False, timeout=self.http_read_timeout)
-                else:
-                    response = self.http.request('GET',url, timeout=self.http_read_timeout)
-            except urllib.error.HTTPError as e:
-                self.print(f"{e}",is_traceback=True)
-            except ConnectionResetError as e:
-                self.print(f"{e}",is_traceback=True)
-            except urllib3.exceptions.MaxRetryError as e:
-                self.print(f"{e}",is_traceback=True)
-            except requests.exceptions.ReadTimeout as e:
-                self.print(f"{e}", is_traceback=True)
-            except requests.exceptions.ConnectionError as e:
-                self.print(f"{e}", is_traceback=True)
-                # raise Exception(str(e))
-            except Exception as e:
-                self.print("OTHER exception" + str(e))
-            else:
+    # stream a response body into a preallocated buffer, or into a memory
+    # mapped temp file when the length isn't known up front, so a tile is
+    # only ever held once in memory
+    def __read_response(self, response, cancelled=None):
+        chunks = response.stream(self.http_chunk_bytes)
+        if cancelled is not None:
+            chunks = get_cancellable_chunks(chunks, cancelled)
+        max_bytes = self.http_max_response_bytes
+        length = response.headers.get('Content-Length')
+        # the advertised length is of the encoded body if compressed
+        if length is not None and not response.headers.get('Content-Encoding'):
+            length = int(length)
+            if max_bytes and length > max_bytes:
+                raise ResponseTooLarge(f"response of {length} bytes exceeds {type(self).__name__} limit of {max_bytes} bytes")
+            buffer = bytearray(length)
+            view = memoryview(buffer)
+            offset = 0
+            for chunk in chunks:
+                if offset+len(chunk) > length:
+                    raise Exception(f"response longer than advertised {length} bytes")
+                view[offset:offset+len(chunk)] = chunk
+                offset += len(chunk)
+            if offset < length:
+                raise Exception(f"truncated response: got {offset} of {length} bytes")
+            return buffer
+        with tempfile.TemporaryFile(dir=self.tmp_dir) as spool:
+            total = 0
+            for chunk in chunks:
+                total += len(chunk)
+                if max_bytes and total > max_bytes:
+                    raise ResponseTooLarge(f"response exceeds {type(self).__name__} limit of {max_bytes} bytes")
+                spool.write(chunk)
+            if total == 0:
+                return bytearray()
+            spool.flush()
+            # private (copy-on-write) mapping, the file is unlinked on close
+            return mmap.mmap(spool.fileno(), total, access=mmap.ACCESS_COPY)
+
+    # one GET, read whole (nb: urllib3 only follows redirects, the retries are ours)
+    def __fetch(self, url, cancelled=None):
+        # nb: without an attached pool (e.g., the webserver), the process wide transport
+        response = self.get_http().request('GET',url, timeout=self.http_read_timeout, preload_content=False, retries=URLLIB3_RETRIES)
+        try:
+            data = self.__read_response(response, cancelled)
+        except Exception:
+            response.close() # don't hand a half read connection back to the pool
+            raise
+        finally:
+            if cancelled is not None:
+                cancelled.done() # nb: before the connection goes back to the pool, for others to use
+            response.release_conn()
+        if response.status in RETRY_STATUSES:
+            raise HTTPStatusError(response.status, url, get_retry_after(response.headers.get('Retry-After')))
+        return (response.status, data)
+
+    # one GET, with a duplicate sent if it's slow for its host (when hedging, see core/hedging.py)
+    def __hedged_fetch(self, url):
+        hedger = get_hedger() if self.use_hedging else None
+        if hedger is None:
+            return self.__fetch(url)
+        return hedger.run(get_host(url), partial(self.__fetch, url))
+
+    # get data over http, as the survey's retry policy says: failures that may go away
+    # (timeouts, resets, 429s and 5xx) are retried with backoff, unless the host's
+    # circuit breaker is open, in which case the task fails fast as unavailable
+    def __request(self, url):
+        policy = self.retry_policy
+        breaker = get_circuit_breakers().get(get_host(url)) if self.use_circuit_breakers else None
+        for attempt_number in range(1, policy.attempts+1):
+            if breaker:
                 try:
-                    #webserver way
-                    if self.http is None:
-                        response_data = bytearray(response.content)
-                    else:
-                        response_data = bytearray(response.data)
-                    return response_data
+                    breaker.before_request()
+                except CircuitOpenError as e:
+                    self.print(f"WARNING: Bailed on fetch '{url}': {e}")
+                    self.processing_status = processing_status.unavailable
+                    raise
+            with self.track_request(url) as attempt:
+                try:
+                    (status, data) = self.__hedged_fetch(url)
+                except ResponseTooLarge as e:
+                    # no point retrying, it won't get any smaller
+                    if breaker:
+                        breaker.add_success() # nb: the host did answer
+                    self.print(f"WARNING: Bailed on fetch '{url}': {e}")
+                    self.processing_status = processing_status.bailed
+                    raise Exception(f"{e}")
                 except Exception as e:
-                    print(f"{e}",is_traceback=True)
-            potential_retries -= 1
-            if potential_retries > 0:
-                self.print(f"Taking a {self.http_wait_retry_s}s nap...")
-                sleep(self.http_wait_retry_s)
+                    failure = get_failure_name(e)
+                    retry_after = getattr(e, 'retry_after', None)
+                    self.print(f"{failure} fetching '{url}': {e}", is_traceback=True)
+                    if breaker and not is_host_fault(e):
+                        breaker.add_success()
+                    elif breaker and breaker.add_failure():
+                        self.print(f"WARNING: {get_host(url)} is failing ({failure}): opened its circuit breaker")
+                else:
+                    if breaker:
+                        breaker.add_success()
+                    attempt.done(len(data))
+                    return (status, data)
+            if attempt_number < policy.attempts:
+                delay = policy.get_delay(attempt_number, retry_after)
+                self.print(f"Taking a {delay:.1f}s nap...")
+                sleep(delay)
                 self.print("OK, lest trying fetching the cutout -- again!")
 
-        print(f"WARNING: Bailed on fetch '{url}'")
+        self.print(f"WARNING: Bailed on fetch '{url}' after {policy.attempts} attempt(s): {failure}")
         self.processing_status = processing_status.bailed
-        raise Exception("Connection issue or Timeout retrieving FITS")
-        return None
+        raise Exception(f"Connection issue or Timeout retrieving FITS ({failure})")
+
+    def send_request(self, url):
+        return self.__request(url)[1]
 
     def standardize_fits_header_DATE_and_DATE_OBS_fields(self, date_obs_value):
         # standardize formating to 'yyyy-mm-ddTHH:MM:SS[.sss]': cf., 'https://heasarc.gsfc.nasa.gov/docs/fcg/standard_dict.html'.
@@ -333,22 +676,26 @@ class SurveyABC(ABC):
     # tries to create a fits file from bytes.
     # on fail it returns None
     def create_fits(self, data, rms=False):
-        # a pretend file in memory
-        fits_file = io.BytesIO(data)
-        fits_file.seek(0)
-        # open fits hdul
-        try:
-            hdul = fits.open(fits_file, ignore_missing_end= True)
-            # print("HDUL OPEN FINE")
-        except OSError as e:
-            if "data is available" in str(data):
-                raise Exception(f"{type(self).__name__}({self.filter.name}={self.filter.value}): error creating FITS "+ str(data.decode()))
-            else:
-                e_s = re.sub(r"\.$","",f"{e}")
-                #self.print("Badly formatted FITS file: {0}\n\treturning None".format(str(e)), file=sys.stderr)
-                self.print(f"OSError: {e_s}: Badly formatted FITS file: Cutout not found: Skipping...", is_traceback=True)
-                self.processing_status = processing_status.corrupted
-                return None
+        # map the primary image straight onto the downloaded buffer if we can,
+        # otherwise fall back to astropy's parser (which copies)
+        hdul = get_hdul_view(data)
+        if hdul is None:
+            # a pretend file in memory
+            fits_file = io.BytesIO(data)
+            fits_file.seek(0)
+            # open fits hdul
+            try:
+                hdul = fits.open(fits_file, ignore_missing_end= True)
+                # print("HDUL OPEN FINE")
+            except OSError as e:
+                if "data is available" in str(bytes(data)):
+                    raise Exception(f"{type(self).__name__}({self.filter.name}={self.filter.value}): error creating FITS "+ str(bytes(data).decode()))
+                else:
+                    e_s = re.sub(r"\.$","",f"{e}")
+                    #self.print("Badly formatted FITS file: {0}\n\treturning None".format(str(e)), file=sys.stderr)
+                    self.print(f"OSError: {e_s}: Badly formatted FITS file: Cutout not found: Skipping...", is_traceback=True)
+                    self.processing_status = processing_status.corrupted
+                    return None
         # print("HDUL AFTER:", hdul)
         # get/check header field
         header = hdul[0].header
@@ -360,7 +707,7 @@ class SurveyABC(ABC):
             return None
         # get/check data field
         data = hdul[0].data
-        if data.min() == 0 and data.max() == 0 and not rms:
+        if not rms and is_all_zero(data):
             print(f"Fits file contains no data: skipping...rms={rms}\n\n\n\n.......................................................")
             raise Exception(f"Fits file contains no data: skipping...rms={rms}")
             self.print("WARNING: Fits file contains no data: skipping...",header)
@@ -377,15 +724,19 @@ class SurveyABC(ABC):
     def get_fits(self, url):
         self.print(f"Fetching: {url}")
         try:
-            response = self.send_request(url)
-            if "NoContent" in str(response):
+            with self.stage('send_request'):
+                response = self.send_request(url)
+            # only scan the body for service error messages if it isn't a FITS file
+            # (saves stringifying a whole tile)
+            text = "" if bytes(response[:6]) == b"SIMPLE" else str(bytes(response))
+            if "NoContent" in text:
                 raise Exception(f"No Content found! </br> Try another position or increasing the radius")
             elif len(response)<=500:
-                print(response)
-                if "502 Bad Gateway" in str(response):
+                print(text)
+                if "502 Bad Gateway" in text:
                     raise Exception(f"Error retrieving Fits: No images found")
-                raise Exception(f"Error retrieving Fits: {response}")
-            elif "No resource" in str(response):
+                raise Exception(f"Error retrieving Fits: {text}")
+            elif "No resource" in text:
                 raise Exception(f"No resource found! </br> Try another position or increasing the radius")
         except Exception as e:
             print(f"{type(self).__name__} EXCEPTION" + str(e))
@@ -396,7 +747,8 @@ class SurveyABC(ABC):
         rms = False
         if ".rms." in url:
             rms = True
-        hdul = self.create_fits(response, rms)
+        with self.stage('create_fits'):
+            hdul = self.create_fits(response, rms)
         if not hdul:
             raise Exception(f"{type(self).__name__}: error creating FITS, Third party service potentially down.")
         return (hdul[0], url)
@@ -405,7 +757,8 @@ class SurveyABC(ABC):
     # some survey classes have custom get_tiles
     def get_tiles(self, position, size):
         self.print(f"getting tile urls for {str(position)}\n" )
-        request_urls_stack = self.get_tile_urls(position,size)
+        with self.stage('get_tile_urls'):
+            request_urls_stack = self.get_tile_urls(position,size)
         if not request_urls_stack:
             self.processing_status = processing_status.none
             raise Exception(f"no valid {type(self).__name__}({self.filter.name}:{self.filter.value}) urls found for Position: {position.ra.degree}, {position.dec.degree}")
@@ -422,7 +775,23 @@ class SurveyABC(ABC):
             if e.errno != errno.EEXIST:
                 raise
 
-    def mosaic(self, cutouts):
+    # mosaics the tiles, in memory if it can; given a size, only that box about the position
+    def mosaic(self, cutouts, position=None, size=None):
+        if self.mosaic_engine == "numpy":
+            try:
+                center = None if position is None else (position.ra.to(u.deg).value, position.dec.to(u.deg).value)
+                size_deg = None if size is None else size.to(u.deg).value
+                hdul = reproject_and_coadd(cutouts, center, self.mosaic_workers, self.mosaic_use_processes,
+                                           size=size_deg, max_pixels=self.mosaic_max_pixels)
+                self.mosaicked_with = "numpy"
+                return hdul
+            except Exception as e:
+                self.print(f"In memory mosaicking failed: {e}: falling back to Montage...",diagnostic_msg=traceback.format_exc(),show_caller=True)
+        hdul = self.montage_mosaic(cutouts)
+        self.mosaicked_with = "montage"
+        return hdul
+
+    def montage_mosaic(self, cutouts):
         tempfile.tempdir = self.tmp_dir
         td = tempfile.mkdtemp()
         input_dir = '{directory}/input'.format(directory=td)
@@ -435,7 +804,7 @@ class SurveyABC(ABC):
                     img.writeto(tmp)
                     # could technically save originals here for webserver instead of later
 
-            montage.mosaic(input_dir, output_dir, subset_fast =True)
+            get_montage().mosaic(input_dir, output_dir, subset_fast =True)
             with open('{outdir}/mosaic.fits'.format(outdir=output_dir), 'rb') as f:
                 merged = f.read()
         finally:
@@ -483,7 +852,8 @@ class SurveyABC(ABC):
     #     mem_file.seek(0)
     #     return mem_file.getvalue()
 
-    def paste_tiles(self, hdul_tiles, position):
+    # nb: given a size (e.g., the survey trims to it anyway), only that box is mosaicked
+    def paste_tiles(self, hdul_tiles, position, size=None):
         if hdul_tiles is None:
             return None
 
@@ -492,7 +862,7 @@ class SurveyABC(ABC):
             try:
                 imgs = [tile for (tile,url) in hdul_tiles]
                 header_template = imgs[0].header.copy()
-                hdu = self.mosaic(imgs)[0]
+                hdu = self.mosaic(imgs, position, size)[0]
 
                 new_keys = set([k for k in hdu.header.keys()]+['PC1_1','PC1_2','PC2_1','PC2_2'])
                 old_keys = set([k for k in header_template.keys()])
@@ -511,7 +881,7 @@ class SurveyABC(ABC):
                     'CRPIX2': (np.round(len(hdu.data)/2.0,1), 'Axis 2 reference pixel')
                 }).get_header()
                 hdu.header = header_template
-            except montage.status.MontageError as e:
+            except get_montage_error() as e:
                 self.print(f"Mosaicking Failed: {e}:",diagnostic_msg=traceback.format_exc(),show_caller=True)
                 self.processing_status = processing_status.error
             except OSError as e:
@@ -536,6 +906,8 @@ class SurveyABC(ABC):
             w = w.dropaxis(2)
             naxis -= 1
         img_data = np.squeeze(hdu.data)
+        from astropy.nddata.utils import Cutout2D # nb: slow to import (it pulls in scipy)
+        # copy only the cutout region so the (possibly buffer backed) tile can be let go
         stamp = Cutout2D(img_data, position, size, wcs=w, mode='trim', copy=True)
         hdu.header.update(stamp.wcs.to_header())
         trimmed = fits.PrimaryHDU(stamp.data, header=hdu.header)
@@ -595,7 +967,7 @@ class SurveyABC(ABC):
         new_hdu.header['COMMENT'] = "BMAJ, BMIN, BPA, MJD-OBS, and DATE-OBS only currently represent the values" \
                                     " from one of the input files."
 
-        return new_hdu
+        return self.add_image_stats(new_hdu)
 
     def group_tiles(self, tile_tups, rule):
         # rule has to be a valid fits HEADER value (such as DATE-OBS) OR of our defined groups "Mosaic" or "None"
@@ -607,6 +979,7 @@ class SurveyABC(ABC):
             if rule in tile.header:
                 this_group = tile.header[rule]
                 if rule=='DATE-OBS':
+                    import timestring
                     this_group = timestring.Date(tile.header[rule]).date.strftime("%Y-%m-%d")
                 if this_group in list(groups):
                     groups[this_group].append((tile,tile_url))
@@ -624,17 +997,17 @@ class SurveyABC(ABC):
         fits_data['epoch'] = None
         survey_name = type(self).__name__
         radius = size/2
-        try:
-            filter = self.get_filter_setting().name.lower()
-        except Exception as e:
-            filter = ""
+        filter = self.get_filter_name()
         # try:
         if len(tiles)>1:
             all_headers = [t.header for (t, tile_url) in tiles]
-            tile    = self.paste_tiles(tiles, position)
+            with self.stage('paste_tiles'):
+                tile    = self.paste_tiles(tiles, position, size if self.needs_trimming else None)
             if self.needs_trimming:
-                tile = self.trim_tile(tile,position,size)
-            cutout  = self.format_fits_hdu(tile,position,all_headers)
+                with self.stage('trim_tile'):
+                    tile = self.trim_tile(tile,position,size)
+            with self.stage('format_fits_hdu'):
+                cutout  = self.format_fits_hdu(tile,position,all_headers)
             fits_data['filename'] = get_mosaic_filename(position,radius,survey_name, filter=filter, group_title=group)
             if survey_name=="VLASS" and group[0].isdigit(): # only label if not mosaicked UNLESS by date obs should all be same epoch
                 fits_data['epoch'] = self.get_epoch(tiles[0][1])
@@ -650,7 +1023,10 @@ class SurveyABC(ABC):
             fits_data['filename'] = get_non_mosaic_filename(position, radius, survey_name, baseurl=tiles[0][1], index=index, filter=filter, group_title=group)
             cutout = tiles[0][0]
             if self.needs_trimming:
-                cutout = self.trim_tile(cutout,position,size)
+                with self.stage('trim_tile'):
+                    cutout = self.trim_tile(cutout,position,size)
+            with self.stage('add_image_stats'):
+                self.add_image_stats(cutout)
             if survey_name=="VLASS": # only label if not mosaicked for now in case multiple epochs
                 fits_data['epoch'] = self.get_epoch(fits_data['filename'])
             # add custom comments
@@ -675,9 +1051,12 @@ class SurveyABC(ABC):
         fits_data['download'] = cutout
         fits_data['out_dir'] = self.out_dir
         fits_data['overwrite'] = self.overwrite
+        fits_data['compression'] = self.compression
+        fits_data['quantize_level'] = self.quantize_level
         fits_data['group'] = group
         fits_data['survey'] = survey_name
         fits_data['filter'] = filter
+        fits_data['pid'] = self.pid
         fits_data['position'] = f"{position.ra.degree}, {position.dec.degree}"
         fits_data['radius'] = radius.value
         # fits_data['status'] = self.__pop_processing_status()
@@ -688,6 +1067,10 @@ class SurveyABC(ABC):
     def get_cutout(self, position, size, group_by="None"):
         if not group_by:
             group_by="None"
+        with self.stage('get_cutout'):
+            return self.__get_cutout(position, size, group_by)
+
+    def __get_cutout(self, position, size, group_by):
         self.processing_status = processing_status.fetching
         tiles   = self.get_tiles(position,size)
         if not tiles:
@@ -701,8 +1084,16 @@ class SurveyABC(ABC):
                     all_fits.append(self.process_tile_group([single], position, size, "None", groups_dict[group].index(single)))
             else:
                 all_fits = all_fits+[self.process_tile_group(groups_dict[group], position, size, group, 0)]
+        for f_dict in all_fits:
+            f_dict['group_by'] = group_by
         return all_fits
 
+    def get_filter_name(self):
+        try:
+            return self.get_filter_setting().name.lower()
+        except Exception as e:
+            return ""
+
     # abstract base class functions required by survey/child classes
     @staticmethod
     @abstractmethod
@@ -3,6 +3,7 @@ from astropy import units as u
 
 import csv, re, math
 import urllib.parse
+import numpy as np
 
 # for padding RA area with dec skew
 def ra_increment(increment, Dec1, Dec2=None):
@@ -59,6 +60,14 @@ def pad_string_lines(string):
         loc+=72
     return string
 
+# single early-exit pass for all-zero (i.e., empty) images: nb, NaN's count as data
+def is_all_zero(data, chunk_size=1 << 16):
+    flat = data.reshape(-1)
+    for start in range(0, flat.size, chunk_size):
+        if np.any(flat[start:start+chunk_size] != 0):
+            return False
+    return True
+
 def get_header_value(tile, value):
     if value in tile.header:
         return tile.header[value]
@@ -11,8 +11,8 @@ from astropy.time import Time
 from astropy.coordinates import SkyCoord
 from astropy.coordinates import Angle
 from astropy import units as u
-from astroquery.cadc import Cadc
-from .survey_abc import SurveyABC
+from .survey_abc import SurveyABC, get_thread_client
+from .http_transport import get_transport
 from .toolbox import pad_string_lines
 from .survey_filters import vlass_epoch
 
@@ -22,6 +22,8 @@ class VLASS(SurveyABC):
         super().__init__()
         self.needs_trimming = False
         self.filter = filter
+        # quick look subimage cutouts are at most a (~55 MB) tile
+        self.http_max_response_bytes = 128 * (1 << 20)
 
     @staticmethod
     def get_supported_filters():
@@ -62,8 +64,18 @@ class VLASS(SurveyABC):
                                 "), after=-1)
 
     # this will work for ANY collection from CADC
+    # one Cadc client per thread (not per task), as its TAP service lookup is a round trip of its own
+    @staticmethod
+    def get_cadc():
+        def get_client():
+            from astroquery.cadc import Cadc # nb: astroquery is slow to import, so only when needed
+            cadc = Cadc(auth_session=get_transport().get_session())
+            cadc.cadctap # nb: looks up the TAP service, once
+            return cadc
+        return get_thread_client('cadc', get_client)
+
     def get_tile_urls(self,position,size):
-        cadc = Cadc()
+        cadc = self.get_cadc()
         radius = (size/2.0).to(u.deg)
         urls = []
         # urls = cadc.get_images(
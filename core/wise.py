@@ -2,10 +2,9 @@ import re
 
 from astropy.table import Table
 from astropy import units as u
-from astroquery.ibe import IbeClass
 
 
-from .survey_abc import SurveyABC
+from .survey_abc import SurveyABC, get_thread_client
 from .survey_filters import wise_filters
 from .toolbox import pad_string_lines
 class WISE(SurveyABC):
@@ -15,6 +14,8 @@ class WISE(SurveyABC):
         self.metadata_root = 'p3am_cdd'
         self.url_root = f"https://irsa.ipac.caltech.edu/ibe/data/wise/allwise/{self.metadata_root}"
         self.needs_trimming = True
+        # full AllWISE atlas tiles are ~64 MB
+        self.http_max_response_bytes = 128 * (1 << 20)
 
     @staticmethod
     def get_supported_filters():
@@ -44,9 +45,17 @@ class WISE(SurveyABC):
             urls.append(f"{self.url_root}/{coaddgrp:s}/{coadd_ra:s}/{coadd_id:s}/{coadd_id}-{self.filter.name}-int-3.fits")
         return urls
 
+    # one IBE client (and keep-alive http session, astroquery's own) per thread
+    @staticmethod
+    def get_ibe():
+        def get_client():
+            from astroquery.ibe import IbeClass # nb: astroquery is slow to import, so only when needed
+            return IbeClass()
+        return get_thread_client('ibe', get_client)
+
     def get_tile_urls(self,position,size):
         #status = list()
-        wise = IbeClass()
+        wise = self.get_ibe()
         edge = size.to(u.deg)
         metadata = wise.query_region(
             coordinate = position,
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import uuid
+import socket
+
+
+#  S H A R E D   W O R K   Q U E U E
+#
+# A durable task queue in a folder on storage shared by several nodes (e.g.,
+# NFS), with no broker: every state change is an atomic rename within it,
+#
+#    queue/pending/<id>.json                     published, waiting for a worker
+#    queue/leased/<id>~<expires>~<worker>.json   leased, until acked or expired
+#    queue/done/<id>.json                        acked, with the task's result
+#    queue/failed/<id>.json                      out of attempts, with its errors
+#    queue/parked/<id>~<until>.json              set aside until then (e.g., its survey is down)
+#
+# so of several workers renaming the same file only one wins. A lease that
+# isn't renewed or acked in time (e.g., its node died) is put back to pending
+# by the next worker that finds it. Lease expiry times are wall clock, so the
+# nodes' clocks should agree (e.g., by NTP) to well within the lease time.
+# Tasks are JSON-able dicts; what's in them is up to the caller.
+#
+
+STATES = ['pending', 'leased', 'done', 'failed', 'parked']
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}".replace("~", "-").replace(os.sep, "-")
+
+
+class Lease:
+    """A leased task; path is its current file in leased/."""
+    def __init__(self, task_id, task, path, expires):
+        self.id = task_id
+        self.task = task
+        self.path = path
+        self.expires = expires
+
+
+class WorkQueue:
+    def __init__(self, root, worker_id=None):
+        self.root = root
+        self.worker_id = worker_id if worker_id else get_worker_id()
+        for folder in STATES+['tmp']:
+            os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    def __path(self, state, name):
+        return os.path.join(self.root, state, name)
+
+    # writes a file whole (into tmp/, then renamed into place)
+    def __write(self, state, name, record):
+        tmp = self.__path('tmp', f"{name}.{uuid.uuid4().hex}")
+        with open(tmp, 'w') as f:
+            json.dump(record, f, default=str)
+        os.rename(tmp, self.__path(state, name))
+
+    def publish(self, task):
+        """Adds a task; returns its id (ids sort in publishing order)."""
+        task_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        self.__write('pending', f"{task_id}.json", {'id': task_id, 'attempts': 0, 'errors': [], 'task': task})
+        return task_id
+
+    def __leased_name(self, task_id, expires):
+        return f"{task_id}~{expires:.3f}~{self.worker_id}.json"
+
+    def lease(self, lease_s=600.0):
+        """Leases the oldest pending task for lease_s seconds; None if there are none."""
+        pending = sorted(os.listdir(self.__path('pending', '')))
+        if not pending:
+            self.requeue_expired()
+            self.unpark()
+            pending = sorted(os.listdir(self.__path('pending', '')))
+        for name in pending:
+            task_id = name[:-len(".json")]
+            expires = time.time()+lease_s
+            path = self.__path('leased', self.__leased_name(task_id, expires))
+            try:
+                os.rename(self.__path('pending', name), path)
+            except OSError:
+                continue # another worker got it first
+            with open(path) as f:
+                record = json.load(f)
+            return Lease(task_id, record, path, expires)
+        return None
+
+    def renew(self, lease, lease_s=600.0):
+        """Extends a lease; False if it was lost (e.g., expired and requeued)."""
+        expires = time.time()+lease_s
+        path = self.__path('leased', self.__leased_name(lease.id, expires))
+        try:
+            os.rename(lease.path, path)
+        except OSError:
+            return False
+        (lease.path, lease.expires) = (path, expires)
+        return True
+
+    # takes a leased task out of the queue (into tmp/) before moving it on
+    def __claim(self, lease):
+        tmp = self.__path('tmp', f"{lease.id}.{self.worker_id}.json")
+        try:
+            os.rename(lease.path, tmp)
+        except OSError:
+            return None
+        return tmp
+
+    def ack(self, lease, result=None):
+        """Marks a leased task done; False if the lease was lost (nb: it
+           may then be run again elsewhere, so tasks should be idempotent)."""
+        tmp = self.__claim(lease)
+        if tmp is None:
+            return False
+        record = dict(lease.task, result=result, worker=self.worker_id, finished=time.time())
+        self.__write('done', f"{lease.id}.json", record)
+        os.remove(tmp)
+        return True
+
+    def fail(self, lease, error, max_attempts=3):
+        """Puts a leased task back to pending, or into failed/ once it has
+           had max_attempts; False if the lease was lost."""
+        tmp = self.__claim(lease)
+        if tmp is None:
+            return False
+        record = dict(lease.task, attempts=lease.task['attempts']+1,
+                      errors=lease.task['errors']+[f"{self.worker_id}: {error}"])
+        self.__write('pending' if record['attempts'] < max_attempts else 'failed', f"{lease.id}.json", record)
+        os.remove(tmp)
+        return True
+
+    def park(self, lease, park_s):
+        """Sets a leased task aside for park_s seconds, without using up an
+           attempt (e.g., while its survey's service is down); False if the
+           lease was lost."""
+        tmp = self.__claim(lease)
+        if tmp is None:
+            return False
+        record = dict(lease.task, parks=lease.task.get('parks', 0)+1)
+        self.__write('parked', f"{lease.id}~{time.time()+park_s:.3f}.json", record)
+        os.remove(tmp)
+        return True
+
+    def unpark(self):
+        """Puts parked tasks whose time is up back to pending; returns how many."""
+        now = time.time()
+        unparked = 0
+        for name in os.listdir(self.__path('parked', '')):
+            try:
+                (task_id, until) = name[:-len(".json")].split("~", 1)
+                if float(until) > now:
+                    continue
+                os.rename(self.__path('parked', name), self.__path('pending', f"{task_id}.json"))
+                unparked += 1
+            except (ValueError, OSError):
+                continue
+        return unparked
+
+    def requeue_expired(self):
+        """Puts expired leases back to pending; returns how many."""
+        now = time.time()
+        requeued = 0
+        for name in os.listdir(self.__path('leased', '')):
+            try:
+                (task_id, expires, worker) = name.split("~", 2)
+                if float(expires) > now:
+                    continue
+                os.rename(self.__path('leased', name), self.__path('pending', f"{task_id}.json"))
+                requeued += 1
+            except (ValueError, OSError):
+                continue
+        return requeued
+
+    def get_counts(self):
+        return {state: len(os.listdir(self.__path(state, ''))) for state in STATES}
+
+    def is_drained(self):
+        """True once nothing is pending, leased or parked."""
+        counts = self.get_counts()
+        return counts['pending'] == 0 and counts['leased'] == 0 and counts['parked'] == 0
@@ -1,29 +1,62 @@
 # system
-import os, sys, traceback, signal
+import os, sys, stat, traceback, signal, glob
 # utilities
-import re, click, urllib3
+import re, json, click, urllib3
 import yaml as yml
 from datetime import datetime
 # threading
-import threading, queue
+import threading, queue, time, socketserver, socket, select
+from functools import partial
 # astropy
 from astropy.io import fits
 import astropy.units as u
 # configuration & processing
-from cli_config import CLIConfig
+from cli_config import CLIConfig, get_task_spec, get_task_from_spec
+from core.toolbox import extractCoordfromString
 from core.survey_abc import processing_status as ProcStatus, SurveyABC
+from core.fits_shards import FITSShardWriter
+from core.manifest import CutoutManifest
+from core.profiling import StageRecorder, NO_STAGE
+from core.metrics import CutoutMetrics, MetricsServer, StatsFileWriter, get_status_name
+from core.log_sink import LogSink, format_record
+from core.work_queue import WorkQueue
+from core.http_transport import HTTPTransport, set_transport
+from core.retry import get_circuit_breakers
+from core.hedging import Hedger, set_hedger
 
 LOG_FILE = "OutLOG.txt"
 
-#Global pool manager
+# logs to the sink if there is one (e.g., save_cutout called on its own just prints)
+def log(log_sink, level, msg, **fields):
+    if log_sink:
+        log_sink.log(level, msg, **fields)
+    else:
+        print(format_record(dict(fields, msg=msg)))
+
+# structured log fields of a task (a target dict) or a saver's list of cutout dicts
+def get_log_fields(task):
+    if isinstance(task, dict) and isinstance(task.get('survey'), SurveyABC):
+        survey = task['survey']
+        return {'pid': task.get('pid'), 'survey': type(survey).__name__, 'filter': survey.get_filter_name()}
+    if isinstance(task, list) and task and isinstance(task[0], dict):
+        return {'pid': task[0].get('pid'), 'survey': task[0].get('survey'), 'filter': task[0].get('filter')}
+    return {}
+
+#Global pool manager: the pooled transport of every survey request (incl. astroquery's)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-http = urllib3.PoolManager(
+http = set_transport(HTTPTransport(
     num_pools = 60,
     maxsize   = 15,
     timeout   = 120.0,
     retries   = 3,
     block     = True
-)
+))
+
+# sizes the transport's pools (and whether it verifies certificates), and sets up the hosts' circuit breakers and any hedging, as configured
+def configure_http(cfg):
+    http.configure(cfg.http_connections, cfg.http_host_connections, cfg.http_verify)
+    get_circuit_breakers().configure(cfg.breaker_failures, cfg.breaker_reset_s)
+    set_hedger(Hedger(cfg.hedge_percentile, cfg.hedge_budget) if cfg.hedge_percentile else None)
 
 def set_sig_handler(threads):
     def sig_handler(sig, frame):
@@ -41,12 +74,66 @@ class PoisonPill:
     def __init__(self):
         pass
 
+# bytes of image data held by a list of cutout dicts (the cutouts and their original tiles)
+def get_hdu_bytes(all_fits):
+    if not isinstance(all_fits, list):
+        return 0
+    nbytes = 0
+    for f_dict in all_fits:
+        if not f_dict:
+            continue
+        hdus = [f_dict.get('download')]+[og.get('tile') for og in f_dict.get('originals', {}).values()]
+        nbytes += sum([hdu.data.nbytes for hdu in hdus if hdu is not None and hdu.data is not None])
+    return nbytes
+
+# a queue bounded by item count and by the bytes of HDU data it holds: put()
+# blocks until there is room for both. An item larger than max_bytes is still
+# let in when the queue is otherwise empty, so it can't wedge the pipeline.
+class HDUQueue(queue.Queue):
+    def __init__(self, maxsize=0, max_bytes=0):
+        super().__init__(maxsize)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+
+    def __is_full(self, nbytes):
+        return (0 < self.maxsize <= self._qsize()) or \
+               (0 < self.max_bytes < self.nbytes+nbytes and self._qsize() > 0)
+
+    def put(self, item, block=True, timeout=None):
+        nbytes = get_hdu_bytes(item)
+        with self.not_full:
+            if not block:
+                if self.__is_full(nbytes):
+                    raise queue.Full
+            elif timeout is None:
+                while self.__is_full(nbytes):
+                    self.not_full.wait()
+            else:
+                if not self.not_full.wait_for(lambda: not self.__is_full(nbytes), timeout):
+                    raise queue.Full
+            self._put((nbytes, item))
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _put(self, sized_item):
+        self.nbytes += sized_item[0]
+        self.queue.append(sized_item)
+
+    def _get(self):
+        nbytes, item = self.queue.popleft()
+        self.nbytes -= nbytes
+        # a freed byte budget may let more than one blocked producer through
+        self.not_full.notify_all()
+        return item
+
 class WorkerThread(threading.Thread):
-    def __init__(self, worker, input_q, output_q=None, *args, **kwargs):
+    def __init__(self, worker, input_q, output_q=None, log_sink=None, *args, **kwargs):
         self.input_q = input_q
         self.output_q = output_q
         self.worker = worker
+        self.log_sink = log_sink
         self.kill_recieved = False
+        self.failed = 0
         super().__init__(*args, **kwargs)
 
     def run(self):
@@ -61,55 +148,83 @@ class WorkerThread(threading.Thread):
 
                 if self.output_q:
                     self.output_q.put(item=ret)
-            #catch running exception and kill
+            # a failed task is logged and counted, and the thread goes on to the next one
+            # (nb: e.g., its host's circuit breaker is open, while other surveys' are fine)
             except Exception as e:
-                msg = task['survey'].sprint(f"{str(e)} killing thread\n\n")
-                try:
-                    date_mark = str(datetime.now()) + ": "
-                    with open(LOG_FILE, "a") as logfile:
-                        logfile.write("\n\n"+date_mark+msg)
-                        logfile.close()
-                except:
-                    print("Unable to write error to log: " + msg)
-                # print("ret", ret)
-                print(msg)
-                self.die()
-                # self.input_q.task_done()
+                fields = get_log_fields(task)
+                if 'survey' in fields and isinstance(task, dict):
+                    fields['status'] = get_status_name(task['survey'].processing_status)
+                log(self.log_sink, 'error', f"{str(e)} skipping task", **fields)
+                self.failed += 1
             self.input_q.task_done()
 
         if self.kill_recieved:
-            try:
-                task['survey'].print("Bye!")
-            except:
-                print("Bye!")
+            log(self.log_sink, 'debug', "Bye!", **get_log_fields(task))
             self.input_q.task_done()
 
     def die(self):
         self.kill_recieved = True
 
 # grab a FITS hdu from some survey
-def get_cutout(target):
+def get_cutout(target, renderer=None, metrics=None, log_sink=None):
     # all fits is list of one or more dicts
-    all_fits = target['survey'].set_pid(target['pid']).get_cutout(target['position'], target['size'], target['group_by'])
+    start = time.perf_counter()
+    try:
+        all_fits = target['survey'].set_pid(target['pid']).get_cutout(target['position'], target['size'], target['group_by'])
+    except:
+        # nb: so the other bands of its RGB composites aren't held for it
+        if renderer:
+            renderer.drop(target)
+        raise
+    finally:
+        if metrics:
+            metrics.add_task(target['survey'].processing_status)
+    log(log_sink, 'debug', "Fetched", stage='fetch', duration_s=round(time.perf_counter()-start, 4),
+        status=get_status_name(target['survey'].processing_status), cutouts=len(all_fits), **get_log_fields(target))
+    # render images from the in-memory cutouts while they go on to be saved
+    if renderer:
+        renderer.submit(all_fits, target)
     return all_fits
 
-def save_cutout(all_fits):
+# times a saver stage of a task's cutouts, if recording
+def get_save_stage(recorder, f_dict, name):
+    if recorder is None:
+        return NO_STAGE
+    return recorder.stage(name, pid=f_dict.get('pid'), survey=f_dict['survey'], filter=f_dict['filter'])
+
+def save_cutout(all_fits, shards=None, manifest=None, recorder=None, metrics=None, log_sink=None):
     originals_end="_ORIGINALS"
+    start = time.perf_counter()
+    fields = get_log_fields(all_fits)
     try:
-        saved_fits = SurveyABC.save_and_serialize(all_fits, originals_path_end=originals_end)
-        msg = f"{all_fits[0]['survey']}({all_fits[0]['filter']}): [Position:{all_fits[0]['position']} at "\
-            f"radius {all_fits[0]['radius']} arcmin]: All Output Files Successfully Saved!"
-        date_mark = str(datetime.now()) + ": "
-        with open(LOG_FILE, "a") as logfile:
-            logfile.write("\n\n"+date_mark+msg)
-            logfile.close()
-        print(msg)
+        cutouts = len([f_dict for f_dict in all_fits if f_dict and f_dict.get('download')])
+        stage = partial(get_save_stage, recorder, all_fits[0])
+        if shards:
+            with stage('write_shards'):
+                rows = [(f_dict, row) for f_dict in all_fits for row in shards.add(f_dict)]
+            if manifest:
+                with stage('register'):
+                    for (f_dict, row) in rows:
+                        if row['role'] == 'cutout':
+                            manifest.register(f_dict, os.path.join(shards.out_dir, row['shard']), row['extension'], row['nbytes'], row['sha1'])
+        else:
+            downloaded = [f_dict for f_dict in all_fits if f_dict['download']]
+            with stage('save_and_serialize'):
+                saved_fits = SurveyABC.save_and_serialize(all_fits, originals_path_end=originals_end)
+            if manifest:
+                with stage('register'):
+                    for f_dict in downloaded:
+                        manifest.register(f_dict, nbytes=f_dict.get('nbytes'), sha1=f_dict.get('sha1'))
+        if metrics:
+            metrics.add_saved(cutouts)
+        log(log_sink, 'info', f"[Position:{all_fits[0]['position']} at radius {all_fits[0]['radius']} arcmin]: "
+            "All Output Files Successfully Saved!", stage='save', status='saved', cutouts=cutouts,
+            duration_s=round(time.perf_counter()-start, 4), **fields)
+        return True
     except Exception as e:
-        print("Unable to save ")
-        date_mark = str(datetime.now()) + ": "
-        with open(LOG_FILE, "a") as logfile:
-            logfile.write("\n\n"+date_mark+str(e))
-            logfile.close()
+        log(log_sink, 'error', f"Unable to save: {e}", stage='save', status='error',
+            duration_s=round(time.perf_counter()-start, 4), **fields)
+        return False
 
 
 
@@ -125,6 +240,34 @@ def read_in_config(yml_file):
         params['output'] = file_data['configuration']['output']
         params['overwrite'] = file_data['configuration']['overwrite']
         params['flush'] = file_data['configuration']['flush']
+        params['savers'] = file_data['configuration'].get('savers')
+        params['max_queued_mb'] = file_data['configuration'].get('max_queued_mb')
+        params['compression'] = file_data['configuration'].get('compression')
+        params['quantize_level'] = file_data['configuration'].get('quantize_level')
+        params['container'] = file_data['configuration'].get('container', False)
+        params['shard_mb'] = file_data['configuration'].get('shard_mb')
+        params['skip_existing'] = file_data['configuration'].get('skip_existing', False)
+        params['render'] = file_data['configuration'].get('render')
+        params['render_workers'] = file_data['configuration'].get('render_workers')
+        params['trace'] = file_data['configuration'].get('trace')
+        params['metrics_port'] = file_data['configuration'].get('metrics_port')
+        params['stats_file'] = file_data['configuration'].get('stats_file')
+        params['stats_interval'] = file_data['configuration'].get('stats_interval')
+        params['verbosity'] = file_data['configuration'].get('verbosity')
+        params['log_file'] = file_data['configuration'].get('log_file')
+        params['http_connections'] = file_data['configuration'].get('http_connections')
+        params['http_host_connections'] = file_data['configuration'].get('http_host_connections')
+        params['http_verify'] = file_data['configuration'].get('http_verify')
+        params['http_retries'] = file_data['configuration'].get('http_retries')
+        params['breaker_failures'] = file_data['configuration'].get('breaker_failures')
+        params['breaker_reset_s'] = file_data['configuration'].get('breaker_reset_s')
+        params['hedge_percentile'] = file_data['configuration'].get('hedge_percentile')
+        params['hedge_budget'] = file_data['configuration'].get('hedge_budget')
+        params['socket'] = file_data['configuration'].get('socket')
+        params['spool'] = file_data['configuration'].get('spool')
+        params['queue'] = file_data['configuration'].get('queue')
+        params['lease_s'] = file_data['configuration'].get('lease_s')
+        params['max_attempts'] = file_data['configuration'].get('max_attempts')
     except Exception as e:
         print("YAML file read error: " +str(e))
         return None
@@ -142,15 +285,41 @@ def check_batch_csv(batch_files_string):
 def process_requests(cfg):
     start = datetime.now()
     grabbers = 15
-    # set up i/o queues
+    # set up i/o queues: grabbers block once the unsaved cutouts hit the
+    # out queue's item or byte budget (nb: the savers' in-hand items aside)
     in_q  = queue.Queue()
-    out_q = queue.Queue()
+    out_q = HDUQueue(cfg.max_queued_items, cfg.max_queued_bytes)
+    configure_http(cfg)
 
     # toss all the targets into the queue, including for all surveys
     # i.e., some position in both NVSS and VLASS and SDSS, etc.
+    # record of saved cutouts, for lookups and reruns
+    manifest = CutoutManifest(cfg.get_manifest_file())
+    # all the run's messages go through one queued writer
+    log_sink = LogSink(cfg.log_file, LOG_FILE, cfg.verbosity)
+    # per stage timings, if tracing
+    recorder = StageRecorder() if cfg.trace_file else None
+    # live metrics, if they're to be served or written
+    metrics = CutoutMetrics() if cfg.metrics_port or cfg.stats_file else None
+    skipped = 0
     for task in cfg.get_procssing_stack():
-        task['survey'].attach_http_pool_manager(http)
+        if cfg.skip_existing and manifest.has_task(task):
+            skipped += 1
+            continue
+        task['survey'].attach_http_pool_manager(http).set_stage_recorder(recorder).set_metrics(metrics).set_log_sink(log_sink)
         in_q.put(task)
+    if skipped:
+        print(f"Skipped {skipped} target(s) already in {cfg.get_manifest_file()}")
+    metrics_server, stats_writer = None, None
+    if metrics:
+        metrics.set_tasks_queued(in_q.qsize())
+        metrics.add_queue('in', in_q)
+        metrics.add_queue('out', out_q)
+        if cfg.metrics_port:
+            metrics_server = MetricsServer(metrics, cfg.metrics_port)
+            print(f"Serving metrics at {metrics_server.get_url()}")
+        if cfg.stats_file:
+            stats_writer = StatsFileWriter(metrics, cfg.stats_file, cfg.stats_interval_s)
 
     # need this for ctrl-c shutdown
     threads = list()
@@ -158,23 +327,52 @@ def process_requests(cfg):
     # spin up a bunch of worker threads to process all the data
     # in principle these could be chained furprint(str(e), "killing thread")
     # targets -> hdus -> save to file -> process to jpg -> save to file
+    renderer = None
+    if cfg.render_format:
+        from core.render import RenderStage # nb: only imported (with its plotting deps) when rendering
+        # nb: the bands awaiting RGB composites get a budget of their own, as big as the out queue's
+        renderer = RenderStage(cfg.render_workers, cfg.render_format, cfg.get_rgb_filters(), cfg.max_queued_bytes)
     for _ in range(grabbers):
-        thread = WorkerThread(get_cutout, in_q, out_q)
+        thread = WorkerThread(partial(get_cutout, renderer=renderer, metrics=metrics, log_sink=log_sink), in_q, out_q, log_sink)
         in_q.put(PoisonPill())
         threads.append(thread)
         thread.start()
 
     # save all from out queue as added there
-    thread = WorkerThread(save_cutout, out_q)#.start()
-    threads.append(thread)
+    shards = FITSShardWriter(cfg.get_shards_dir(), cfg.shard_bytes) if cfg.container else None
+    savers = [WorkerThread(partial(save_cutout, shards=shards, manifest=manifest, recorder=recorder, metrics=metrics, log_sink=log_sink), out_q, None, log_sink) for _ in range(cfg.save_workers)]
+    threads.extend(savers)
     set_sig_handler(threads) # install ctrl-c handler
-    thread.start()
+    for thread in savers:
+        thread.start()
     in_q.join()
 
-    out_q.put(PoisonPill()) # add killmessage to end of queue
+    for _ in savers:
+        out_q.put(PoisonPill()) # add killmessage to end of queue
     out_q.join()
+    if shards:
+        shards.close()
+        print(f"Cutouts written to FITS shards in {cfg.get_shards_dir()}")
+    manifest.close()
+    failed = sum([thread.failed for thread in threads])
+    if failed:
+        print(f"{failed} task(s) failed (see {cfg.log_file})")
+    if renderer:
+        rendered, errors = renderer.close()
+        print(f"Rendered {len(rendered)} image(s)")
+        for e in errors:
+            log_sink.error(f"Render error: {e}", stage='render')
+
+    if stats_writer:
+        stats_writer.close()
+    if metrics_server:
+        metrics_server.close()
+    log_sink.close()
 
     print("time took: " +str(datetime.now()-start))
+    if recorder:
+        print(recorder.format_summary())
+        print(f"Stage trace written to {recorder.write_trace(cfg.trace_file)} (open in chrome://tracing or ui.perfetto.dev)")
 
 def check_group_by_string(group_by):
     case_match = group_by.upper()
@@ -186,6 +384,30 @@ def check_group_by_string(group_by):
     else:
         raise Exception(f"group_by argument {group_by} is invalid!\n Valid group by options are: MOSAIC, NONE, DATE-OBS")
 
+def check_render_string(render_format):
+    case_match = render_format.upper()
+    if case_match == "NONE":
+        return None
+    if case_match in ["PNG", "JPEG", "JPG"]:
+        return case_match.lower()
+    raise Exception(f"render argument {render_format} is invalid!\n Valid render options are: NONE, PNG, JPEG")
+
+def check_compression_string(compression):
+    methods = {
+        "RICE": "RICE_1",
+        "GZIP": "GZIP_1",
+        "GZIP2": "GZIP_2",
+        "HCOMPRESS": "HCOMPRESS_1",
+    }
+    case_match = compression.upper().replace("-","_")
+    if case_match == "NONE":
+        return None
+    if case_match in methods:
+        return methods[case_match]
+    if case_match in methods.values():
+        return case_match
+    raise Exception(f"compression argument {compression} is invalid!\n Valid compression options are: NONE, RICE, GZIP, GZIP2, HCOMPRESS")
+
 def parse_surveys_string(surveys):
     # regex to match if filters in brackets next to survey name
     # e.g. WISE[w1],SDSS(g,r,i)
@@ -194,6 +416,639 @@ def parse_surveys_string(surveys):
     else:
         return []
 
+#  C U T O U T   S E R V I C E
+#
+# `fetch_cutouts.py serve` keeps one process up, with its imports, http pool,
+# manifest, log sink and grabber/saver threads warm, and runs jobs submitted
+# as JSON lines (one job per line), e.g.,
+#
+#    {"id": "j1", "coords": "150.1, 2.2", "radius": 1, "surveys": "VLASS,WISE[w1]", "groupby": "MOSAIC"}
+#    {"id": "j2", "targets": [{"name": "M87"}, {"coords": "10.68 41.27"}], "radius": 2}
+#
+# over a unix socket, with the results streamed back on the connection, and/or
+# as *.jsonl files moved into a spool folder, with the results written to
+# <file>.results.jsonl. Each task gets a result line as soon as it's saved,
+#
+#    {"job": "j1", "pid": 7, "survey": "VLASS", "filter": "", "position": "150.1, 2.2",
+#     "status": "done", "files": ["/.../VLASS/...fits"], "duration_s": 1.93}
+#
+# and each job ends with {"job": "j1", "done": true, "tasks": 2, "failed": 0, "duration_s": 2.41}.
+# Jobs may also set surveys, groupby, overwrite, compress, quantize and skip_existing;
+# anything left out takes the service's setting.
+#
+
+# task statuses that don't fail a job ('none' is no survey coverage, 'exists' a skipped task)
+SERVICE_OK_STATUSES = ['done', 'none', 'exists']
+
+class ServiceJob:
+    """A submitted job: counts down its tasks' results, passing each to emit()."""
+    def __init__(self, job_id, emit):
+        self.id = job_id
+        self.emit = emit
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.tasks = 0
+        self.failed = 0
+        self.start = time.perf_counter()
+        self.finished = threading.Event()
+
+    def set_tasks(self, count):
+        self.pending = self.tasks = count
+        if count == 0:
+            self.finish()
+
+    def add_result(self, result):
+        self.emit(dict({'job': self.id}, **result))
+        with self.lock:
+            self.pending -= 1
+            if not result['status'] in SERVICE_OK_STATUSES:
+                self.failed += 1
+            last = self.pending == 0
+        if last:
+            self.finish()
+
+    def finish(self, error=None):
+        summary = {'job': self.id, 'done': True, 'tasks': self.tasks, 'failed': self.failed,
+                   'duration_s': round(time.perf_counter()-self.start, 4)}
+        if error:
+            summary['error'] = error
+        self.emit(summary)
+        self.finished.set()
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+# result line of a task (an entry of CutoutService.tasks)
+def get_task_result(task, status, files=None, error=None):
+    survey = task['survey']
+    position = task['position']
+    result = {'pid': task['pid'], 'survey': type(survey).__name__, 'filter': survey.get_filter_name(),
+              'position': f"{position.ra.degree}, {position.dec.degree}", 'status': status,
+              'files': files or [], 'duration_s': round(time.perf_counter()-task['start'], 4)}
+    if error:
+        result['error'] = error
+    return result
+
+class CutoutService:
+    """Runs service jobs on long lived grabber and saver threads (see above).
+       cfg is the service's CLIConfig: its output folder, savers, queue
+       budget, logging and metrics settings are shared by all jobs, and the
+       rest are defaults for them."""
+    def __init__(self, cfg, surveys=None, size=None, grabbers=15):
+        self.cfg = cfg
+        self.surveys = surveys
+        self.size = size
+        self.in_q  = queue.Queue()
+        self.out_q = HDUQueue(cfg.max_queued_items, cfg.max_queued_bytes)
+        configure_http(cfg)
+        self.manifest = CutoutManifest(cfg.get_manifest_file())
+        self.log_sink = LogSink(cfg.log_file, LOG_FILE, cfg.verbosity)
+        self.metrics = CutoutMetrics() if cfg.metrics_port or cfg.stats_file else None
+        self.metrics_server, self.stats_writer = None, None
+        if self.metrics:
+            self.metrics.add_queue('in', self.in_q)
+            self.metrics.add_queue('out', self.out_q)
+            if cfg.metrics_port:
+                self.metrics_server = MetricsServer(self.metrics, cfg.metrics_port)
+                print(f"Serving metrics at {self.metrics_server.get_url()}")
+            if cfg.stats_file:
+                self.stats_writer = StatsFileWriter(self.metrics, cfg.stats_file, cfg.stats_interval_s)
+        # queued and in hand tasks by pid, which is unique over the service's lifetime
+        self.lock = threading.Lock()
+        self.tasks = dict()
+        self.next_pid = 0
+        self.closing = False
+        self.grabbers = [WorkerThread(self.grab, self.in_q, self.out_q, self.log_sink, daemon=True) for _ in range(grabbers)]
+        self.savers = [WorkerThread(self.save, self.out_q, None, self.log_sink, daemon=True) for _ in range(cfg.save_workers)]
+        for thread in self.grabbers+self.savers:
+            thread.start()
+
+    # a job's configuration: the service's, with the job's overrides
+    def get_job_config(self, job):
+        surveys = job.get('surveys', self.surveys)
+        if isinstance(surveys, str):
+            surveys = parse_surveys_string(surveys)
+        group_by = job.get('groupby', job.get('group_by', self.cfg.group_by))
+        if isinstance(group_by, str):
+            group_by = check_group_by_string(group_by)
+        size = job['radius']*2 if job.get('radius') else self.size
+        if not size:
+            raise Exception("radius required (the service has no default radius)")
+        if job.get('targets'):
+            targets = job['targets']
+        elif job.get('coords') or job.get('name'):
+            targets = [job]
+        else:
+            raise Exception("coords, name or targets required")
+        positions = list()
+        for target in targets:
+            if bool(target.get('coords')) == bool(target.get('name')):
+                raise Exception(f"target {target} must have ONE of coords or name")
+            if target.get('name'):
+                positions.append(extractCoordfromString(target['name'], True))
+            else:
+                positions.append(extractCoordfromString(str(target['coords'])))
+        cfg = CLIConfig(surveys, self.cfg.data_out, group_by)
+        if not cfg.survey_names:
+            raise Exception(f"no supported surveys in {surveys}")
+        cfg.set_targets(positions, size)
+        cfg.set_overwrite(job.get('overwrite', self.cfg.overwrite))
+        compression = job.get('compress', self.cfg.compression)
+        if isinstance(compression, str):
+            compression = check_compression_string(compression)
+        cfg.set_compression(compression, job.get('quantize', self.cfg.quantize_level))
+        cfg.set_skip_existing(job.get('skip_existing', self.cfg.skip_existing))
+        cfg.set_http_retries(self.cfg.http_retries)
+        return cfg
+
+    def submit(self, line, emit):
+        """Queues the tasks of a JSON job line; returns its ServiceJob."""
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise Exception("a job must be a JSON object")
+        except Exception as e:
+            job = {}
+            error = f"Invalid job: {e}"
+        else:
+            error = None
+        service_job = ServiceJob(job.get('id', f"job-{time.time():.6f}"), emit)
+        if error:
+            service_job.finish(error)
+            return service_job
+        try:
+            cfg = self.get_job_config(job)
+            stack = cfg.get_procssing_stack()
+        except Exception as e:
+            service_job.finish(f"Invalid job: {e}")
+            return service_job
+        queued, skipped = list(), list()
+        with self.lock:
+            # nb: nothing may be queued behind close()'s poison pills
+            if self.closing:
+                service_job.finish("The service is stopping")
+                return service_job
+            service_job.set_tasks(len(stack))
+            for task in stack:
+                task['pid'] = self.next_pid
+                task['start'] = time.perf_counter()
+                self.next_pid += 1
+                if cfg.skip_existing and self.manifest.has_task(task):
+                    skipped.append(task)
+                    continue
+                task['survey'].attach_http_pool_manager(http).set_metrics(self.metrics).set_log_sink(self.log_sink)
+                self.tasks[task['pid']] = (service_job, task)
+                self.in_q.put(task)
+                queued.append(task)
+            if self.metrics:
+                self.metrics.set_tasks_queued(self.next_pid)
+        log(self.log_sink, 'info', f"Job {service_job.id}: {len(queued)} task(s) queued, {len(skipped)} skipped")
+        for task in skipped:
+            service_job.add_result(get_task_result(task, 'exists'))
+        return service_job
+
+    def finish_task(self, pid, status, files=None, error=None):
+        with self.lock:
+            (service_job, task) = self.tasks.pop(pid)
+        service_job.add_result(get_task_result(task, status, files, error))
+
+    # grabber worker: a failed task is reported (rather than killing the thread)
+    def grab(self, task):
+        try:
+            all_fits = get_cutout(task, metrics=self.metrics, log_sink=self.log_sink)
+        except Exception as e:
+            status = get_status_name(task['survey'].processing_status)
+            log(self.log_sink, 'error', str(e), status=status, **get_log_fields(task))
+            self.finish_task(task['pid'], status, error=str(e))
+            return None
+        if not all_fits:
+            self.finish_task(task['pid'], get_status_name(task['survey'].processing_status))
+            return None
+        return all_fits
+
+    # saver worker
+    def save(self, all_fits):
+        if not all_fits:
+            return
+        pid = all_fits[0]['pid']
+        with self.lock:
+            task = self.tasks[pid][1]
+        if save_cutout(all_fits, manifest=self.manifest, metrics=self.metrics, log_sink=self.log_sink):
+            files = [f_dict['download_path'] for f_dict in all_fits if f_dict and f_dict.get('download_path')]
+            self.finish_task(pid, get_status_name(task['survey'].processing_status), files)
+        else:
+            self.finish_task(pid, 'error', error="Unable to save")
+
+    def close(self):
+        """Finishes the queued tasks and shuts down."""
+        with self.lock:
+            self.closing = True
+        for _ in self.grabbers:
+            self.in_q.put(PoisonPill())
+        self.in_q.join()
+        for _ in self.savers:
+            self.out_q.put(PoisonPill())
+        self.out_q.join()
+        self.manifest.close()
+        if self.stats_writer:
+            self.stats_writer.close()
+        if self.metrics_server:
+            self.metrics_server.close()
+        self.log_sink.close()
+
+# a connection's (or spool file's) results: emit() queues them as JSON lines
+# for a writer thread of its own, so the grabbers and savers calling it are
+# never held up by a slow reader; once write fails (e.g., a send timed out)
+# or max_lines are waiting, the reader is dropped, drop() is called (e.g., to
+# disconnect it), and later results are discarded (its jobs still run to
+# completion)
+class LineWriter(threading.Thread):
+    def __init__(self, write, max_lines=1000, drop=None):
+        super().__init__(name="LineWriter", daemon=True)
+        self.write = write
+        self.drop = drop
+        self.lines = queue.Queue(max_lines)
+        self.dropped = threading.Event()
+        self.start()
+
+    def emit(self, record):
+        if self.dropped.is_set():
+            return
+        try:
+            self.lines.put_nowait(json.dumps(record, default=str)+"\n")
+        except queue.Full:
+            self.__drop()
+
+    def __drop(self):
+        if not self.dropped.is_set():
+            self.dropped.set()
+            if self.drop:
+                self.drop()
+
+    def run(self):
+        while True:
+            line = self.lines.get()
+            if line is None:
+                return
+            if self.dropped.is_set():
+                continue
+            try:
+                self.write(line)
+            except OSError:
+                self.__drop()
+
+    def close(self):
+        """Waits for the queued lines to be written (or dropped)."""
+        self.lines.put(None) # nb: the writer drains the queue, even once dropped
+        self.join()
+        self.dropped.set() # nb: nothing's written after this
+
+# sends all of data on a (blocking) socket, raising socket.timeout if the
+# peer hasn't taken it within timeout_s (nb: the socket's own timeout would
+# apply to its reads as well)
+def send_all(connection, data, timeout_s):
+    view = memoryview(data)
+    deadline = time.monotonic()+timeout_s
+    while view:
+        (readable, writable, failed) = select.select([], [connection], [], max(0.0, deadline-time.monotonic()))
+        if not writable:
+            raise socket.timeout(f"client took no results for {timeout_s}s")
+        try:
+            view = view[connection.send(view, socket.MSG_DONTWAIT):]
+        except BlockingIOError:
+            pass
+
+# runs each job of a stream of JSON lines, waiting for them all
+def run_job_lines(service, lines, emit):
+    jobs = [service.submit(line, emit) for line in lines if line.strip()]
+    for job in jobs:
+        job.wait()
+    return jobs
+
+class JobStreamHandler(socketserver.StreamRequestHandler):
+    """A socket connection: jobs in, results out, until the client's done sending and all its jobs are."""
+    def handle(self):
+        writer = LineWriter(lambda line: send_all(self.connection, line.encode('utf-8'), self.server.send_timeout_s),
+                            self.server.max_lines, self.disconnect)
+        try:
+            run_job_lines(self.server.service, (line.decode('utf-8') for line in self.rfile), writer.emit)
+        finally:
+            writer.close()
+
+    # drops a client that stopped taking its results (nb: its jobs carry on)
+    def disconnect(self):
+        log(self.server.service.log_sink, 'warning', "Dropped a client that stopped reading its results")
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class JobSocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Takes jobs on a unix socket; a client that takes no results for
+       send_timeout_s, or falls max_lines behind, is disconnected."""
+    daemon_threads = True
+
+    def __init__(self, path, service, send_timeout_s=30.0, max_lines=1000):
+        # nb: a socket file left by a dead service would block the bind (but
+        # anything else at the path, e.g., from a mistyped option, is left be)
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise Exception(f"{path} exists and isn't a socket: not replacing it")
+            os.remove(path)
+        self.service = service
+        self.send_timeout_s = send_timeout_s
+        self.max_lines = max_lines
+        super().__init__(path, JobStreamHandler)
+
+# watches a spool folder for *.jsonl job files: each is claimed by renaming
+# it to .working, its results are written to .results.jsonl, and it is
+# renamed to .done once all its jobs are (nb: write job files elsewhere, or
+# under another extension, and move them in, so they're never read half written)
+class SpoolWatcher(threading.Thread):
+    def __init__(self, service, spool_dir, interval_s=1.0):
+        super().__init__(name="SpoolWatcher", daemon=True)
+        self.service = service
+        self.spool_dir = spool_dir
+        self.interval_s = interval_s
+        self.stopped = threading.Event()
+        self.runs = list()
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval_s):
+            for path in sorted(glob.glob(os.path.join(self.spool_dir, "*.jsonl"))):
+                if path.endswith(".results.jsonl"):
+                    continue
+                base = path[:-len(".jsonl")]
+                try:
+                    os.rename(path, base+".working")
+                except OSError:
+                    continue # e.g., claimed by another service
+                thread = threading.Thread(target=self.run_file, args=(base,), daemon=True)
+                self.runs.append(thread)
+                thread.start()
+
+    def run_file(self, base):
+        with open(base+".working") as jobs, open(base+".results.jsonl", 'a') as results:
+            def write(line):
+                results.write(line)
+                results.flush()
+            writer = LineWriter(write)
+            try:
+                run_job_lines(self.service, jobs.readlines(), writer.emit)
+            finally:
+                writer.close()
+        os.rename(base+".working", base+".done")
+
+    def close(self):
+        self.stopped.set()
+        self.join()
+        for thread in self.runs:
+            thread.join()
+
+#  W O R K   Q U E U E   W O R K E R S
+#
+# `publish` puts a run's processing stack into a work queue folder on storage
+# shared by several nodes, and `work`, on any number of them, leases the
+# tasks, fetches and saves them as fetch does, and acks them, e.g.,
+#
+#    node0$ python3 fetch_cutouts.py publish -q /shared/queue -f targets.csv -r 1 -o /shared/out
+#    nodeN$ python3 fetch_cutouts.py work -q /shared/queue
+#
+# Leases are renewed while their tasks are in hand, so only a dead worker's
+# expire (and get picked up again); a failed task goes back to pending until
+# it has had max_attempts, and a task with no survey coverage is just done.
+#
+
+class QueueWorker:
+    """Runs a WorkQueue's tasks on grabber and saver threads until the queue
+       is drained (or, if waiting, until stopped)."""
+    def __init__(self, work_queue, cfg, grabbers=15, lease_s=600.0, max_attempts=3, wait=False, poll_s=5.0, max_parks=10):
+        self.work_queue = work_queue
+        self.cfg = cfg
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        # tasks of a survey whose service is down are parked (for a breaker reset) this many times before they fail
+        self.max_parks = max_parks
+        self.wait = wait
+        self.poll_s = poll_s
+        # nb: tasks are only leased as grabbers come free
+        self.in_q  = queue.Queue(grabbers)
+        self.out_q = HDUQueue(cfg.max_queued_items, cfg.max_queued_bytes)
+        configure_http(cfg)
+        self.log_sink = LogSink(cfg.log_file, LOG_FILE, cfg.verbosity)
+        self.metrics = CutoutMetrics() if cfg.metrics_port or cfg.stats_file else None
+        # leases of the tasks in hand, by pid; held while renaming their files
+        self.lock = threading.Lock()
+        self.leases = dict()
+        self.counts = {'acked': 0, 'failed': 0, 'parked': 0, 'lost': 0}
+        self.stopped = threading.Event()
+        self.grabbers = [WorkerThread(self.grab, self.in_q, self.out_q, self.log_sink) for _ in range(grabbers)]
+        self.savers = [WorkerThread(self.save, self.out_q, None, self.log_sink) for _ in range(cfg.save_workers)]
+
+    def stop(self):
+        """Stops leasing tasks; those in hand are finished."""
+        self.stopped.set()
+
+    # leases tasks into the in queue
+    def feed(self):
+        pid = 0
+        while not self.stopped.is_set():
+            lease = self.work_queue.lease(self.lease_s)
+            if lease is None:
+                if not self.wait and self.work_queue.is_drained():
+                    break
+                self.stopped.wait(self.poll_s)
+                continue
+            try:
+                task = get_task_from_spec(lease.task['task'], pid)
+            except Exception as e:
+                with self.lock:
+                    self.counts['failed'] += self.work_queue.fail(lease, f"Invalid task: {e}", self.max_attempts)
+                continue
+            task['survey'].attach_http_pool_manager(http).set_metrics(self.metrics).set_log_sink(self.log_sink)
+            self.cfg.set_survey_http_retries(task['survey'])
+            with self.lock:
+                self.leases[pid] = lease
+            pid += 1
+            self.in_q.put(task)
+        for _ in self.grabbers:
+            self.in_q.put(PoisonPill())
+
+    # renews the leases in hand every quarter lease
+    def renew(self, done):
+        while not done.wait(self.lease_s/4):
+            with self.lock:
+                for lease in self.leases.values():
+                    if not self.work_queue.renew(lease, self.lease_s):
+                        log(self.log_sink, 'warning', f"Lost the lease on task {lease.id}")
+
+    def finish_task(self, pid, result=None, error=None, park=False):
+        with self.lock:
+            lease = self.leases.pop(pid)
+            if park and lease.task.get('parks', 0) < self.max_parks:
+                finished = self.work_queue.park(lease, self.cfg.breaker_reset_s)
+                self.counts['parked'] += finished
+            elif error:
+                finished = self.work_queue.fail(lease, error, self.max_attempts)
+                self.counts['failed'] += finished
+            else:
+                finished = self.work_queue.ack(lease, result)
+                self.counts['acked'] += finished
+            self.counts['lost'] += not finished
+        if not finished:
+            log(self.log_sink, 'warning', f"Lost the lease on task {lease.id}; it may be run again elsewhere")
+
+    # grabber worker: a failed task goes back to the queue (rather than killing the thread)
+    def grab(self, task):
+        try:
+            all_fits = get_cutout(task, metrics=self.metrics, log_sink=self.log_sink)
+        except Exception as e:
+            status = get_status_name(task['survey'].processing_status)
+            log(self.log_sink, 'error', str(e), status=status, **get_log_fields(task))
+            if status == 'none':
+                self.finish_task(task['pid'], {'status': status, 'files': [], 'error': str(e)})
+            elif status == 'unavailable':
+                # nb: its survey's circuit breaker is open, so set it aside for a while
+                self.finish_task(task['pid'], error=str(e), park=True)
+            else:
+                self.finish_task(task['pid'], error=str(e))
+            return None
+        if not all_fits:
+            self.finish_task(task['pid'], {'status': get_status_name(task['survey'].processing_status), 'files': []})
+            return None
+        return all_fits
+
+    # saver worker
+    def save(self, all_fits):
+        if not all_fits:
+            return
+        pid = all_fits[0]['pid']
+        if save_cutout(all_fits, metrics=self.metrics, log_sink=self.log_sink):
+            files = [f_dict['download_path'] for f_dict in all_fits if f_dict and f_dict.get('download_path')]
+            self.finish_task(pid, {'status': 'done', 'files': files})
+        else:
+            self.finish_task(pid, error="Unable to save")
+
+    def run(self):
+        metrics_server, stats_writer = None, None
+        if self.metrics:
+            self.metrics.add_queue('in', self.in_q)
+            self.metrics.add_queue('out', self.out_q)
+            if self.cfg.metrics_port:
+                metrics_server = MetricsServer(self.metrics, self.cfg.metrics_port)
+                print(f"Serving metrics at {metrics_server.get_url()}")
+            if self.cfg.stats_file:
+                stats_writer = StatsFileWriter(self.metrics, self.cfg.stats_file, self.cfg.stats_interval_s)
+        renewed = threading.Event()
+        renewer = threading.Thread(target=self.renew, args=(renewed,), name="LeaseRenewer", daemon=True)
+        renewer.start()
+        for thread in self.grabbers+self.savers:
+            thread.start()
+        self.feed()
+        self.in_q.join()
+        for _ in self.savers:
+            self.out_q.put(PoisonPill())
+        self.out_q.join()
+        renewed.set()
+        renewer.join()
+        if stats_writer:
+            stats_writer.close()
+        if metrics_server:
+            metrics_server.close()
+        self.log_sink.close()
+        return self.counts
+
+#  C O M M A N D   O P T I O N S
+#
+# The commands share most of their options: any not given on the command line
+# are taken from the config file (--config), then checked, and set on the run's
+# CLIConfig, each printed as it's set.
+
+# (option, config file key) of the options a command may take from the config file
+CONFIG_OPTIONS = [
+    ('radius', 'radius'), ('surveys', 'surveys'), ('data_out', 'output'), ('group_by', 'group_by'),
+    ('overwrite', 'overwrite'), ('flush', 'flush'), ('savers', 'savers'), ('max_queued_mb', 'max_queued_mb'),
+    ('compression', 'compression'), ('quantize_level', 'quantize_level'), ('container', 'container'),
+    ('shard_mb', 'shard_mb'), ('skip_existing', 'skip_existing'), ('render_format', 'render'),
+    ('render_workers', 'render_workers'), ('trace_file', 'trace'), ('metrics_port', 'metrics_port'),
+    ('stats_file', 'stats_file'), ('verbosity', 'verbosity'), ('log_file', 'log_file'),
+    ('http_connections', 'http_connections'), ('hedge_percentile', 'hedge_percentile'),
+    ('socket_path', 'socket'), ('spool_dir', 'spool'), ('queue_dir', 'queue'),
+    ('lease_s', 'lease_s'), ('max_attempts', 'max_attempts'),
+]
+# options that count as not given when falsy (flags, and an empty group_by), rather than None
+FALSY_OPTIONS = ['radius', 'group_by', 'overwrite', 'flush', 'container', 'skip_existing']
+# settings only the config file has, by the option of the commands they're for
+CONFIG_SETTINGS = {
+    'stats_file': ['stats_interval'],
+    'http_connections': ['http_host_connections', 'http_verify', 'http_retries', 'breaker_failures', 'breaker_reset_s'],
+    'hedge_percentile': ['hedge_budget'],
+}
+
+def get_options(params):
+    """Returns a command's options (its click params), with those not given
+       filled in from its config file, if any, and the surveys, group_by,
+       compression and render options checked; None (once the error's
+       printed) if the config file or an option is invalid."""
+    options = dict(params)
+    config_dict = None
+    if options.get('config_file'):
+        config_dict = read_in_config(options['config_file'])
+        if not config_dict:
+            print(f"no valid params parsed from config file {options['config_file']}")
+            return None # config file error abort
+    for option, settings in CONFIG_SETTINGS.items():
+        if option in options:
+            options.update({setting: config_dict[setting] if config_dict else None for setting in settings})
+    if config_dict:
+        # use YAML configs only if args not given
+        for option, key in CONFIG_OPTIONS:
+            if option in options and (not options[option] if option in FALSY_OPTIONS else options[option] is None):
+                options[option] = config_dict[key]
+    if 'radius' in options:
+        options['size'] = options['radius']*2 if options['radius'] else None
+    if isinstance(options.get('surveys'), str):
+        options['surveys'] = parse_surveys_string(options['surveys'])
+    checks = [('group_by', check_group_by_string), ('compression', check_compression_string), ('render_format', check_render_string)]
+    for option, check in checks:
+        if isinstance(options.get(option), str):
+            try:
+                options[option] = check(options[option])
+            except Exception as e:
+                print(str(e))
+                return None
+    if 'surveys' in options:
+        print(f"Using args: \n image size {options['size']} \n surveys {options['surveys']} \n group by: {options['group_by']}\n")
+    return options
+
+def set_options(cfg, options):
+    """Sets (and prints) whichever of these settings a command's options have on cfg."""
+    settings = [
+        ('overwrite', lambda: f"Overwrite Mode: {cfg.set_overwrite(options['overwrite'])}"),
+        ('savers', lambda: f"Save Workers: {cfg.set_save_workers(options['savers'])}"),
+        ('max_queued_mb', lambda: f"Save Queue Budget: {cfg.set_max_queued_mb(options['max_queued_mb'])} MB"),
+        ('lease_s', lambda: f"Lease: {cfg.set_lease(options['lease_s'], options['max_attempts'])} s, up to {cfg.max_attempts} attempt(s)"),
+        ('compression', lambda: f"Output Compression: {cfg.set_compression(options['compression'], options['quantize_level'])}"),
+        ('container', lambda: f"Container Output: {cfg.set_container(options['container'], options['shard_mb'])}"),
+        ('skip_existing', lambda: f"Skip Existing: {cfg.set_skip_existing(options['skip_existing'])}"),
+        ('render_format', lambda: f"Render Images: {cfg.set_render(options['render_format'], options['render_workers'])}"),
+        ('trace_file', lambda: f"Stage Trace: {cfg.set_trace(options['trace_file'])}"),
+        ('metrics_port', lambda: f"Metrics Port: {cfg.set_metrics_port(options['metrics_port'])}"),
+        ('stats_file', lambda: f"Stats File: {cfg.set_stats_file(options['stats_file'], options['stats_interval'])}"),
+        ('verbosity', lambda: f"Console Verbosity: {cfg.set_verbosity(options['verbosity'])}"),
+        ('log_file', lambda: f"Log File: {cfg.set_log_file(options['log_file'])}"),
+        ('http_connections', lambda: f"HTTP Connections: {cfg.set_http_connections(options['http_connections'], options['http_host_connections'])}"),
+        ('http_verify', lambda: f"HTTP Verify Certificates: {cfg.set_http_verify(options['http_verify'])}"),
+        ('http_retries', lambda: f"HTTP Retry Overrides: {cfg.set_http_retries(options['http_retries'])}"),
+        ('breaker_failures', lambda: f"Circuit Breaker: opens after {cfg.set_circuit_breaker(options['breaker_failures'], options['breaker_reset_s'])} failures, for {cfg.breaker_reset_s} s"),
+        ('hedge_percentile', lambda: f"Hedge Percentile: {cfg.set_hedging(options['hedge_percentile'], options['hedge_budget'])}, budget {cfg.hedge_budget}"),
+    ]
+    for option, set_option in settings:
+        if option in options:
+            print(set_option())
+    return cfg
+
 ##HANDLE COMMAND LINE INPUT
 @click.group()
 def cli():
@@ -212,7 +1067,23 @@ def cli():
 @click.option('--config', '-cf','config_file', required=False)
 @click.option('--overwrite',is_flag=True, help='overwrite existing target files (default False)')
 @click.option('--flush', is_flag=True, help='flush existing target files (supersedes --overwrite)')
-def fetch(overwrite, flush, coords, name, radius=None, surveys=None, data_out=None, group_by='', config_file=''):
+@click.option('--savers', 'savers', required=False, type=int, help='number of threads saving FITS output (default 4)')
+@click.option('--max_queued_mb', 'max_queued_mb', required=False, type=int, help='memory budget for cutouts waiting to be saved in MB (default 1024)')
+@click.option('--compress', 'compression', required=False, type=str, help='tile compress output FITS: NONE (default), RICE, GZIP, GZIP2 or HCOMPRESS')
+@click.option('--quantize', 'quantize_level', required=False, type=float, help='quantization level for compressed float images (default 16, 0 is lossless for GZIP)')
+@click.option('--container', is_flag=True, help='write into a few multi-extension FITS shards (plus an index.csv) rather than a file per cutout')
+@click.option('--shard_mb', 'shard_mb', required=False, type=int, help='approximate size of each FITS shard in MB with --container (default 4096)')
+@click.option('--skip_existing', is_flag=True, help='skip targets already saved according to the output manifest.sqlite (default False)')
+@click.option('--render', 'render_format', required=False, type=str, help='render images of the cutouts as NONE (default), PNG or JPEG, plus RGB composites for 3+ filters of a survey')
+@click.option('--render_workers', 'render_workers', required=False, type=int, help='number of processes rendering images (default cpu count)')
+@click.option('--trace', 'trace_file', required=False, type=str, help='time each stage of each task, printing a summary and writing a Chrome trace (JSON) to this file')
+@click.option('--metrics_port', 'metrics_port', required=False, type=int, help='serve live metrics (Prometheus text) at http://127.0.0.1:PORT/metrics')
+@click.option('--stats_file', 'stats_file', required=False, type=str, help='rewrite live metrics to this file every stats_interval (default 10) seconds: JSON, or Prometheus text for a .prom file')
+@click.option('--verbosity', 'verbosity', required=False, type=click.Choice(['debug', 'info', 'warning', 'error', 'quiet'], case_sensitive=False), help='console messages shown: debug (default, everything), info, warning, error or quiet')
+@click.option('--log_file', 'log_file', required=False, type=str, help='JSON-lines log of the run (default OutLOG.jsonl)')
+@click.option('--http_connections', 'http_connections', required=False, type=int, help='keep-alive connections per survey host (default 15)')
+@click.option('--hedge_percentile', 'hedge_percentile', required=False, type=float, help='send a duplicate of a download slower than this percentile (e.g., 95) of its host\'s, within a budget of hedge_budget (default 0.05) duplicates per request (default off)')
+def fetch(overwrite, flush, coords, name, radius=None, surveys=None, data_out=None, group_by='', config_file='', savers=None, max_queued_mb=None, compression=None, quantize_level=None, container=False, shard_mb=None, skip_existing=False, render_format=None, render_workers=None, trace_file=None, metrics_port=None, stats_file=None, verbosity=None, log_file=None, http_connections=None, hedge_percentile=None):
     """
     \b
     Single cutout fetching command.
@@ -292,54 +1163,19 @@ def fetch(overwrite, flush, coords, name, radius=None, surveys=None, data_out=No
         print("\n must specify search radius or to use config.yml (--config_file)")
         return
 
-    if radius:
-        size = radius*2
-
-    if group_by:
-        group_by = group_by.upper()
-
-    if config_file:
-        config_dict = read_in_config(config_file)
-        if not config_dict:
-            print(f"no valid params parsed from config file {config_file}")
-            return # config file error abort
-        # use YAML configs only if args not given
-        if not radius:
-            size = config_dict['radius']*2
-        if surveys is None:
-            surveys = config_dict['surveys']
-        if data_out is None:
-            data_out = config_dict['output']
-        if not overwrite:
-            overwrite = config_dict['overwrite']
-        if not flush:
-            flush = config_dict['flush']
-        if not group_by:
-            group_by = config_dict['group_by']
-
-    if data_out is None:
-        data_out = 'data_out'
+    options = get_options(click.get_current_context().params)
+    if options is None:
+        return
 
     relative_path = os.path.dirname(os.path.abspath(__file__))+'/'
-    out_path = os.path.join(relative_path,data_out)
-
-    if isinstance(surveys, str):
-        surveys = parse_surveys_string(surveys)
-
-    if isinstance(group_by, str):
-        try:
-            group_by = check_group_by_string(group_by)
-        except Exception as e:
-            print(str(e))
-            return
-    print(f"Using args: \n image size {size} \n surveys {surveys} \n group by: {group_by}\n")
+    out_path = os.path.join(relative_path,options['data_out'] or 'data_out')
 
     # configuration
-    cfg = CLIConfig(surveys, out_path, group_by)
-    cfg.set_single_target_params(target, size, is_name)
-    if flush:
+    cfg = CLIConfig(options['surveys'], out_path, options['group_by'])
+    cfg.set_single_target_params(target, options['size'], is_name)
+    if options['flush']:
         cfg.flush_old_survey_data()
-    print(f"Overwrite Mode: {cfg.set_overwrite(overwrite)}")
+    set_options(cfg, options)
     # MAIN CALL
     process_requests(cfg)
 
@@ -354,7 +1190,23 @@ def fetch(overwrite, flush, coords, name, radius=None, surveys=None, data_out=No
 @click.option('--config', '-cf','config_file', required=False)
 @click.option('--overwrite', 'overwrite', is_flag=True, help='overwrite existing duplicate target files (default True)')
 @click.option('--flush', 'flush', is_flag=True, help='flush existing target files (supersedes --overwrite)')
-def fetch_batch( overwrite, flush, batch_files_string, radius=None, surveys=None, data_out=None, group_by='', config_file=''):
+@click.option('--savers', 'savers', required=False, type=int, help='number of threads saving FITS output (default 4)')
+@click.option('--max_queued_mb', 'max_queued_mb', required=False, type=int, help='memory budget for cutouts waiting to be saved in MB (default 1024)')
+@click.option('--compress', 'compression', required=False, type=str, help='tile compress output FITS: NONE (default), RICE, GZIP, GZIP2 or HCOMPRESS')
+@click.option('--quantize', 'quantize_level', required=False, type=float, help='quantization level for compressed float images (default 16, 0 is lossless for GZIP)')
+@click.option('--container', is_flag=True, help='write into a few multi-extension FITS shards (plus an index.csv) rather than a file per cutout')
+@click.option('--shard_mb', 'shard_mb', required=False, type=int, help='approximate size of each FITS shard in MB with --container (default 4096)')
+@click.option('--skip_existing', is_flag=True, help='skip targets already saved according to the output manifest.sqlite (default False)')
+@click.option('--render', 'render_format', required=False, type=str, help='render images of the cutouts as NONE (default), PNG or JPEG, plus RGB composites for 3+ filters of a survey')
+@click.option('--render_workers', 'render_workers', required=False, type=int, help='number of processes rendering images (default cpu count)')
+@click.option('--trace', 'trace_file', required=False, type=str, help='time each stage of each task, printing a summary and writing a Chrome trace (JSON) to this file')
+@click.option('--metrics_port', 'metrics_port', required=False, type=int, help='serve live metrics (Prometheus text) at http://127.0.0.1:PORT/metrics')
+@click.option('--stats_file', 'stats_file', required=False, type=str, help='rewrite live metrics to this file every stats_interval (default 10) seconds: JSON, or Prometheus text for a .prom file')
+@click.option('--verbosity', 'verbosity', required=False, type=click.Choice(['debug', 'info', 'warning', 'error', 'quiet'], case_sensitive=False), help='console messages shown: debug (default, everything), info, warning, error or quiet')
+@click.option('--log_file', 'log_file', required=False, type=str, help='JSON-lines log of the run (default OutLOG.jsonl)')
+@click.option('--http_connections', 'http_connections', required=False, type=int, help='keep-alive connections per survey host (default 15)')
+@click.option('--hedge_percentile', 'hedge_percentile', required=False, type=float, help='send a duplicate of a download slower than this percentile (e.g., 95) of its host\'s, within a budget of hedge_budget (default 0.05) duplicates per request (default off)')
+def fetch_batch( overwrite, flush, batch_files_string, radius=None, surveys=None, data_out=None, group_by='', config_file='', savers=None, max_queued_mb=None, compression=None, quantize_level=None, container=False, shard_mb=None, skip_existing=False, render_format=None, render_workers=None, trace_file=None, metrics_port=None, stats_file=None, verbosity=None, log_file=None, http_connections=None, hedge_percentile=None):
     """
        Batch cutout fetching command.
 
@@ -441,40 +1293,10 @@ def fetch_batch( overwrite, flush, batch_files_string, radius=None, surveys=None
     if not radius and not config_file:
         print("\n must specify search radius or to use config.yml (--config_file)")
         return
-    if radius:
-        size = radius*2
-
-    if group_by:
-        group_by = group_by.upper()
 
-    if config_file:
-        config_dict = read_in_config(config_file)
-        if not config_dict:
-            return # config file error abort
-        # use YAML configs only if args not given
-        if not radius:
-            size = config_dict['radius']*2
-        if surveys is None:
-            surveys = config_dict['surveys']
-        if data_out is None:
-            data_out = config_dict['output']
-        if not overwrite:
-            overwrite = config_dict['overwrite']
-        if not flush:
-            flush = config_dict['flush']
-        if not group_by:
-            group_by = config_dict['group_by']
-
-    if isinstance(surveys, str):
-        surveys = parse_surveys_string(surveys)
-
-    if isinstance(group_by, str):
-        try:
-            group_by = check_group_by_string(group_by)
-        except Exception as e:
-            print(str(e))
-            return
-    print(f"Using args: \n image size {size} \n surveys {surveys} \n group by: {group_by}\n")
+    options = get_options(click.get_current_context().params)
+    if options is None:
+        return
 
     accepted_batch_files = check_batch_csv(batch_files_string)
     if not accepted_batch_files:
@@ -482,6 +1304,7 @@ def fetch_batch( overwrite, flush, batch_files_string, radius=None, surveys=None
         return
     print(f"Using batch csv: {accepted_batch_files}")
 
+    data_out = options['data_out']
     if data_out is None:
         # make output oflder resemble batch file name
         if len(accepted_batch_files) == 1:
@@ -491,13 +1314,214 @@ def fetch_batch( overwrite, flush, batch_files_string, radius=None, surveys=None
     relative_path = os.path.dirname(os.path.abspath(__file__))+'/'
     out_path = os.path.join(relative_path,data_out)
     # configuration
-    cfg = CLIConfig(surveys, out_path, group_by)
-    cfg.set_batch_targets(accepted_batch_files, relative_path, size)
-    if flush:
+    cfg = CLIConfig(options['surveys'], out_path, options['group_by'])
+    cfg.set_batch_targets(accepted_batch_files, relative_path, options['size'])
+    if options['flush']:
         cfg.flush_old_survey_data()
-    print(f"Overwrite Mode: {cfg.set_overwrite(overwrite)}")
+    set_options(cfg, options)
     process_requests(cfg)
 
+@cli.command()
+@click.option('--socket', 'socket_path', required=False, type=str, help='unix socket to accept JSON-lines jobs on (default cutout_service.sock, unless only --spool is given)')
+@click.option('--spool', 'spool_dir', required=False, type=str, help='folder to watch for *.jsonl job files')
+@click.option('--radius','-r', 'radius', required=False, type=int, help='default radius of jobs in arcmin')
+@click.option('--surveys','-s', 'surveys', required=False, type=str, help='default surveys of jobs (default all)')
+@click.option('--output','-o', 'data_out', required=False)
+@click.option('--groupby','-g', 'group_by', required=False)
+@click.option('--config', '-cf','config_file', required=False)
+@click.option('--overwrite',is_flag=True, help='overwrite existing target files (default False)')
+@click.option('--savers', 'savers', required=False, type=int, help='number of threads saving FITS output (default 4)')
+@click.option('--max_queued_mb', 'max_queued_mb', required=False, type=int, help='memory budget for cutouts waiting to be saved in MB (default 1024)')
+@click.option('--compress', 'compression', required=False, type=str, help='tile compress output FITS: NONE (default), RICE, GZIP, GZIP2 or HCOMPRESS')
+@click.option('--quantize', 'quantize_level', required=False, type=float, help='quantization level for compressed float images (default 16, 0 is lossless for GZIP)')
+@click.option('--skip_existing', is_flag=True, help='skip targets already saved according to the output manifest.sqlite (default False)')
+@click.option('--metrics_port', 'metrics_port', required=False, type=int, help='serve live metrics (Prometheus text) at http://127.0.0.1:PORT/metrics')
+@click.option('--stats_file', 'stats_file', required=False, type=str, help='rewrite live metrics to this file every stats_interval (default 10) seconds: JSON, or Prometheus text for a .prom file')
+@click.option('--verbosity', 'verbosity', required=False, type=click.Choice(['debug', 'info', 'warning', 'error', 'quiet'], case_sensitive=False), help='console messages shown: debug (default, everything), info, warning, error or quiet')
+@click.option('--log_file', 'log_file', required=False, type=str, help='JSON-lines log of the service (default OutLOG.jsonl)')
+@click.option('--http_connections', 'http_connections', required=False, type=int, help='keep-alive connections per survey host (default 15)')
+@click.option('--hedge_percentile', 'hedge_percentile', required=False, type=float, help='send a duplicate of a download slower than this percentile (e.g., 95) of its host\'s, within a budget of hedge_budget (default 0.05) duplicates per request (default off)')
+def serve(overwrite, socket_path=None, spool_dir=None, radius=None, surveys=None, data_out=None, group_by='', config_file='', savers=None, max_queued_mb=None, compression=None, quantize_level=None, skip_existing=False, metrics_port=None, stats_file=None, verbosity=None, log_file=None, http_connections=None, hedge_percentile=None):
+    """
+    \b
+    Cutout service: a long running process taking jobs as JSON lines,
+    e.g.,
+        {"id": "j1", "coords": "150.1, 2.2", "radius": 1, "surveys": "VLASS,WISE[w1]"}
+        {"id": "j2", "targets": [{"name": "M87"}, {"coords": "10.68 41.27"}]}
+    \b
+    over a unix socket (--socket), with each task's result streamed back as a
+    JSON line as soon as it's saved, and/or as *.jsonl files moved into a
+    spool folder (--spool), with the results written to <file>.results.jsonl.
+    Each job ends with a {"job": ..., "done": true, ...} line.
+    \b
+    Jobs may set coords, name or targets, and radius, surveys, groupby,
+    overwrite, compress, quantize or skip_existing; the other options here
+    are the defaults for jobs that don't.
+    \b
+    -cf 'config' is to specify a YAML config file for settings, ex."config.yml".
+        *Note: Specified command line args will overwrite these settings.
+    """
+    options = get_options(click.get_current_context().params)
+    if options is None:
+        return
+    socket_path, spool_dir = options['socket_path'], options['spool_dir']
+    if not socket_path and not spool_dir:
+        socket_path = 'cutout_service.sock'
+
+    relative_path = os.path.dirname(os.path.abspath(__file__))+'/'
+    out_path = os.path.join(relative_path,options['data_out'] or 'data_out')
+
+    # the service's configuration, and the defaults of its jobs
+    cfg = CLIConfig(options['surveys'], out_path, options['group_by'])
+    set_options(cfg, options)
+
+    service = CutoutService(cfg, options['surveys'], options['size'])
+    server, watcher = None, None
+    if socket_path:
+        server = JobSocketServer(socket_path, service)
+        threading.Thread(target=server.serve_forever, name="JobSocketServer", daemon=True).start()
+        print(f"Accepting jobs on {os.path.abspath(socket_path)}")
+    if spool_dir:
+        watcher = SpoolWatcher(service, spool_dir)
+        watcher.start()
+        print(f"Watching {os.path.abspath(spool_dir)} for *.jsonl jobs")
+
+    # ctrl-c (or a SIGTERM) stops taking jobs and finishes those already queued
+    stopped = threading.Event()
+    def sig_handler(sig, frame):
+        print("\nStopping: finishing queued tasks...")
+        stopped.set()
+    signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGTERM, sig_handler)
+    while not stopped.wait(1.0):
+        pass
+    if server:
+        server.shutdown()
+        server.server_close()
+        os.remove(socket_path)
+    if watcher:
+        watcher.close()
+    service.close()
+
+@cli.command()
+@click.option('--queue','-q', 'queue_dir', required=False, help='work queue folder, on storage shared by the workers')
+@click.option('--file','-f', 'batch_files_string', required=True, help='batch file(s) name(s)')
+@click.option('--radius','-r', 'radius', required=False, type=int)
+@click.option('--surveys','-s', 'surveys', required=False, type=str)
+@click.option('--output','-o', 'data_out', required=False, help='output folder, on storage shared by the workers')
+@click.option('--groupby','-g', 'group_by', required=False)
+@click.option('--config', '-cf','config_file', required=False)
+@click.option('--overwrite', 'overwrite', is_flag=True, help='overwrite existing duplicate target files (default True)')
+@click.option('--compress', 'compression', required=False, type=str, help='tile compress output FITS: NONE (default), RICE, GZIP, GZIP2 or HCOMPRESS')
+@click.option('--quantize', 'quantize_level', required=False, type=float, help='quantization level for compressed float images (default 16, 0 is lossless for GZIP)')
+@click.option('--skip_existing', is_flag=True, help='skip targets already saved according to the output manifest.sqlite (default False)')
+def publish(overwrite, batch_files_string, queue_dir=None, radius=None, surveys=None, data_out=None, group_by='', config_file='', compression=None, quantize_level=None, skip_existing=False):
+    """
+       Publish batch cutout tasks to a work queue.
+
+       \b
+       Puts the tasks fetch_batch would run into a work queue folder
+       (-q), to be run by `work` on any number of nodes sharing it (and
+       the output folder). The other options are as for fetch_batch.
+    """
+    if not radius and not config_file:
+        print("\n must specify search radius or to use config.yml (--config_file)")
+        return
+
+    options = get_options(click.get_current_context().params)
+    if options is None:
+        return
+    queue_dir = options['queue_dir']
+    if not queue_dir:
+        print("\n must specify a work queue folder (--queue)")
+        return
+
+    accepted_batch_files = check_batch_csv(batch_files_string)
+    if not accepted_batch_files:
+        print("no valid CSV batch files specified!")
+        return
+    print(f"Using batch csv: {accepted_batch_files}")
+
+    data_out = options['data_out']
+    if data_out is None:
+        # make output oflder resemble batch file name
+        if len(accepted_batch_files) == 1:
+            data_out = accepted_batch_files[0].split("/")[-1].replace('.csv', '_out')
+        else:
+            data_out = 'data_out'
+    relative_path = os.path.dirname(os.path.abspath(__file__))+'/'
+    out_path = os.path.join(relative_path,data_out)
+    # configuration
+    cfg = CLIConfig(options['surveys'], out_path, options['group_by'])
+    cfg.set_batch_targets(accepted_batch_files, relative_path, options['size'])
+    set_options(cfg, options)
+
+    work_queue = WorkQueue(queue_dir)
+    manifest = CutoutManifest(cfg.get_manifest_file()) if cfg.skip_existing else None
+    published, skipped = 0, 0
+    for task in cfg.get_procssing_stack():
+        if manifest and manifest.has_task(task):
+            skipped += 1
+            continue
+        work_queue.publish(get_task_spec(task))
+        published += 1
+    if manifest:
+        manifest.close()
+    if skipped:
+        print(f"Skipped {skipped} target(s) already in {cfg.get_manifest_file()}")
+    print(f"Published {published} task(s) to {os.path.abspath(queue_dir)}: {work_queue.get_counts()}")
+
+@cli.command()
+@click.option('--queue','-q', 'queue_dir', required=False, help='work queue folder, as given to publish')
+@click.option('--config', '-cf','config_file', required=False)
+@click.option('--savers', 'savers', required=False, type=int, help='number of threads saving FITS output (default 4)')
+@click.option('--max_queued_mb', 'max_queued_mb', required=False, type=int, help='memory budget for cutouts waiting to be saved in MB (default 1024)')
+@click.option('--lease_s', 'lease_s', required=False, type=float, help='seconds a task is leased for, renewed while in hand; a dead worker\'s tasks are run again once theirs expire (default 600)')
+@click.option('--max_attempts', 'max_attempts', required=False, type=int, help='times a failing task is tried before it goes to failed/ (default 3)')
+@click.option('--wait', is_flag=True, help='keep waiting for tasks once the queue is drained (default False)')
+@click.option('--metrics_port', 'metrics_port', required=False, type=int, help='serve live metrics (Prometheus text) at http://127.0.0.1:PORT/metrics')
+@click.option('--stats_file', 'stats_file', required=False, type=str, help='rewrite live metrics to this file every stats_interval (default 10) seconds: JSON, or Prometheus text for a .prom file')
+@click.option('--verbosity', 'verbosity', required=False, type=click.Choice(['debug', 'info', 'warning', 'error', 'quiet'], case_sensitive=False), help='console messages shown: debug (default, everything), info, warning, error or quiet')
+@click.option('--log_file', 'log_file', required=False, type=str, help='JSON-lines log of the run (default OutLOG.jsonl)')
+@click.option('--http_connections', 'http_connections', required=False, type=int, help='keep-alive connections per survey host (default 15)')
+@click.option('--hedge_percentile', 'hedge_percentile', required=False, type=float, help='send a duplicate of a download slower than this percentile (e.g., 95) of its host\'s, within a budget of hedge_budget (default 0.05) duplicates per request (default off)')
+def work(queue_dir=None, config_file='', savers=None, max_queued_mb=None, lease_s=None, max_attempts=None, wait=False, metrics_port=None, stats_file=None, verbosity=None, log_file=None, http_connections=None, hedge_percentile=None):
+    """
+       Run the tasks of a work queue.
+
+       \b
+       Leases tasks published to a work queue folder (-q), fetches and
+       saves their cutouts, and acks them, until the queue is drained
+       (or, with --wait, until ctrl-c). Run it on as many nodes as you
+       like. Done tasks, with their files, are recorded in the queue's
+       done/ folder, and those out of attempts in failed/.
+    """
+    options = get_options(click.get_current_context().params)
+    if options is None:
+        return
+    queue_dir = options['queue_dir']
+    if not queue_dir:
+        print("\n must specify a work queue folder (--queue)")
+        return
+
+    # configuration (nb: no output folder, the tasks have theirs)
+    cfg = CLIConfig(None, None)
+    set_options(cfg, options)
+
+    start = datetime.now()
+    work_queue = WorkQueue(queue_dir)
+    print(f"Worker {work_queue.worker_id} on {os.path.abspath(queue_dir)}: {work_queue.get_counts()}")
+    worker = QueueWorker(work_queue, cfg, lease_s=cfg.lease_s, max_attempts=cfg.max_attempts, wait=wait)
+    # ctrl-c stops leasing tasks and finishes those in hand
+    def sig_handler(sig, frame):
+        print("\nStopping: finishing the tasks in hand...")
+        worker.stop()
+    signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGTERM, sig_handler)
+    counts = worker.run()
+    print(f"Acked {counts['acked']}, failed {counts['failed']}, parked {counts['parked']} and lost {counts['lost']} task(s); queue: {work_queue.get_counts()}")
+    print("time took: " +str(datetime.now()-start))
+
 if __name__ == "__main__":
     cli()
     print("hmm")
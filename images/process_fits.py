@@ -1,65 +1,24 @@
 import os
+import sys
 import errno
 
 import numpy as np
 
 from astropy.io import fits
-from astropy.visualization import make_lupton_rgb
 
 import matplotlib.pyplot as plt
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core.render import vlass_stretch, nvss_stretch, first_stretch, sdss_stretch, panstarrs_stretch
+
 '''
-TODO finish this?? looks incomplete and needs to use toolbox
 Grab FITS files from /out, process into JPGs and save to /processed
 
-TODO (Issue #15): Should probably be refactored so that it can easily integrated
-     with fetch_cutouts.py or become part of a fetch-fits-create-png pipeline script...
+NB: fetch_cutouts.py can now render images as it goes (--render PNG|JPEG),
+    from the cutouts in memory; this is for FITS files already on disk.
 '''
 
 
-def vlass_stretch(data):
-
-    vmin = -0.000235248
-    vmax = 0.00798479
-
-    return arcsinh_stretch(data, vmin, vmax)
-
-
-def nvss_stretch(data):
-
-    vmin = -0.00070356
-    vmax = 0.162288
-
-    return arcsinh_stretch(data, vmin, vmax)
-
-
-def first_stretch(data):
-
-    vmin = -0.00551651
-    vmax = 0.0634952
-
-    return arcsinh_stretch(data, vmin, vmax)
-
-
-def sdss_stretch(data):
-
-    vmin = -0.05538
-    vmax = 20.67399
-
-    return lupton_stretch(data, vmin, vmax)
-
-def panstarrs_stretch(data):
-
-    vmin = -250.226
-    vmax = 80822.4
-
-    fit = np.interp(data, (vmin, vmax), (0, 10))
-
-    fit = make_lupton_rgb(fit[2], fit[1], fit[0], stretch=0.7, Q=11)
-
-    return fit
-
-
 # make the directory structure if it doesn't exist
 def make_dir(dirname):
 
@@ -70,24 +29,6 @@ def make_dir(dirname):
             raise
 
 
-def lupton_stretch(data, vmin, vmax):
-
-    fit = np.interp(data, (vmin, vmax), (0, 10))
-
-    fit = make_lupton_rgb(fit[2], fit[1], fit[0], stretch=0.5, Q=9)
-
-    return fit
-
-
-def arcsinh_stretch(data, vmin, vmax):
-
-    fit = np.interp(data, (vmin, vmax), (0, 1))
-
-    fit = np.arcsinh(10*fit)/3
-
-    return fit
-
-
 def get_fits_data(in_file):
     f = fits.getdata(in_file)
 
@@ -100,7 +41,7 @@ def get_fits_data(in_file):
 def save_image(data, out_file):
 
     # a color image
-    if data.shape == 3:
+    if len(data.shape) == 3:
         plt.imsave(fname=out_file, arr=data)
     else:
         plt.imsave(fname=out_file, arr=data, cmap='gray')
@@ -0,0 +1,35 @@
+import os
+import sys
+import socket
+
+import pytest
+
+# nb: as the benchmarks do, so the tests run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def stand_in_server():
+    """A local stand-in for the surveys' image services (see benchmarks/stand_ins.py)."""
+    from benchmarks.stand_ins import StandInServer
+    server = StandInServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def dead_url():
+    """The url of a local port nothing is listening on."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+
+@pytest.fixture
+def circuit_breakers(monkeypatch):
+    """Fresh process wide circuit breakers, so a test's open circuits don't leak."""
+    import core.retry
+    breakers = core.retry.CircuitBreakers()
+    monkeypatch.setattr(core.retry, 'default_breakers', breakers)
+    return breakers
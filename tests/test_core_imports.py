@@ -0,0 +1,25 @@
+import os
+import sys
+import json
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# runs code in a fresh interpreter (nb: so nothing is imported yet), returning what it prints as JSON
+def run_python(code):
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT]+sys.path)),
+                            stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def test_import_is_lazy():
+    loaded = run_python("import sys, json, core; print(json.dumps(sorted(sys.modules)))")
+    assert not [name for name in ['core.vlass', 'core.wise', 'core.FITS2DImageTools', 'astroquery'] if name in loaded]
+
+
+def test_star_import_exports_the_surveys_and_tools():
+    names = run_python("import json\nfrom core import *\nprint(json.dumps(sorted(globals())))")
+    for name in ['FIRST', 'NVSS', 'VLASS', 'WISE', 'PANSTARRS', 'SDSS', 'GLEAM', 'processing_status',
+                 'grizy_filters', 'vlass_epoch', 'get_thumbnail', 'robust_stats', 'extractCoordfromString']:
+        assert name in names
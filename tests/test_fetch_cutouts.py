@@ -0,0 +1,68 @@
+import os
+import threading
+
+import astropy.units as u
+from click.testing import CliRunner
+from astropy.coordinates import SkyCoord
+
+import cli_config
+import fetch_cutouts
+from benchmarks.stand_ins import get_stand_in_survey
+
+
+def get_config(tmp_path, surveys, targets=6):
+    cfg = cli_config.CLIConfig(surveys, str(tmp_path/'data_out'))
+    cfg.targets = [{'position': SkyCoord(150.0+0.1*i, 2.2, unit='deg'), 'size': 1*u.arcmin} for i in range(targets)]
+    cfg.set_verbosity('quiet')
+    return cfg
+
+
+def run_requests(cfg, timeout_s=120):
+    # nb: in a thread (so a stuck run fails the test, rather than hanging it), without the ctrl-c handler
+    thread = threading.Thread(target=fetch_cutouts.process_requests, args=(cfg,), daemon=True)
+    thread.start()
+    thread.join(timeout_s)
+    return not thread.is_alive()
+
+
+def test_down_host_fails_fast_while_other_surveys_carry_on(tmp_path, monkeypatch, stand_in_server, dead_url, circuit_breakers):
+    base_urls = {'FIRST': stand_in_server.get_base_url(), 'NVSS': dead_url}
+    monkeypatch.setattr(cli_config, 'get_survey_class', lambda name: get_stand_in_survey(name, base_urls[name]))
+    monkeypatch.setattr(fetch_cutouts, 'set_sig_handler', lambda threads: None)
+    monkeypatch.chdir(tmp_path)
+    # nb: more failing tasks than grabbers, most of them failing fast on the open circuit
+    cfg = get_config(tmp_path, ['FIRST', 'NVSS'], targets=20)
+    cfg.set_http_retries({'NVSS': {'attempts': 1}})
+    assert run_requests(cfg), "process_requests hung"
+    first_dir = tmp_path/'data_out'/'FIRST'
+    assert len([f for f in os.listdir(first_dir) if f.endswith('.fits')]) == 20
+    assert not os.path.exists(tmp_path/'data_out'/'NVSS') or not os.listdir(tmp_path/'data_out'/'NVSS')
+    assert circuit_breakers.get(dead_url.split('//')[1]).get_state()['trips'] >= 1
+
+
+def test_commands_take_options_not_given_from_the_config_file(tmp_path, monkeypatch):
+    config_file = tmp_path/'config.yml'
+    config_file.write_text("cutouts: {radius: 2, surveys: [VLASS], group_by: MOSAIC}\n"
+                           "configuration: {output: data_out/, overwrite: True, flush: False, savers: 2, compression: RICE,\n"
+                           "                http_connections: 7, breaker_failures: 3, hedge_budget: 0.1, lease_s: 60, max_attempts: 5}\n")
+    configs = list()
+    monkeypatch.setattr(fetch_cutouts, 'process_requests', configs.append)
+    result = CliRunner().invoke(fetch_cutouts.cli, ['fetch', '-c', '150.0, 2.2', '-cf', str(config_file), '--savers', '3', '--verbosity', 'quiet'])
+    assert result.exit_code == 0, result.output
+    cfg = configs.pop()
+    assert (cfg.overwrite, cfg.save_workers, cfg.compression, cfg.group_by) == (True, 3, 'RICE_1', 'MOSAIC')
+    assert (cfg.http_connections, cfg.breaker_failures, cfg.hedge_budget) == (7, 3, 0.1)
+    assert cfg.targets[0]['size'].value == 4
+    assert "Save Workers: 3" in result.output
+
+    class QueueWorker:
+        def __init__(self, work_queue, cfg, **kwargs):
+            configs.append(cfg)
+        def run(self):
+            return {'acked': 0, 'failed': 0, 'parked': 0, 'lost': 0}
+    monkeypatch.setattr(fetch_cutouts, 'QueueWorker', QueueWorker)
+    result = CliRunner().invoke(fetch_cutouts.cli, ['work', '-q', str(tmp_path/'queue'), '-cf', str(config_file), '--max_attempts', '2'])
+    assert result.exit_code == 0, result.output
+    cfg = configs.pop()
+    assert (cfg.lease_s, cfg.max_attempts, cfg.save_workers, cfg.http_connections) == (60, 2, 2, 7)
+    assert "Overwrite Mode" not in result.output
@@ -0,0 +1,45 @@
+import numpy as np
+from astropy.io import fits
+
+from core.fits_shards import FITSShardWriter, read_index, find_extensions, iter_extensions
+
+
+def get_cutout_dict(ra, survey='VLASS', tiles=1, shape=(20, 30)):
+    data = np.random.RandomState(int(ra)).random_sample(shape).astype(np.float32)
+    originals = {f"https://example.org/{survey}/{ra}/tile{i}.fits": {'tile': fits.PrimaryHDU(data*(i+2))} for i in range(tiles)}
+    return {'download': fits.PrimaryHDU(data), 'originals': originals, 'position': f"{ra}, 2.2", 'radius': 1.0,
+            'survey': survey, 'filter': '', 'group': 'None', 'epoch': '', 'filename': f"{survey}_{ra}.fits"}
+
+
+def test_round_trip(tmp_path):
+    f_dicts = [get_cutout_dict(ra, tiles=3 if ra == 12 else 1) for ra in range(10, 16)]
+    writer = FITSShardWriter(str(tmp_path), max_shard_bytes=8*2880)
+    rows = [row for f_dict in f_dicts for row in writer.add(f_dict)]
+    writer.close()
+    index = read_index(str(tmp_path))
+    assert len(index) == len(rows) == 6+3
+    assert len(set([row['shard'] for row in index])) > 1
+    cutouts = find_extensions(index, role='cutout')
+    read_back = {row['position']: hdu.data for (row, hdu) in iter_extensions(str(tmp_path), cutouts)}
+    for f_dict in f_dicts:
+        assert np.array_equal(read_back[f_dict['position']], f_dict['download'].data)
+    originals = find_extensions(index, role='original')
+    assert set([row['position'] for row in originals]) == {"12, 2.2"}
+    for (row, hdu) in iter_extensions(str(tmp_path), originals):
+        assert np.array_equal(hdu.data, f_dicts[2]['originals'][row['url']]['tile'].data)
+
+
+def test_single_tile_originals_not_written(tmp_path):
+    writer = FITSShardWriter(str(tmp_path))
+    rows = writer.add(get_cutout_dict(10, tiles=1))
+    writer.close()
+    assert [row['role'] for row in rows] == ['cutout']
+
+
+def test_rerun_appends_to_index(tmp_path):
+    for run in range(2):
+        writer = FITSShardWriter(str(tmp_path))
+        writer.add(get_cutout_dict(10))
+        writer.close()
+    index = read_index(str(tmp_path))
+    assert [row['shard'] for row in index] == ['cutouts-0000.fits', 'cutouts-0001.fits']
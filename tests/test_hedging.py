@@ -0,0 +1,64 @@
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from core.hedging import Hedger, get_cancellable_chunks
+from core.http_transport import HTTPTransport
+
+
+@pytest.fixture
+def stalling_server():
+    """Serves 'ok', except the first request, which gets no response (not
+       even its headers) until the test is over."""
+    release = threading.Event()
+    requests = list()
+    class StallingHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            if len(requests) == 1:
+                release.wait(60)
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StallingHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def test_losing_copy_stalled_before_its_headers_is_shut_down(stalling_server):
+    transport = HTTPTransport(maxsize=4, timeout=30.0, retries=0)
+    hedger = Hedger(percentile=50, budget=1.0, min_delay_s=0.1, min_samples=1)
+    hedger.latencies.add('test', 0.1)
+    outcomes = list()
+    def fetch(cancelled):
+        start = time.perf_counter()
+        try:
+            response = transport.request('GET', f"{stalling_server}/tile", preload_content=False)
+            try:
+                return b''.join(get_cancellable_chunks(response.stream(1024), cancelled))
+            finally:
+                cancelled.done()
+                response.release_conn()
+        except Exception as e:
+            outcomes.append((e, time.perf_counter()-start))
+            raise
+    start = time.perf_counter()
+    assert hedger.run('test', fetch) == b'ok'
+    assert time.perf_counter()-start < 5
+    assert hedger.get_counts()['hedge_wins'] == 1
+    # the stalled copy is woken as the hedge wins, long before its 30s read timeout
+    deadline = time.perf_counter()+5
+    while not outcomes and time.perf_counter() < deadline:
+        time.sleep(0.05)
+    assert len(outcomes) == 1 and outcomes[0][1] < 5
+    # and its connection isn't handed back to the pool for others to use
+    assert transport.request('GET', f"{stalling_server}/tile").data == b'ok'
@@ -0,0 +1,37 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from core.http_transport import HTTPTransport
+from core.survey_abc import get_thread_client
+
+
+def test_sessions_are_per_thread_on_shared_pools(stand_in_server):
+    transport = HTTPTransport(maxsize=4)
+    url = f"{stand_in_server.get_base_url()}/first/cgi-bin/firstimage?ra=150&dec=2.2&size=0.01"
+    def fetch(_):
+        session = transport.get_session()
+        assert session is transport.get_session()
+        assert session.get(url).status_code == 200
+        assert transport.request('GET', url).status == 200
+        return id(session)
+    with ThreadPoolExecutor(4) as pool:
+        sessions = set(pool.map(fetch, range(16)))
+    assert 1 < len(sessions) <= 4
+    # nb: the requests sessions' connections come from the transport's (one) pool of the host
+    assert len(transport.manager.pools) == 1
+    transport.configure(verify=False)
+    assert not [session for session in transport.sessions if session.verify]
+
+
+def test_thread_clients_are_built_once_per_thread():
+    built = list()
+    def factory():
+        built.append(threading.get_ident())
+        return object()
+    def get_client(_):
+        client = get_thread_client('test', factory)
+        assert client is get_thread_client('test', factory)
+        return (threading.get_ident(), id(client))
+    with ThreadPoolExecutor(3) as pool:
+        clients = set(pool.map(get_client, range(30)))
+    assert len(set(built)) == len(built) == len(clients)
@@ -0,0 +1,46 @@
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+
+from core import WISE
+from core.survey_filters import wise_filters
+from core.manifest import CutoutManifest
+
+
+def add_cutout(manifest, tmp_path, ra, dec, radius=1.0, survey='WISE', filter='w1', group_by='NONE'):
+    path = tmp_path/f"{survey}_{ra}_{dec}_{radius}_{filter}_{group_by}.fits"
+    path.write_bytes(b"fits")
+    manifest.register({'position': f"{ra}, {dec}", 'radius': radius, 'survey': survey, 'filter': filter,
+                       'group': None, 'group_by': group_by, 'epoch': None}, path=str(path))
+    return path
+
+
+def test_find_matches_positions_columns_and_wraps_through_ra_0(tmp_path):
+    manifest = CutoutManifest(str(tmp_path/'manifest.sqlite'))
+    add_cutout(manifest, tmp_path, 150.0, 2.2)
+    add_cutout(manifest, tmp_path, 150.0, 2.2, survey='VLASS', filter='')
+    add_cutout(manifest, tmp_path, 359.9995, -30.0)
+    add_cutout(manifest, tmp_path, 0.0001, -30.0, filter='w2')
+    add_cutout(manifest, tmp_path, 10.0, 89.9999)
+    assert len(manifest.find(150.0, 2.2)) == 2
+    assert [row['survey'] for row in manifest.find(150.0, 2.2, survey='VLASS')] == ['VLASS']
+    assert manifest.find(150.0+2/3600, 2.2) == [] # nb: outside the 1 arcsec default
+    assert len(manifest.find(150.0+2/3600, 2.2, radius=3/3600)) == 2
+    # nb: either side of RA=0 (at dec -30, 0.0006 deg of RA is about 1.9 arcsec)
+    assert sorted([row['filter'] for row in manifest.find(0.0, -30.0, radius=2/3600)]) == ['w1', 'w2']
+    assert [row['filter'] for row in manifest.find(359.9999, -30.0)] == ['w2']
+    assert len(manifest.find(190.0, 89.9999, radius=1/3600)) == 1 # nb: across the pole
+    manifest.close()
+
+
+def test_has_task_matches_survey_filter_radius_and_grouping(tmp_path):
+    manifest = CutoutManifest(str(tmp_path/'manifest.sqlite'))
+    path = add_cutout(manifest, tmp_path, 150.0, 2.2, radius=1.0)
+    task = {'position': SkyCoord(150.0, 2.2, unit='deg'), 'size': 2*u.arcmin, 'survey': WISE(filter=wise_filters.w1)}
+    assert manifest.has_task(task)
+    assert not manifest.has_task(dict(task, survey=WISE(filter=wise_filters.w2)))
+    assert not manifest.has_task(dict(task, size=4*u.arcmin))
+    assert not manifest.has_task(dict(task, group_by='MOSAIC'))
+    assert not manifest.has_task(dict(task, position=SkyCoord(150.1, 2.2, unit='deg')))
+    path.unlink() # nb: no longer on disk, so it's fetched again
+    assert not manifest.has_task(task)
+    manifest.close()
@@ -0,0 +1,104 @@
+import time
+from email.utils import formatdate
+
+import pytest
+
+import core.retry
+from core.retry import RetryPolicy, CircuitBreaker, CircuitBreakers, CircuitOpenError, HTTPStatusError, get_retry_after, is_host_fault
+
+
+class Clock:
+    """Stands in for the time module, so the breakers' timeouts pass at once."""
+    def __init__(self):
+        self.now = 1000.0
+    def monotonic(self):
+        return self.now
+    def time(self):
+        return time.time()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(core.retry, 'time', clock)
+    return clock
+
+
+def test_retry_delays_back_off_up_to_max_s():
+    policy = RetryPolicy(attempts=5, base_s=2, max_s=10, jitter=False)
+    assert [policy.get_delay(retry) for retry in range(1, 6)] == [2, 4, 8, 10, 10]
+    jittered = RetryPolicy(base_s=2, max_s=10)
+    assert all([0 <= jittered.get_delay(3) <= 8 for _ in range(100)])
+    assert policy.replace(attempts=0).attempts == 1
+    assert policy.replace(base_s=1).base_s == 1 and policy.base_s == 2
+
+
+def test_retry_after_is_waited_for_up_to_its_limit():
+    policy = RetryPolicy(base_s=2, max_s=10, max_retry_after_s=60)
+    assert policy.get_delay(1, retry_after=30) == 30
+    assert policy.get_delay(1, retry_after=600) == 60
+    assert get_retry_after("12") == 12
+    assert 50 < get_retry_after(formatdate(time.time()+60, usegmt=True)) <= 60
+    assert get_retry_after("-5") == 0
+    assert get_retry_after("soon") is None and get_retry_after(None) is None
+
+
+def test_only_the_host_s_own_faults_count_against_it():
+    assert is_host_fault(TimeoutError())
+    assert is_host_fault(HTTPStatusError(503, 'http://host/'))
+    assert not is_host_fault(HTTPStatusError(429, 'http://host/'))
+    assert not is_host_fault(HTTPStatusError(500, 'http://host/'))
+
+
+def test_circuit_opens_after_failures_in_a_row(clock):
+    breaker = CircuitBreaker('host', failures=3, reset_s=30)
+    breaker.add_failure()
+    breaker.add_failure()
+    breaker.add_success() # nb: in a row
+    assert not breaker.add_failure() and not breaker.add_failure()
+    breaker.before_request()
+    assert breaker.add_failure()
+    assert breaker.get_state() == {'state': 'open', 'failures': 3, 'trips': 1}
+    clock.now += 10
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_request()
+    assert error.value.retry_in_s == pytest.approx(20)
+    # nb: the failures of requests already under way don't reopen it
+    assert not breaker.add_failure()
+
+
+def test_half_open_probe_closes_or_reopens_for_twice_as_long(clock):
+    breaker = CircuitBreaker('host', failures=1, reset_s=30, max_reset_s=100)
+    breaker.add_failure()
+    clock.now += 30
+    breaker.before_request() # the probe
+    assert breaker.get_state()['state'] == 'half_open'
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request() # only the probe goes
+    assert breaker.add_failure()
+    assert breaker.get_state() == {'state': 'open', 'failures': 2, 'trips': 2}
+    clock.now += 59
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    clock.now += 1
+    breaker.before_request()
+    breaker.add_failure()
+    assert breaker.reset_s == 100 # nb: up to max_reset_s
+    clock.now += 100
+    breaker.before_request()
+    breaker.add_success()
+    assert breaker.get_state() == {'state': 'closed', 'failures': 0, 'trips': 3}
+    assert breaker.reset_s == 30
+    breaker.before_request()
+
+
+def test_breakers_are_per_host_with_the_settings_they_were_made_with():
+    breakers = CircuitBreakers(failures=2, reset_s=10)
+    first = breakers.get('a:80')
+    assert breakers.get('a:80') is first and breakers.get('b:80') is not first
+    breakers.configure(failures=4)
+    assert (first.max_failures, breakers.get('c:80').max_failures) == (2, 4)
+    first.add_failure()
+    first.add_failure()
+    assert breakers.get_states()['a:80']['state'] == 'open'
+    assert breakers.get_states()['b:80']['state'] == 'closed'
@@ -0,0 +1,87 @@
+import json
+import time
+import socket
+import threading
+
+import pytest
+
+import cli_config
+import fetch_cutouts
+from benchmarks.stand_ins import get_stand_in_survey
+from fetch_cutouts import LineWriter, send_all
+
+
+def test_slow_client_is_dropped_without_blocking_emit():
+    (server_end, client_end) = socket.socketpair()
+    dropped = threading.Event()
+    def drop():
+        dropped.set()
+        server_end.shutdown(socket.SHUT_RDWR)
+    writer = LineWriter(lambda line: send_all(server_end, line.encode('utf-8'), 0.5), max_lines=50, drop=drop)
+    start = time.perf_counter()
+    # nb: the client never reads, so the socket buffer fills
+    for i in range(20000):
+        writer.emit({'job': 'j1', 'pid': i, 'status': 'done', 'files': ['x'*200]})
+    assert time.perf_counter()-start < 5.0
+    assert dropped.wait(5.0)
+    writer.close()
+    server_end.close()
+    client_end.close()
+
+
+def test_lines_are_written_in_order():
+    lines = list()
+    writer = LineWriter(lines.append)
+    for i in range(100):
+        writer.emit({'pid': i})
+    writer.close()
+    assert lines == [f'{{"pid": {i}}}\n' for i in range(100)]
+
+
+def test_socket_streams_a_result_per_task(tmp_path, monkeypatch, stand_in_server, circuit_breakers):
+    monkeypatch.setattr(cli_config, 'get_survey_class', lambda name: get_stand_in_survey(name, stand_in_server.get_base_url()))
+    monkeypatch.chdir(tmp_path)
+    cfg = cli_config.CLIConfig(['FIRST'], str(tmp_path/'data_out'))
+    cfg.set_verbosity('quiet')
+    service = fetch_cutouts.CutoutService(cfg, surveys=['FIRST'], size=2, grabbers=4)
+    server = fetch_cutouts.JobSocketServer(str(tmp_path/'service.sock'), service)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(str(tmp_path/'service.sock'))
+        jobs = [{'id': 'j1', 'targets': [{'coords': f"{150+0.1*i} 2.2"} for i in range(3)]},
+                {'id': 'j2', 'coords': "151 2.2", 'radius': 0.5},
+                {'id': 'bad'}]
+        client.sendall("".join([json.dumps(job)+"\n" for job in jobs]).encode('utf-8'))
+        client.shutdown(socket.SHUT_WR)
+        with client.makefile('r') as results:
+            records = [json.loads(line) for line in results]
+        client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+    tasks = [r for r in records if not r.get('done')]
+    done = {r['job']: r for r in records if r.get('done')}
+    assert sorted([(r['job'], r['status']) for r in tasks]) == [('j1', 'done')]*3 + [('j2', 'done')]
+    assert all([len(r['files']) == 1 and r['files'][0].startswith(str(tmp_path)) for r in tasks])
+    assert (done['j1']['tasks'], done['j1']['failed']) == (3, 0)
+    assert done['j2']['tasks'] == 1
+    assert 'error' in done['bad']
+    # nb: each job's done line comes after its task lines
+    for job in ['j1', 'j2']:
+        assert max([records.index(r) for r in tasks if r['job'] == job]) < records.index(done[job])
+
+
+def test_socket_path_only_replaces_a_socket(tmp_path):
+    path = tmp_path/'jobs.jsonl'
+    path.write_text("not a socket")
+    with pytest.raises(Exception, match="isn't a socket"):
+        fetch_cutouts.JobSocketServer(str(path), service=None)
+    assert path.read_text() == "not a socket"
+    # a stale socket file is replaced
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(tmp_path/'service.sock'))
+    stale.close()
+    server = fetch_cutouts.JobSocketServer(str(tmp_path/'service.sock'), service=None)
+    server.server_close()
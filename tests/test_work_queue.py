@@ -0,0 +1,69 @@
+import pytest
+
+import core.work_queue
+from core.work_queue import WorkQueue
+
+
+class Clock:
+    """Stands in for the time module, so leases expire at once."""
+    def __init__(self):
+        self.now = 1000.0
+    def time(self):
+        return self.now
+    def time_ns(self):
+        self.now += 1e-6 # nb: so ids still sort in publishing order
+        return int(self.now*1e9)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(core.work_queue, 'time', clock)
+    return clock
+
+
+def test_expired_lease_is_requeued_and_the_old_holder_loses_it(tmp_path, clock):
+    first, second = WorkQueue(str(tmp_path), 'node1'), WorkQueue(str(tmp_path), 'node2')
+    task_id = first.publish({'n': 1})
+    lease = first.lease(lease_s=60)
+    assert lease.id == task_id and lease.task['task'] == {'n': 1}
+    assert second.lease(lease_s=60) is None # nb: not expired yet
+    clock.now += 30
+    assert first.renew(lease, lease_s=60)
+    clock.now += 45
+    assert second.lease(lease_s=60) is None # nb: renewed
+    clock.now += 16
+    taken = second.lease(lease_s=60)
+    assert taken.id == task_id
+    assert not first.renew(lease) and not first.ack(lease, {'files': []})
+    assert second.ack(taken, {'files': ['a.fits']})
+    assert first.get_counts() == {'pending': 0, 'leased': 0, 'done': 1, 'failed': 0, 'parked': 0}
+    assert first.is_drained()
+
+
+def test_failed_task_is_retried_until_out_of_attempts(tmp_path, clock):
+    queue = WorkQueue(str(tmp_path), 'node1')
+    queue.publish({'n': 1})
+    for attempt in range(1, 3):
+        lease = queue.lease()
+        assert lease.task['attempts'] == attempt-1
+        assert queue.fail(lease, "HTTP 500", max_attempts=2)
+    assert queue.get_counts()['failed'] == 1 and queue.lease() is None
+    assert queue.is_drained()
+
+
+def test_parked_task_comes_back_once_its_time_is_up(tmp_path, clock):
+    queue = WorkQueue(str(tmp_path), 'node1')
+    queue.publish({'n': 1})
+    assert queue.park(queue.lease(), park_s=30)
+    assert queue.lease() is None and not queue.is_drained()
+    clock.now += 31
+    lease = queue.lease()
+    assert lease.task['parks'] == 1 and lease.task['attempts'] == 0
+
+
+def test_tasks_are_leased_oldest_first(tmp_path, clock):
+    queue = WorkQueue(str(tmp_path), 'node1')
+    ids = [queue.publish({'n': n}) for n in range(5)]
+    assert [queue.lease().id for _ in ids] == ids
+    assert queue.lease() is None